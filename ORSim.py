@@ -27,49 +27,40 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 from datetime import datetime, timedelta, date
-from sklearn.neighbors import KernelDensity
 from numpy import array, linspace
 import numpy as np
 from matplotlib.pyplot import plot
-import random
 from matplotlib import colors as mcolors
-import openpyxl
+import matplotlib.dates as mdates
+from matplotlib.patches import Patch
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+import warnings
+from statistics import NormalDist
+from scipy.special import ndtr
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+import cProfile
 pd.options.mode.chained_assignment = None
 pd.set_option('display.max_rows', 100)
 
-# read in the data from the input files
-dt = pd.read_excel("OR_Model_Final_PSH.xlsx", engine='openpyxl')
-cancelled_cases = pd.read_excel("2019_Cancelled_Cases_Complete_Clean.xlsx", engine='openpyxl')
+# input files - these are read lazily the first time the data is needed, not at import
+# the scheduled cases workbook ships as .XLSX - the exact case matters on case-sensitive file systems
+SCHEDULED_CASES_FILE = "OR_Model_Final_PSH.XLSX"
+CANCELLED_CASES_FILE = "2019_Cancelled_Cases_Complete_Clean.xlsx"
 
-'''
-
-Parses and Organizes Data from Scheduled Cases Dataset (OR_Model_Final_PSH.xlsx)
-
-'''
-
-###################### Clean Actual Cases Data #########################################################
-# create some new columns in the data for other useful stats
-# scheduled vs. actual case length
-dt['scheduled_case_duration'] = dt['SCH_END'] - dt['SCH_START']
-dt['actual_case_duration'] = dt['OUT_ROOM_TIME'] - dt['IN_ROOM_TIME']
-# scheduled vs. actual case length in seconds
-dt['actual_case_duration_seconds'] = (dt['OUT_ROOM_TIME'] - dt['IN_ROOM_TIME']).dt.total_seconds()
-dt['scheduled_case_duration_seconds'] = (dt['SCH_END'] - dt['SCH_START']).dt.total_seconds()
-# scheduled vs. actual case length in minutes
-dt['actual_case_duration_minute'] = pd.to_numeric(dt['actual_case_duration_seconds'])/60
-dt['scheduled_case_duration_minute'] = pd.to_numeric(dt['scheduled_case_duration_seconds'])/60
-# make columns for just time regardless of date - will be used later to model variability in starting time
-dt['scheduled_start_time'] = dt['SCH_START'].apply(lambda x : datetime.strptime(str(x), "%Y-%m-%d %H:%M:%S").time())
-dt['actual_start_time'] = dt['IN_ROOM_TIME'].apply(lambda x : datetime.strptime(str(x), "%Y-%m-%d %H:%M:%S").time())
-#add month column
-dt['SCH_START_MONTH'] = dt['SCH_START'].dt.strftime('%b')
-dt['ACTUAL_START_MONTH'] = dt['IN_ROOM_TIME'].dt.strftime('%b')
-#calculate difference between actual and planned numbers
-dt['actual_minus_scheduled_case_duration_minute'] = dt['actual_case_duration_minute'] - dt['scheduled_case_duration_minute']
-dt['actual_minus_scheduled_case_start_time'] = (dt['IN_ROOM_TIME'] - dt['SCH_START']).dt.total_seconds()/60
-#fix capitalization
-dt['WEEKDAY'] = dt['WEEKDAY'].str.capitalize()
+# the cleaned combined_data frame is cached here as a Feather file keyed by the hashes of the input files
+# bump CACHE_VERSION whenever the cleaning steps below change so that old caches get rebuilt
+CACHE_DIR = ".orsim_cache"
+CACHE_VERSION = 3
 
 def classify(inp):
     '''
@@ -79,7 +70,7 @@ def classify(inp):
     3) Priority
     -1) Non-emergency classification
     '''
-    
+
     if inp < 1: #emergency
         return 1
     elif inp < 6:
@@ -88,7 +79,7 @@ def classify(inp):
         return 3 #priority
     else:
         return 0 #elective
-    
+
 def day_of_week(inp):
     if inp == 0:
         return "Mon"
@@ -104,34 +95,135 @@ def day_of_week(inp):
         return "Sat"
     else:
         return "Sun"
-    
-dt['ACTUAL_WEEKDAY'] = (dt['IN_ROOM_TIME']).dt.dayofweek.apply(day_of_week)
-dt['calculated_add_on_hours']=(dt['SCH_START']-dt['ORIG_SCH_DATE']).apply(lambda x : x.seconds/360)
-dt['new_emergency_classification'] = dt['calculated_add_on_hours'].apply(classify)
-dt['cancelled_flag'] = 0
+
+#month abbreviations used in the data and their numbers
+month_numbers = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6, "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+def monthNumber(selected_month):
+    #anything not recognised is treated as December, as before
+    return month_numbers.get(selected_month, 12)
+
+#categorical types of the month and weekday columns - a fixed set of categories keeps them categorical when combined
+weekday_names = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+month_type = pd.CategoricalDtype(list(month_numbers))
+weekday_type = pd.CategoricalDtype(weekday_names)
+
+def classifyHours(hours):
+    #vectorized classify - missing hours count as elective, as before
+    return np.select([hours < 1, hours < 6, hours < 24], [1, 2, 3], default=0)
+
+def monthNames(times):
+    #month abbreviation of each datetime as a categorical, missing where the time is missing
+    return pd.Series(pd.Categorical.from_codes(times.dt.month.fillna(0).astype(int) - 1, dtype=month_type), index=times.index)
+
+def weekdayNames(times):
+    #weekday abbreviation of each datetime as a categorical, missing where the time is missing
+    return pd.Series(pd.Categorical.from_codes(times.dt.dayofweek.fillna(-1).astype(int), dtype=weekday_type), index=times.index)
+
+def minutesSinceMidnight(times):
+    #minutes since midnight of each datetime (seconds as a fraction), nan where the time is missing
+    return ((times - times.dt.floor("D"))/pd.Timedelta(minutes=1)).to_numpy()
 
 '''
 
-Parses and Organizes Data from Cancelled Cases Dataset (2019_Cancelled_Cases_Complete_Clean.xlxs)
+Schema of the cleaned combined_data. Rooms, service lines and the other repeated labels are categoricals and times of
+day are minutes since midnight, so the filters on them compare integer codes and numbers instead of strings and
+datetime.time objects.
 
 '''
 
-################################# Clean Cancelled Cases Data ##############################################################
-#rename columns of cancelled data and make new columns similar to what we did with the regular data
-cancelled_cases = cancelled_cases.rename(columns={"Case Number Formatted": "CASE_NBR", "Scheduled OR Number": "SCH_OR",
-                                                  "Service Line": "Service_Line", "Service Line Dept": "Service_Line_Dept",
-                                                "Cancelled Date and time": "CANCELLED_DATE", "Scheduled Start  Date and Time": "SCH_START"})
+############################# combined_data schema ##############################################################
+#column types of combined_data - 'category' columns get the sorted labels found in the data as their categories
+#times of day are float32 minutes since midnight: cancelled cases have no actual time (nan) and some have seconds
+combined_data_schema = {
+    'SCH_OR': 'category', 'OR_USED': 'category', 'Service_Line': 'category', 'Service_Line_Dept': 'category',
+    'PT_STATUS': 'category', 'Medical Service': 'category',
+    'SCH_START_MONTH': month_type, 'ACTUAL_START_MONTH': month_type, 'WEEKDAY': weekday_type, 'ACTUAL_WEEKDAY': weekday_type,
+    'scheduled_start_time': np.float32, 'actual_start_time': np.float32, 'cancelled_flag': np.int8}
+
+def applySchema(combined_data):
+    '''
+    Input: cleaned cases - just combined, or read back from a cache or the case store
+    Output: a copy with the column types of combined_data_schema - label columns that were combined from frames with
+    different categories (which pandas turns back into strings) are made categorical again
+    '''
+    types = {column: column_type for column, column_type in combined_data_schema.items() if column in combined_data.columns}
+    return combined_data.astype(types)
+
+'''
+
+Parses and Organizes Data from Scheduled Cases Dataset (OR_Model_Final_PSH.xlsx)
+
+'''
 
-cancelled_cases['scheduled_case_duration'] = cancelled_cases['SCH_END'] - cancelled_cases['SCH_START']
-cancelled_cases['scheduled_case_duration_seconds'] = (cancelled_cases['SCH_END'] - cancelled_cases['SCH_START']).dt.total_seconds()
-cancelled_cases['scheduled_case_duration_minute'] = pd.to_numeric(cancelled_cases['scheduled_case_duration_seconds'])/60
-cancelled_cases['scheduled_start_time'] = cancelled_cases['SCH_START'].apply(lambda x : datetime.strptime(str(x), "%Y-%m-%d %H:%M:%S").time())
-cancelled_cases['SCH_START_MONTH'] = cancelled_cases['SCH_START'].dt.strftime('%b')
+###################### Clean Actual Cases Data #########################################################
+def cleanScheduledCases(dt):
+    '''
+    Input: raw scheduled cases as read from OR_Model_Final_PSH.xlsx (or any extract with the same columns)
+    Output: a copy with the derived columns used by the simulation
+    '''
+    dt = dt.copy()
+    for column in ['CASE_DATE', 'ORIG_SCH_DATE', 'SCH_START', 'SCH_END', 'IN_ROOM_TIME', 'OUT_ROOM_TIME']:
+        dt[column] = pd.to_datetime(dt[column])
+    # create some new columns in the data for other useful stats
+    # scheduled vs. actual case length
+    dt['scheduled_case_duration'] = dt['SCH_END'] - dt['SCH_START']
+    dt['actual_case_duration'] = dt['OUT_ROOM_TIME'] - dt['IN_ROOM_TIME']
+    # scheduled vs. actual case length in seconds
+    dt['actual_case_duration_seconds'] = dt['actual_case_duration'].dt.total_seconds()
+    dt['scheduled_case_duration_seconds'] = dt['scheduled_case_duration'].dt.total_seconds()
+    # scheduled vs. actual case length in minutes
+    dt['actual_case_duration_minute'] = dt['actual_case_duration_seconds']/60
+    dt['scheduled_case_duration_minute'] = dt['scheduled_case_duration_seconds']/60
+    # make columns for just time regardless of date - will be used later to model variability in starting time
+    dt['scheduled_start_time'] = minutesSinceMidnight(dt['SCH_START'])
+    dt['actual_start_time'] = minutesSinceMidnight(dt['IN_ROOM_TIME'])
+    #add month column
+    dt['SCH_START_MONTH'] = monthNames(dt['SCH_START'])
+    dt['ACTUAL_START_MONTH'] = monthNames(dt['IN_ROOM_TIME'])
+    #calculate difference between actual and planned numbers
+    dt['actual_minus_scheduled_case_duration_minute'] = dt['actual_case_duration_minute'] - dt['scheduled_case_duration_minute']
+    dt['actual_minus_scheduled_case_start_time'] = (dt['IN_ROOM_TIME'] - dt['SCH_START']).dt.total_seconds()/60
+    #fix capitalization
+    dt['WEEKDAY'] = dt['WEEKDAY'].str.capitalize().astype(weekday_type)
+
+    dt['ACTUAL_WEEKDAY'] = weekdayNames(dt['IN_ROOM_TIME'])
+    #seconds part of the lead time only (as timedelta.seconds) over 360, as the classification was built on
+    dt['calculated_add_on_hours'] = (dt['SCH_START'] - dt['ORIG_SCH_DATE']).dt.seconds/360
+    dt['new_emergency_classification'] = classifyHours(dt['calculated_add_on_hours'])
+    dt['cancelled_flag'] = 0
+    return dt
+
+'''
 
-#Add cancelled flag, week day, and case date    
-cancelled_cases['cancelled_flag'] = 1
-cancelled_cases['WEEKDAY'] = (cancelled_cases['SCH_START']).dt.dayofweek.apply(day_of_week)
-cancelled_cases['CASE_DATE'] = cancelled_cases['SCH_START'].dt.floor("D") #.dt.date.
+Parses and Organizes Data from Cancelled Cases Dataset (2019_Cancelled_Cases_Complete_Clean.xlxs)
+
+'''
+
+################################# Clean Cancelled Cases Data ##############################################################
+def cleanCancelledCases(cancelled_cases):
+    '''
+    Input: raw cancelled cases as read from 2019_Cancelled_Cases_Complete_Clean.xlsx (or any extract with the same columns)
+    Output: cancelled cases renamed and formatted to match the scheduled cases
+    '''
+    #rename columns of cancelled data and make new columns similar to what we did with the regular data
+    cancelled_cases = cancelled_cases.rename(columns={"Case Number Formatted": "CASE_NBR", "Scheduled OR Number": "SCH_OR",
+                                                      "Service Line": "Service_Line", "Service Line Dept": "Service_Line_Dept",
+                                                    "Cancelled Date and time": "CANCELLED_DATE", "Scheduled Start  Date and Time": "SCH_START"})
+    for column in ['CANCELLED_DATE', 'SCH_START', 'SCH_END', 'IN_ROOM_TIME', 'OUT_ROOM_TIME']:
+        cancelled_cases[column] = pd.to_datetime(cancelled_cases[column])
+
+    cancelled_cases['scheduled_case_duration'] = cancelled_cases['SCH_END'] - cancelled_cases['SCH_START']
+    cancelled_cases['scheduled_case_duration_seconds'] = cancelled_cases['scheduled_case_duration'].dt.total_seconds()
+    cancelled_cases['scheduled_case_duration_minute'] = cancelled_cases['scheduled_case_duration_seconds']/60
+    cancelled_cases['scheduled_start_time'] = minutesSinceMidnight(cancelled_cases['SCH_START'])
+    cancelled_cases['SCH_START_MONTH'] = monthNames(cancelled_cases['SCH_START'])
+
+    #Add cancelled flag, week day, and case date
+    cancelled_cases['cancelled_flag'] = 1
+    cancelled_cases['WEEKDAY'] = weekdayNames(cancelled_cases['SCH_START'])
+    cancelled_cases['CASE_DATE'] = cancelled_cases['SCH_START'].dt.floor("D") #.dt.date.
+    return cancelled_cases
 
 '''
 
@@ -139,8 +231,16 @@ Combines Cancelled and Scheduled Cases into one Pandas DataFrame
 
 '''
 
-#Make the combined data set
-combined_data = pd.concat([dt, cancelled_cases])
+def combineCases(dt, cancelled_cases):
+    #Make the combined data set - a fresh index keeps it storable in the Feather cache
+    return pd.concat([dt, cancelled_cases], ignore_index=True)
+
+def cleanData(scheduled_cases, cancelled_cases):
+    '''
+    Input: raw scheduled and cancelled cases of any extract with the same columns as the two workbooks
+    Output: the cleaned combined_data DataFrame, with the column types of combined_data_schema
+    '''
+    return applySchema(combineCases(cleanScheduledCases(scheduled_cases), cleanCancelledCases(cancelled_cases)))
 
 
 '''
@@ -150,13 +250,1893 @@ Filters OR Rooms as well as retains the unique set of OR rooms from the combined
 '''
 
 ###################### Ignore rooms in simulation and create a full list of rooms to use #######################################
-#Find the list of rooms to use during the analysis and sort them by order
-all_or_rooms = combined_data.SCH_OR.unique()
 ignore_or = ["At Bedside", "MOR CATH 01", "MPR 01", "SPR 04", "CHPR 02", "CHPR 01", "MOR Add On 2", "CHOR Add On 1",
             "MOR Standby 1", "MOR Standby 2", "CHOR Standby 1", "CHPR Add On 1","MOR Add On 1"]
-all_or_rooms = list(set(all_or_rooms).difference(ignore_or))
-all_or_rooms = [x for x in all_or_rooms if str(x) != 'nan']
-all_or_rooms.sort(reverse=False)
+
+def findORRooms(combined_data):
+    #Find the list of rooms to use during the analysis and sort them by order
+    all_or_rooms = combined_data.SCH_OR.unique()
+    all_or_rooms = list(set(all_or_rooms).difference(ignore_or))
+    all_or_rooms = [x for x in all_or_rooms if pd.notnull(x)]
+    all_or_rooms.sort(reverse=False)
+    return all_or_rooms
+
+
+'''
+
+Loads the data on first use instead of at import, and caches the cleaned combined_data on disk
+
+'''
+
+################################# Load and cache the data ##############################################################
+#data used by this process - filled in on first use
+_loaded = {'combined_data': None, 'all_or_rooms': None, 'distribution_index': None, 'real_schedule_index': None, 'partitions': {}}
+
+def hashFile(path):
+    #hash the file contents so the cache is rebuilt whenever a workbook changes
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def readCombinedData(scheduled_file=SCHEDULED_CASES_FILE, cancelled_file=CANCELLED_CASES_FILE):
+    #read and clean both workbooks - this is the slow path that the cache avoids
+    dt = pd.read_excel(scheduled_file, engine='openpyxl')
+    cancelled_cases = pd.read_excel(cancelled_file, engine='openpyxl')
+    return cleanData(dt, cancelled_cases)
+
+def loadData(scheduled_file=SCHEDULED_CASES_FILE, cancelled_file=CANCELLED_CASES_FILE, cache_dir=CACHE_DIR, use_cache=True):
+    '''
+    Input: paths to the scheduled and cancelled case workbooks, folder for the cache, whether to use the cache
+    Output: the cleaned combined_data DataFrame, which is also used by the rest of the module from now on
+    '''
+    if not use_cache:
+        return useData(readCombinedData(scheduled_file, cancelled_file))
+
+    #the cache key changes if either workbook or the cleaning code changes
+    cache_key = hashlib.sha256("{}:{}:{}".format(CACHE_VERSION, hashFile(scheduled_file), hashFile(cancelled_file)).encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, "combined_data_" + cache_key + ".feather")
+
+    if os.path.exists(cache_file):
+        try:
+            return useData(pd.read_feather(cache_file))
+        except Exception as e:
+            warnings.warn("Could not read data cache {}, rebuilding it: {}".format(cache_file, e))
+
+    combined_data = readCombinedData(scheduled_file, cancelled_file)
+
+    #write the new cache and clear out the caches of older versions of the workbooks
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for old_file in os.listdir(cache_dir):
+            if old_file.startswith("combined_data_") and old_file.endswith(".feather"):
+                os.remove(os.path.join(cache_dir, old_file))
+        combined_data.to_feather(cache_file)
+    except Exception as e:
+        #Feather needs pyarrow - without it everything still works, just without the disk cache
+        warnings.warn("Could not write data cache {}: {}".format(cache_file, e))
+
+    return useData(combined_data)
+
+def useData(combined_data):
+    #make a cleaned combined_data frame the one used by the simulation - frames from older caches or concatenated
+    #extracts get the schema's column types back
+    combined_data = applySchema(combined_data)
+    _loaded['combined_data'] = combined_data
+    _loaded['all_or_rooms'] = findORRooms(combined_data)
+    #distributions fitted to the old data and its date index no longer apply
+    _loaded['distribution_index'] = None
+    _loaded['real_schedule_index'] = None
+    _loaded['partitions'] = {}
+    return combined_data
+
+def getCombinedData():
+    #cleaned scheduled + cancelled cases, loaded on first use
+    if _loaded['combined_data'] is None:
+        loadData()
+    return _loaded['combined_data']
+
+def getAllORRooms():
+    #sorted list of OR rooms used in the simulation, loaded on first use
+    if _loaded['all_or_rooms'] is None:
+        loadData()
+    return _loaded['all_or_rooms']
+
+class CasePartitions:
+    '''
+    Row positions of cases for every combination of values of some key columns, found in one groupby pass - a
+    filter on all the keys is then a dict lookup instead of a full-length mask
+    '''
+    def __init__(self, cases, keys):
+        self.cases = cases
+        self.keys = list(keys)
+        #rows with a missing key are in no partition, as they match no == filter
+        self.indices = cases.groupby(self.keys, observed=True, sort=False).indices
+
+    def positions(self, *key):
+        #row positions of the cases with these key values, in their order in cases
+        return self.indices.get(key if len(key) > 1 else key[0], np.array([], dtype=np.intp))
+
+    def get(self, *key):
+        #the cases with these key values
+        return self.cases.iloc[self.positions(*key)]
+
+def getPartitions(keys):
+    #partitions of the data in use by some key columns, built on first use
+    keys = tuple(keys)
+    if keys not in _loaded['partitions']:
+        _loaded['partitions'][keys] = CasePartitions(getCombinedData(), keys)
+    return _loaded['partitions'][keys]
+
+def selectCases(**columns):
+    '''
+    Input: column=value filters, e.g. selectCases(SCH_OR="MOR 01", SCH_START_MONTH="Apr", WEEKDAY="Tue")
+    Output: the cases of combined_data matching every filter - the partitions of each set of columns are built once
+    '''
+    keys = sorted(columns)
+    return getPartitions(keys).get(*[columns[key] for key in keys])
+
+def __getattr__(name):
+    #keeps ORSim.combined_data and ORSim.all_or_rooms working without loading the data at import
+    if name == 'combined_data':
+        return getCombinedData()
+    if name == 'all_or_rooms':
+        return getAllORRooms()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+'''
+
+Profiling. Opt-in named timers and counters for the hot paths - fitting, planning and simulating each room, bounded
+KDE draws whose bounds could not be met and retried case lengths. The hooks look up the active Profiler and do nothing when there is none, so
+they cost next to nothing when profiling is off.
+
+'''
+
+############################# Profiling hooks ########################################################################
+#Profiler the hooks report to - None when profiling is off
+_profiling = {'profiler': None}
+
+#timer handed out when profiling is off
+_no_timer = nullcontext()
+
+class Profiler:
+    '''
+    Timers and counters of one profiled run, keyed by (name, room). Room is the room of the innermost timer that
+    names one - ALL for fits over every room, None outside of them. Optionally keeps every timed span for a JSON
+    trace and runs cProfile too. Only this process reports, so profile parallel runs with max_workers=1.
+    '''
+    def __init__(self, trace=False, cprofile=False):
+        #timers: (name, room) -> [calls, seconds], counters: (name, room) -> count
+        self.timers = {}
+        self.counters = {}
+        self.room = None
+        self.origin = perf_counter()
+        self.spans = [] if trace else None
+        self.cprofile = cProfile.Profile() if cprofile else None
+
+    @contextmanager
+    def timer(self, name, room=None):
+        #times the with block - a room also becomes the room of the counters inside it
+        outer_room = self.room
+        if room is not None:
+            self.room = room
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            key = (name, self.room)
+            timer = self.timers.setdefault(key, [0, 0.0])
+            timer[0] += 1
+            timer[1] += end - start
+            if self.spans is not None:
+                self.spans.append((name, self.room, start, end))
+            self.room = outer_room
+
+    def count(self, name, n=1):
+        key = (name, self.room)
+        self.counters[key] = self.counters.get(key, 0) + int(n)
+
+    def timerSummary(self):
+        #one row per timer and room, slowest first
+        rows = [(name, room, calls, seconds) for (name, room), (calls, seconds) in self.timers.items()]
+        summary = pd.DataFrame(rows, columns=['NAME', 'ROOM', 'CALLS', 'SECONDS'])
+        summary['MEAN_MS'] = 1000*summary.SECONDS/summary.CALLS
+        return summary.sort_values(by='SECONDS', ascending=False, ignore_index=True)
+
+    def counterSummary(self):
+        #one row per counter and room
+        rows = [(name, room, count) for (name, room), count in self.counters.items()]
+        return pd.DataFrame(rows, columns=['NAME', 'ROOM', 'COUNT']).sort_values(by=['NAME', 'ROOM'], key=lambda column: column.astype(str), ignore_index=True)
+
+    def writeTrace(self, path):
+        '''
+        Input: path of the JSON file
+        Output: the path - timed spans (recorded with trace=True) and the final counts in the Chrome trace event
+        format, which chrome://tracing and Perfetto open
+        '''
+        process = os.getpid()
+        events = [{'name': name, 'cat': 'orsim', 'ph': 'X', 'pid': process, 'tid': 0, 'ts': 1e6*(start - self.origin),
+                   'dur': 1e6*(end - start), 'args': {'room': room}} for name, room, start, end in (self.spans or [])]
+        end = 1e6*(perf_counter() - self.origin)
+        events += [{'name': name if room is None else "{} {}".format(name, room), 'cat': 'orsim', 'ph': 'C', 'pid': process,
+                    'ts': end, 'args': {'count': count}} for (name, room), count in self.counters.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+    def dumpStats(self, path):
+        #cProfile statistics of the run (recorded with cprofile=True), readable with pstats or snakeviz
+        if self.cprofile is None:
+            raise ValueError("cProfile was not run - create the Profiler with cprofile=True")
+        self.cprofile.dump_stats(path)
+        return path
+
+@contextmanager
+def profiling(profiler=None):
+    '''
+    Input: Profiler to report to (default a new one)
+    Output: context manager giving the profiler - every hook run in this process inside the with block reports to it
+    '''
+    profiler = Profiler() if profiler is None else profiler
+    outer_profiler = _profiling['profiler']
+    _profiling['profiler'] = profiler
+    if profiler.cprofile is not None:
+        profiler.cprofile.enable()
+    try:
+        yield profiler
+    finally:
+        if profiler.cprofile is not None:
+            profiler.cprofile.disable()
+        _profiling['profiler'] = outer_profiler
+
+def profileTimer(name, room=None):
+    #timer of the active profiler, or a timer that does nothing when profiling is off
+    profiler = _profiling['profiler']
+    return _no_timer if profiler is None else profiler.timer(name, room)
+
+def profileCount(name, n=1):
+    #adds to a counter of the active profiler, if there is one
+    profiler = _profiling['profiler']
+    if profiler is not None:
+        profiler.count(name, n)
+
+
+'''
+
+Gaussian KDE sampling. Drawing from a Gaussian KDE only needs a random data point plus normal noise scaled by
+the bandwidth, so the samplers below keep the data and bandwidth and draw any number of values in one NumPy call.
+Bounded draws invert the CDF of the rounded KDE on a grid of whole numbers, so they take the same time however
+little of the distribution is inside the bounds.
+
+'''
+
+############################# KDE sampler ########################################################################
+#random numbers used when no generator is passed in
+_default_rng = np.random.default_rng()
+
+def spawnSeeds(seed, n):
+    '''
+    Input: seed - None, int, SeedSequence or numpy Generator - and number of child streams
+    Output: n independent SeedSequences for child random streams
+    '''
+    if isinstance(seed, np.random.Generator):
+        #a generator has no public seed sequence on older numpy - seed the children from its own draws
+        seed = np.random.SeedSequence(seed.integers(2**63, size=4))
+    elif not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+class KDESampler:
+    '''
+    Draws from a Gaussian kernel density estimate of data - the same distribution as
+    KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(data).sample() without fitting anything
+    '''
+    __slots__ = ('data', 'bandwidth', 'grid')
+
+    #bounds that hold less of the KDE's probability than this cannot be met - those draws take the nearest bound
+    min_bounded_mass = 1e-12
+
+    def __init__(self, data, bandwidth):
+        data = np.asarray(data, dtype=float).ravel()
+        self.data = data[~np.isnan(data)]
+        self.bandwidth = bandwidth
+        self.grid = None
+
+    def sample(self, size=1, rng=None):
+        #pick a random data point for each draw and add normal noise with sd = bandwidth
+        rng = _default_rng if rng is None else rng
+        return self.data[rng.integers(0, len(self.data), size)] + rng.normal(0, self.bandwidth, size)
+
+    def sampleRounded(self, size=1, rng=None):
+        #draws rounded to whole numbers (minutes, number of cases)
+        return np.round(self.sample(size, rng))
+
+    def roundedCDF(self):
+        '''
+        Output: (values, cdf) - every whole number a rounded draw can take (out to 8 bandwidths past the data) and the
+        probability that a rounded draw is at most that value, computed on first use
+        '''
+        #samplers pickled before the grid existed have no grid attribute
+        if getattr(self, 'grid', None) is None:
+            values = np.arange(np.floor(self.data.min() - 8*self.bandwidth) - 1, np.ceil(self.data.max() + 8*self.bandwidth) + 2)
+            cdf = np.empty(len(values))
+            #a draw rounds to at most v when it is below v + .5 - a few hundred values at a time to keep memory small
+            for first in range(0, len(values), 256):
+                edges = values[first:first + 256, None] + .5
+                cdf[first:first + 256] = ndtr((edges - self.data[None, :])/self.bandwidth).mean(axis=1)
+            self.grid = (values, cdf)
+        return self.grid
+
+    def sampleWithin(self, low=-np.inf, high=np.inf, size=1, rng=None, name=None):
+        '''
+        Input: lower and upper bound (inclusive, scalars or one per draw), number of draws, random generator, optional
+        name of the distribution for the profiler
+        Output: rounded draws between the bounds - the same distribution as redrawing sampleRounded until every draw
+        is inside them, drawn in one pass by inverting the CDF of the rounded KDE between the bounds. Bounds the KDE
+        (almost) never reaches take the nearest bound, with a RuntimeWarning and a '<name> unmet bounds' count
+        '''
+        rng = _default_rng if rng is None else rng
+        low = np.ceil(np.broadcast_to(low, size).astype(float))
+        high = np.floor(np.broadcast_to(high, size).astype(float))
+        if (low > high).any():
+            raise ValueError("sampleWithin got a low bound above its high bound - no whole number is between them")
+        values, cdf = self.roundedCDF()
+        #probability of a rounded draw below low and of one at most high
+        below = np.interp(low - 1, values, cdf, left=0, right=1)
+        at_most_high = np.interp(high, values, cdf, left=0, right=1)
+        mass = at_most_high - below
+        position = np.searchsorted(cdf, below + rng.random(size)*mass, side='right')
+        draws = values[np.minimum(position, len(values) - 1)]
+
+        #in the far tail the truncated KDE is all at the bound, which is also where the draws go
+        unmet = mass < self.min_bounded_mass
+        if unmet.any():
+            draws[unmet] = np.where(at_most_high[unmet] < .5, high[unmet], low[unmet])
+            #one fixed message so the warning filter shows it once - the counts per distribution are in the profiler
+            warnings.warn("Some bounded KDE draws had bounds the data almost never reaches and took the nearest bound", RuntimeWarning)
+            if name is not None:
+                profileCount(name + " unmet bounds", unmet.sum())
+        return draws
+
+
+class CategoricalSampler:
+    '''
+    Draws from the historical probabilities of each value (or combination of values) of some columns, using a
+    precomputed cumulative probability array and np.searchsorted on a batch of uniform draws
+    '''
+    __slots__ = ('values', 'cumulative')
+
+    def __init__(self, cases, columns):
+        #probability of each combination of columns among cases, most common first
+        counts = cases.groupby(columns, observed=True).size().sort_values(ascending=False, kind='stable')
+        self.values = {column: counts.index.get_level_values(column).to_numpy() for column in columns}
+        self.cumulative = np.cumsum(counts.to_numpy()) / len(cases)
+
+    def __len__(self):
+        return len(self.cumulative)
+
+    def sampleIndex(self, size=1, rng=None):
+        #position of the drawn value for each draw - a draw past the last cumulative probability takes the last value
+        rng = _default_rng if rng is None else rng
+        return np.minimum(np.searchsorted(self.cumulative, rng.random(size), side='right'), len(self.cumulative)-1)
+
+    def sample(self, size=1, rng=None):
+        #dict of column -> array of drawn values
+        drawn = self.sampleIndex(size, rng)
+        return {column: values[drawn] for column, values in self.values.items()}
+
+
+def sampleByServiceLine(service_lines, get_sampler, rng, columns=1, low=None, name=None):
+    '''
+    Input: service line of each draw, function giving the sampler of a service line, random generator,
+    number of draws per service line entry, optional lower bound for each entry, optional name of the
+    distribution for the profiler's unmet bound counts
+    Output: rounded draws, one row per entry of service_lines
+    '''
+    draws = np.full((len(service_lines), columns), np.nan)
+    for service_line in pd.unique(service_lines):
+        rows = service_lines == service_line
+        sampler = get_sampler(service_line)
+        if low is None:
+            draws[rows] = sampler.sampleRounded(rows.sum()*columns, rng).reshape(-1, columns)
+        else:
+            draws[rows, 0] = sampler.sampleWithin(low=low[rows], size=rows.sum(), rng=rng, name=None if name is None else "{} {}".format(name, service_line))
+    return draws
+
+
+'''
+
+Compact schedules used inside the simulation. Each case is one record of a structured NumPy array with its times
+as whole minutes from the start of the day and its room and service line as codes. Schedules are only turned back
+into the usual pandas layout when they are returned.
+
+'''
+
+############################# Compact schedule ########################################################################
+#time of a case that never happened (cancelled or not simulated yet) - the same value as NaT
+MISSING_TIME = np.iinfo(np.int64).min
+
+class CompactSchedule:
+    '''
+    Schedule of one day (or many replications of it) stored as a structured NumPy array of cases.
+    Times are int64 minutes from day_start and room / service_line are codes into the rooms / service_lines lists.
+    '''
+    __slots__ = ('day_start', 'rooms', 'service_lines', 'cases')
+
+    case_dtype = np.dtype([('replication', np.int32), ('case_nbr', np.int32), ('room', np.int16), ('service_line', np.int16),
+                           ('cancelled', np.int8), ('sch_start', np.int64), ('sch_end', np.int64),
+                           ('in_room', np.int64), ('out_room', np.int64)])
+
+    def __init__(self, day_start, rooms, service_lines, cases):
+        self.day_start = np.datetime64(day_start, 'm')
+        self.rooms = list(rooms)
+        self.service_lines = list(service_lines)
+        self.cases = cases
+
+    @classmethod
+    def empty(cls, day_start, rooms, service_lines, size):
+        #schedule of size cases with nothing simulated yet
+        cases = np.zeros(size, dtype=cls.case_dtype)
+        cases['in_room'] = MISSING_TIME
+        cases['out_room'] = MISSING_TIME
+        return cls(day_start, rooms, service_lines, cases)
+
+    @classmethod
+    def fromFrame(cls, planned_schedule, rooms):
+        '''
+        Input: planned schedule in the usual pandas layout, rooms to keep (in the order they are simulated)
+        Output: CompactSchedule with the cases of those rooms, in room order and then in the order of planned_schedule
+        '''
+        planned_schedule = planned_schedule[planned_schedule.SCH_OR.isin(rooms)]
+        room_codes = pd.Categorical(planned_schedule.SCH_OR, categories=rooms).codes
+        #stable sort keeps the planned order of the cases inside each room
+        planned_schedule = planned_schedule.iloc[np.argsort(room_codes, kind='stable')]
+        service_lines = pd.Categorical(planned_schedule.Service_Line)
+        if len(planned_schedule) > 0:
+            day_start = pd.Timestamp(planned_schedule.SCH_START.min()).floor("D")
+        else:
+            day_start = pd.Timestamp(2020, 1, 1)
+
+        schedule = cls.empty(day_start, rooms, service_lines.categories, len(planned_schedule))
+        cases = schedule.cases
+        if 'REPLICATION' in planned_schedule.columns:
+            cases['replication'] = planned_schedule.REPLICATION.to_numpy()
+        cases['case_nbr'] = planned_schedule.CASE_NBR.to_numpy()
+        cases['room'] = np.sort(room_codes)
+        cases['service_line'] = service_lines.codes
+        cases['cancelled'] = planned_schedule.CANCELLED.to_numpy()
+        cases['sch_start'] = schedule.toMinutes(planned_schedule.SCH_START)
+        cases['sch_end'] = schedule.toMinutes(planned_schedule.SCH_END)
+        return schedule
+
+    def toMinutes(self, times):
+        #datetimes -> whole minutes from day_start
+        minutes = (pd.to_datetime(times).to_numpy() - self.day_start) / np.timedelta64(1, 'm')
+        return np.where(np.isnan(minutes), MISSING_TIME, np.round(minutes)).astype(np.int64)
+
+    def toTimes(self, minutes):
+        #whole minutes from day_start -> datetimes (MISSING_TIME becomes NaT)
+        return (self.day_start + minutes.astype('timedelta64[m]')).astype('datetime64[ns]')
+
+    def toFrame(self, simulated=True, replications=False):
+        '''
+        Input: whether to include the simulated columns, whether to include the REPLICATION column
+        Output: the schedule in the usual pandas layout
+        '''
+        cases = self.cases
+        room_names = np.array(self.rooms, dtype=object)[cases['room']]
+        #code -1 (missing service line) picks the nan on the end
+        service_line_names = np.array(self.service_lines + [np.nan], dtype=object)[cases['service_line']]
+        d = {'CASE_NBR': cases['case_nbr'].astype(int), 'SCH_START': self.toTimes(cases['sch_start']), 'SCH_END': self.toTimes(cases['sch_end']),
+             'SCH_OR': room_names, 'Service_Line': service_line_names, 'CANCELLED': cases['cancelled'].astype(int)}
+        if simulated:
+            d['IN_ROOM_TIME'] = self.toTimes(cases['in_room'])
+            d['OUT_ROOM_TIME'] = self.toTimes(cases['out_room'])
+            d['OR_USED'] = np.where(cases['in_room'] == MISSING_TIME, "", room_names)
+        frame = pd.DataFrame(data=d)
+        if replications:
+            frame.insert(0, 'REPLICATION', cases['replication'])
+        return frame
+
+    @staticmethod
+    def replicationLayout(positions, replication):
+        #positions of one room's cases (sorted by replication) as a (replications, cases) array, -1 where a replication has fewer cases
+        #number the cases of each replication in their planned order
+        row = np.unique(replication, return_inverse=True)[1]
+        slot = np.arange(len(positions)) - np.searchsorted(replication, replication, side='left')
+        layout = np.full((row.max() + 1 if len(row) > 0 else 0, slot.max() + 1 if len(slot) > 0 else 0), -1)
+        layout[row, slot] = positions
+        return layout
+
+    def roomArrays(self, room):
+        '''
+        Input: room code
+        Output: positions of the room's cases in self.cases laid out as a (replications, cases) array,
+        -1 where a replication has fewer cases
+        '''
+        positions = np.flatnonzero(self.cases['room'] == room)
+        positions = positions[np.argsort(self.cases['replication'][positions], kind='stable')]
+        return self.replicationLayout(positions, self.cases['replication'][positions])
+
+    def roomLayouts(self):
+        #roomArrays of every room that has cases, in room order - one sort of the cases instead of one scan per room
+        order = np.lexsort((self.cases['replication'], self.cases['room']))
+        rooms = self.cases['room'][order]
+        replication = self.cases['replication'][order]
+        room_codes, room_starts = np.unique(rooms, return_index=True)
+        room_ends = np.append(room_starts[1:], len(order))
+        return {int(room): self.replicationLayout(order[start:end], replication[start:end])
+                for room, start, end in zip(room_codes, room_starts, room_ends)}
+
+
+'''
+
+Fitted distributions for planning a schedule. Everything planSchedule needs for a (room, month, weekday, cutoff)
+is the same every time, so it is built once here and planSchedule only samples from it.
+
+'''
+
+############################# Fitted distributions for planned schedules ##################################################
+class RoomPlanModel:
+    '''
+    Distributions planSchedule draws from for one OR room on a given month, weekday and cutoff time
+    '''
+    def __init__(self, or_single):
+        # rank the cases by time each day - we can use this to find the first, second, third, etc. case of each day
+        or_single['case_order_scheduled'] = or_single.groupby("CASE_DATE")["SCH_START"].rank("dense", ascending=True)
+
+        #Find the 90th percentile time a case has been scheduled to end in a room for use later, in minutes since midnight
+        max_time_or = np.sort(minutesSinceMidnight(or_single['SCH_END']))
+        self.max_time_or = max_time_or[round(.9*len(max_time_or))-1]
+
+        # KDE of the number of cases that will be in the OR that day
+        num_cases = or_single[['CASE_DATE', 'CASE_NBR']].groupby(['CASE_DATE']).agg(['count']).reset_index()
+        num_cases = num_cases[['CASE_NBR']]
+        num_cases_numpy = num_cases.to_numpy().reshape(-1, 1)
+        self.num_cases = KDESampler(num_cases_numpy, .3)
+
+        # What time will the first case start? Discrete distribution of historical probabilities
+        or_single_first_cases = or_single[(or_single.case_order_scheduled == 1)]
+        self.first_case_start_time = CategoricalSampler(or_single_first_cases, ['scheduled_start_time'])
+        self.first_case_start_minutes = self.first_case_start_time.values['scheduled_start_time'].astype(float)
+
+        # what is the probability of each type of case being the ith case of the day? one sampler per case order
+        #case orders whose cases all have no service line get no sampler, like case orders with no cases
+        self.service_line_samplers = {int(case_order): CategoricalSampler(cases, ['Service_Line', 'cancelled_flag'])
+                                      for case_order, cases in or_single.groupby('case_order_scheduled') if cases.Service_Line.notna().any()}
+
+        #distribution of time between cases to draw from
+        or_single_copy = or_single.copy()
+        or_single_copy['case_order_scheduled'] = or_single_copy['case_order_scheduled'] - 1
+        or_single_time_between = or_single.merge(or_single_copy, how='left', on=['CASE_DATE', 'case_order_scheduled', 'SCH_OR'])
+        or_single_time_between = or_single_time_between[['SCH_START_x', 'SCH_END_x', 'SCH_OR', 'SCH_START_y', 'SCH_END_y']]
+        or_single_time_between = or_single_time_between[or_single_time_between.SCH_START_y.notnull()]
+        or_single_time_between['time_between_surgeries_scheduled'] = (or_single_time_between['SCH_START_y'] - or_single_time_between['SCH_END_x']).dt.total_seconds()/60
+
+        scheduled_time_between = or_single_time_between[['time_between_surgeries_scheduled']]
+        scheduled_time_between_numpy = scheduled_time_between.to_numpy().reshape(-1, 1)
+        #check if there are enough cases to build this data, otherwise set it to just be 10 minutes
+        if len(scheduled_time_between) == 0:
+            scheduled_time_between_numpy = np.array([10,10,10,10]).reshape(-1, 1)
+        self.time_between_cases = KDESampler(scheduled_time_between_numpy, .02)
+
+        #scheduled case lengths of each service line - their distributions are filled in lazily
+        self.scheduled_lengths = {service_line: lengths.to_numpy() for service_line, lengths in or_single.groupby('Service_Line', observed=True)['scheduled_case_duration_minute']}
+        self.all_scheduled_lengths = or_single['scheduled_case_duration_minute'].to_numpy()
+        self.case_lengths = {}
+
+    def drawServiceLines(self, n, max_cases, rng=None):
+        '''
+        Input: number of days, number of cases per day, random generator
+        Output: (days, cases) arrays with the service line and cancelled flag of each case
+        '''
+        rng = _default_rng if rng is None else rng
+        service_lines = np.empty((n, max_cases), dtype=object)
+        cancelled = np.zeros((n, max_cases), dtype=int)
+        for i in range(1, max_cases+1):
+            sampler = self.service_line_samplers.get(i)
+            if sampler is not None:
+                drawn = sampler.sample(n, rng)
+                case_type = drawn['Service_Line']
+                case_cancelled = drawn['cancelled_flag']
+            else:
+                #no historical ith cases - the case is the same type as the one before it
+                case_type = service_lines[:, i-2]
+                case_cancelled = cancelled[:, i-2]
+            #94% of the time the case type should be the same as the one before it
+            if i != 1:
+                previous_case_type = service_lines[:, i-2]
+                case_type = np.where((case_type != previous_case_type) & (rng.random(n) >= .06), previous_case_type, case_type)
+            service_lines[:, i-1] = case_type
+            cancelled[:, i-1] = case_cancelled
+        return service_lines, cancelled
+
+    def drawStartingTimes(self, n, rng=None):
+        #start of the first case of each of n days, in minutes after midnight
+        return self.first_case_start_minutes[self.first_case_start_time.sampleIndex(n, rng)]
+
+    def planBatch(self, n, rng):
+        '''
+        Input: number of days to plan, random generator
+        Output: dict of (days, cases) arrays - service line, cancelled flag, scheduled start and end in minutes
+        after midnight - and 'in_plan', which marks the cases that are on each planned day
+        '''
+        # Start by seeing how many cases there will be each day
+        num_cases = self.num_cases.sampleRounded(n, rng).astype(int)
+        max_cases = max(num_cases.max(), 0)
+        in_plan = np.arange(max_cases) < num_cases[:, None]
+        sch_start = np.full((n, max_cases), np.nan)
+        sch_end = np.full((n, max_cases), np.nan)
+
+        # for each of the cases that is scheduled for that day, what is that case?
+        service_lines, cancelled = self.drawServiceLines(n, max_cases, rng)
+
+        if max_cases == 0:
+            return {'service_line': service_lines, 'cancelled': cancelled, 'sch_start': sch_start, 'sch_end': sch_end, 'in_plan': in_plan}
+
+        # What time will the first case start? Random draw from discrete distribution of historical probabilities
+        starting_time = self.drawStartingTimes(n, rng)
+        max_time_or = self.max_time_or
+
+        # starting case
+        rows = np.flatnonzero(in_plan[:, 0])
+        case_length = sampleByServiceLine(service_lines[rows, 0], self.caseLength, rng)[:, 0]
+        sch_start[rows, 0] = starting_time[rows]
+        sch_end[rows, 0] = starting_time[rows] + case_length
+
+        for case_number in range(1, max_cases):
+            rows = np.flatnonzero(in_plan[:, case_number])
+            if len(rows) == 0:
+                break
+            # add turnover time to scheduled end of last case --> this is scheduled start
+            next_case_scheduled_start = sch_end[rows, case_number-1] + self.time_between_cases.sampleRounded(len(rows), rng)
+            # case length plus 5 redraws in case it would end too late in the night
+            case_length = sampleByServiceLine(service_lines[rows, case_number], self.caseLength, rng, columns=6)
+            fits = next_case_scheduled_start[:, None] + case_length < max_time_or
+            placed = fits.any(axis=1)
+            #if none of the draws fit, that room's day ends with the previous case
+            in_plan[rows[~placed], case_number:] = False
+            if _profiling['profiler'] is not None:
+                profileCount("plan case length redraws", (fits[placed].argmax(axis=1)).sum())
+                profileCount("plan days ended by overrun", (~placed).sum())
+            case_length = case_length[placed, fits[placed].argmax(axis=1)]
+            next_case_scheduled_start = next_case_scheduled_start[placed]
+            rows = rows[placed]
+            sch_start[rows, case_number] = np.round(next_case_scheduled_start/5)*5 # round start to nearest 5 minutes
+            sch_end[rows, case_number] = next_case_scheduled_start + case_length
+
+        return {'service_line': service_lines, 'cancelled': cancelled, 'sch_start': sch_start, 'sch_end': sch_end, 'in_plan': in_plan}
+
+    def caseLength(self, service_line):
+        #distrubution of surgery length as originally scheduled for a service line
+        if service_line not in self.case_lengths:
+            X2 = self.scheduled_lengths.get(service_line, np.array([])).reshape(-1, 1)
+            #a service line with no scheduled lengths on record (or a case with no service line) draws from the lengths of every case in the room
+            if np.isnan(X2).all():
+                X2 = self.all_scheduled_lengths.reshape(-1, 1)
+            self.case_lengths[service_line] = KDESampler(X2, .3)
+        return self.case_lengths[service_line]
+
+
+def turnoverTimes(cases, keys):
+    '''
+    Input: simulated (non-cancelled) cases with their case_order_actual, columns that split the cases into separate tables
+    Output: dict of (key values..., service line) -> array of actual minus scheduled turnover times in minutes before a
+    case that directly follows a case of the same service line
+    '''
+    #pair every case with each case of the same service line ranked directly after it in its day and room, in one
+    #merge for all tables - cases tied on case_order_actual each pair with every case of the next rank, as the
+    #original self-merge on case_order_actual + 1 did
+    pair_keys = keys + [key for key in ['CASE_DATE', 'OR_USED', 'Service_Line', 'case_order_actual'] if key not in keys]
+    ranked = cases[cases.case_order_actual.notnull() & cases.Service_Line.notnull()]
+    previous_cases = ranked[pair_keys + ['OUT_ROOM_TIME', 'SCH_END']]
+    next_cases = ranked[pair_keys + ['IN_ROOM_TIME', 'SCH_START']].assign(case_order_actual=ranked.case_order_actual - 1)
+    pairs = previous_cases.merge(next_cases, on=pair_keys)
+
+    time_between_surgeries_actual = (pairs.IN_ROOM_TIME - pairs.OUT_ROOM_TIME).dt.total_seconds()/60
+    time_between_surgeries_scheduled = (pairs.SCH_START - pairs.SCH_END).dt.total_seconds()/60
+    actual_minus_expected = time_between_surgeries_actual - time_between_surgeries_scheduled
+    table_keys = [pairs[key] for key in keys + ['Service_Line']]
+    return {(key if isinstance(key, tuple) else (key,)): times.to_numpy() for key, times in actual_minus_expected.groupby(table_keys, observed=True)}
+
+
+class RoomSimulationModel:
+    '''
+    Distributions simulateSchedule draws from for one OR room on a given month and weekday
+    '''
+    def __init__(self, or_single_simulated, turnover_times=None):
+        #calculate a few columns that are useful to use
+        or_single_simulated['IN_ROOM_TIME'] = pd.to_datetime(or_single_simulated['IN_ROOM_TIME'])
+        or_single_simulated['OUT_ROOM_TIME'] = pd.to_datetime(or_single_simulated['OUT_ROOM_TIME'])
+        or_single_simulated['case_order_actual'] = or_single_simulated.groupby("CASE_DATE")["IN_ROOM_TIME"].rank("dense", ascending=True)
+
+        #actual minus expected turnover times of each service line - handed in by the DistributionIndex, which builds
+        #them for every room at once, or built from this room's cases
+        if turnover_times is None:
+            turnover_times = {key[0]: times for key, times in turnoverTimes(or_single_simulated, []).items()}
+        self.turnover_times = turnover_times
+
+        # distrubution of actual-scheduled case start time of the first case of the day
+        or_single_first_case = or_single_simulated[(or_single_simulated.case_order_actual == 1)]
+        X = or_single_first_case[['actual_minus_scheduled_case_start_time']]
+        X2 = X.to_numpy().reshape(-1, 1)
+        #if no data, make the start time difference distribution
+        if len(or_single_first_case) == 0:
+            X2 = np.array([0,0,-5,5,10,-10]).reshape(-1, 1)
+        self.start_time_difference = KDESampler(X2, .3)
+
+        #actual minus scheduled case lengths of each service line
+        self.length_differences = {service_line: differences.to_numpy() for service_line, differences
+                                   in or_single_simulated.groupby('Service_Line', observed=True)['actual_minus_scheduled_case_duration_minute']}
+
+        #filled in lazily for each service line
+        self.case_length_modifiers = {}
+        self.turnover_samplers = {}
+
+    def caseLengthModifier(self, service_line):
+        #distribution of actual length minus planned length for a service line
+        if service_line not in self.case_length_modifiers:
+            X2 = self.length_differences.get(service_line, np.array([])).reshape(-1, 1)
+            if len(X2) == 0:
+                X2 = np.array([0,0,0,0]).reshape(-1, 1)
+            self.case_length_modifiers[service_line] = KDESampler(X2, .3)
+        return self.case_length_modifiers[service_line]
+
+    def turnoverTime(self, service_line, previous_cancelled):
+        #distribution of actual minus expected turnover time before a case of this service line
+        key = (service_line, previous_cancelled)
+        if key not in self.turnover_samplers:
+            actual_minus_expected_time_between_numpy = self.turnover_times.get(service_line, np.array([]))
+            #check if there are enough cases to build this data, otherwise use a default distribution
+            if len(actual_minus_expected_time_between_numpy) == 0:
+                if previous_cancelled:
+                    actual_minus_expected_time_between_numpy = np.array([10,10,10,10])
+                else:
+                    actual_minus_expected_time_between_numpy = np.array([0,5,10,15,20,25])
+            self.turnover_samplers[key] = KDESampler(actual_minus_expected_time_between_numpy, .3)
+        return self.turnover_samplers[key]
+
+    def simulateBatch(self, service_lines, cancelled, sch_start, sch_end, in_plan, rng, first_case=None):
+        '''
+        Input: (days, cases) arrays of planned days in this room - service line, cancelled flag, scheduled start and end
+        in minutes after midnight, which cases are on each day - a random generator and optionally which cases count
+        as the first case of the day (default only the first column)
+        Output: simulated in room and out room times in minutes after midnight (nan for cancelled cases)
+        '''
+        in_room = np.full(sch_start.shape, np.nan)
+        out_room = np.full(sch_start.shape, np.nan)
+        scheduled_case_length = sch_end - sch_start
+
+        for case_number in range(sch_start.shape[1]):
+            #cancelled cases are never simulated
+            rows = np.flatnonzero(in_plan[:, case_number] & (cancelled[:, case_number] != 1))
+            if len(rows) == 0:
+                continue
+            case_service_lines = service_lines[rows, case_number]
+            case_length = scheduled_case_length[rows, case_number]
+            #actual length minus planned, keeping every case at least 10 minutes long
+            case_length_modifier = sampleByServiceLine(case_service_lines, self.caseLengthModifier, rng, low=10 - case_length, name="case_length_modifier")[:, 0]
+
+            is_first = np.full(len(rows), case_number == 0)
+            if first_case is not None:
+                is_first |= first_case[rows, case_number]
+            case_in_room = np.empty(len(rows))
+
+            #first case of the day - start within 90 minutes of the scheduled start
+            if is_first.any():
+                start_time_difference = self.start_time_difference.sampleWithin(-90, 90, size=is_first.sum(), rng=rng, name="start_time_difference")
+                case_in_room[is_first] = sch_start[rows[is_first], case_number] + start_time_difference
+
+            #second case or later
+            later = ~is_first
+            if later.any():
+                later_rows = rows[later]
+                previous_cancelled = cancelled[later_rows, case_number-1] >= 1
+                actual_time_between_draw = np.empty(len(later_rows))
+                #turnover time is capped at 60 minutes after a cancelled case and 120 otherwise - longer draws become 25 minutes
+                for previous_was_cancelled, max_turnover in ((True, 60), (False, 120)):
+                    group = previous_cancelled == previous_was_cancelled
+                    if group.any():
+                        draws = sampleByServiceLine(case_service_lines[later][group], lambda service_line: self.turnoverTime(service_line, previous_was_cancelled), rng)[:, 0]
+                        actual_time_between_draw[group] = np.where(draws > max_turnover, 25, draws)
+
+                #previous case was cancelled - scheduled start time plus the turnover time modifier
+                #otherwise - previous case out time plus the scheduled gap plus the modifier, set to 30 minutes if under 5
+                simulated_turnover_time = sch_start[later_rows, case_number] - sch_end[later_rows, case_number-1] + actual_time_between_draw
+                simulated_turnover_time = np.where(simulated_turnover_time < 5, 30, simulated_turnover_time)
+                case_in_room[later] = np.where(previous_cancelled, sch_start[later_rows, case_number] + actual_time_between_draw,
+                                               out_room[later_rows, case_number-1] + simulated_turnover_time)
+
+            in_room[rows, case_number] = case_in_room
+            out_room[rows, case_number] = in_room[rows, case_number] + case_length + case_length_modifier
+
+        return in_room, out_room
+
+
+class DistributionIndex:
+    '''
+    Fitted distributions for every (room, month, weekday, cutoff) key, built the first time a key is asked for.
+    Call build() to fit them all up front and save()/load() to keep them on disk between runs.
+    '''
+    def __init__(self, combined_data=None):
+        self.combined_data = getCombinedData() if combined_data is None else combined_data
+        self.plan_models = {}
+        self.simulation_models = {}
+        self.emergent_models = {}
+        #turnover times of every (room, month, weekday) - built for all of them at once the first time one is needed
+        self.turnover_times = None
+        #cases of every key the models are fitted to, split up in one pass the first time one is needed
+        self.partitions = {}
+
+    def simulatedCases(self):
+        #cases used for the simulation distributions - non-cancelled. & binds before ==, so this is
+        #cancelled_flag == (0 & (add-on hours > 6)), i.e. cancelled_flag == 0, and emergency add-ons are kept
+        combined_data = self.combined_data
+        return combined_data[(combined_data.cancelled_flag == 0 & (combined_data.calculated_add_on_hours > 6))]
+
+    def casesFor(self, kind, *key):
+        #cases of one plan (scheduled room, month, weekday), simulation (used room, month, weekday) or emergent (month, weekday) key
+        if kind not in self.partitions:
+            with profileTimer("fit partitions", "ALL"):
+                if kind == 'plan':
+                    self.partitions[kind] = CasePartitions(self.combined_data, ['SCH_OR', 'SCH_START_MONTH', 'WEEKDAY'])
+                elif kind == 'simulation':
+                    self.partitions[kind] = CasePartitions(self.simulatedCases(), ['OR_USED', 'ACTUAL_START_MONTH', 'ACTUAL_WEEKDAY'])
+                else:
+                    combined_data = self.combined_data
+                    self.partitions[kind] = CasePartitions(combined_data[combined_data.SCH_OR.isin(findORRooms(combined_data))], ['SCH_START_MONTH', 'WEEKDAY'])
+        return self.partitions[kind].get(*key)
+
+    def turnoverTimes(self, or_room, selected_month, selected_weekday):
+        #dict of service line -> actual minus expected turnover times for one room, month and weekday
+        if self.turnover_times is None:
+            with profileTimer("fit turnover times", "ALL"):
+                simulated_cases = self.simulatedCases().copy()
+                simulated_cases['IN_ROOM_TIME'] = pd.to_datetime(simulated_cases['IN_ROOM_TIME'])
+                simulated_cases['OUT_ROOM_TIME'] = pd.to_datetime(simulated_cases['OUT_ROOM_TIME'])
+                #the same case order each room's own cases would give it
+                keys = ['OR_USED', 'ACTUAL_START_MONTH', 'ACTUAL_WEEKDAY']
+                simulated_cases['case_order_actual'] = simulated_cases.groupby(keys + ['CASE_DATE'], observed=True)["IN_ROOM_TIME"].rank("dense", ascending=True)
+                self.turnover_times = {}
+                for (room, month, weekday, service_line), times in turnoverTimes(simulated_cases, keys).items():
+                    self.turnover_times.setdefault((room, month, weekday), {})[service_line] = times
+        return self.turnover_times.get((or_room, selected_month, selected_weekday), {})
+
+    def planModel(self, or_room, selected_month, selected_weekday, selected_cutoff_time):
+        #returns None when there is no data for the room
+        key = (or_room, selected_month, selected_weekday, selected_cutoff_time)
+        if key not in self.plan_models:
+            # filter data based on selections
+            or_single = self.casesFor('plan', or_room, selected_month, selected_weekday)
+
+            # filter out cases that were scheduled not before cutoff time the previous day (these are emergency cases mostly) or were cancelled after the cutoff time
+            or_single = or_single[((or_single.ORIG_SCH_DATE < (or_single.CASE_DATE-timedelta(days=selected_cutoff_time))) | pd.isnull(or_single.ORIG_SCH_DATE)) & ((or_single.CANCELLED_DATE > or_single.CASE_DATE-timedelta(days=selected_cutoff_time)) | (or_single.cancelled_flag ==0))]
+            with profileTimer("fit plan model", or_room):
+                self.plan_models[key] = RoomPlanModel(or_single) if len(or_single) > 0 else None
+        return self.plan_models[key]
+
+    def simulationModel(self, or_room, selected_month, selected_weekday):
+        #distributions for simulating a room - these do not depend on the cutoff time
+        key = (or_room, selected_month, selected_weekday)
+        if key not in self.simulation_models:
+            #Filter for the correct room, day, month and non-cancelled
+            or_single_simulated = self.casesFor('simulation', or_room, selected_month, selected_weekday)
+            turnover_times = self.turnoverTimes(or_room, selected_month, selected_weekday)
+            with profileTimer("fit simulation model", or_room):
+                self.simulation_models[key] = RoomSimulationModel(or_single_simulated, turnover_times)
+        return self.simulation_models[key]
+
+    def emergentModel(self, selected_month, selected_weekday, selected_cutoff_time):
+        #emergent and add-on cases of all rooms for the event-driven simulation
+        key = (selected_month, selected_weekday, selected_cutoff_time)
+        if key not in self.emergent_models:
+            day_cases = self.casesFor('emergent', selected_month, selected_weekday)
+            #booked after the cutoff time the day before (the cases planSchedule leaves out) and not cancelled
+            emergent_cases = day_cases[(day_cases.cancelled_flag == 0) & (day_cases.ORIG_SCH_DATE >= day_cases.CASE_DATE-timedelta(days=selected_cutoff_time))]
+            with profileTimer("fit emergent model", "ALL"):
+                self.emergent_models[key] = EmergentArrivalModel(day_cases.CASE_DATE.nunique(), emergent_cases)
+        return self.emergent_models[key]
+
+    def update(self, combined_data, new_cases):
+        '''
+        Input: combined_data with the new cases added, the new cases
+        Output: number of fitted models that were refit - only the keys the new cases fall in, the rest are kept
+        '''
+        self.combined_data = combined_data
+        self.turnover_times = None
+        self.partitions = {}
+        plan_keys = set(zip(new_cases.SCH_OR, new_cases.SCH_START_MONTH, new_cases.WEEKDAY))
+        simulation_keys = set(zip(new_cases.OR_USED, new_cases.ACTUAL_START_MONTH, new_cases.ACTUAL_WEEKDAY))
+        emergent_keys = set(zip(new_cases.SCH_START_MONTH, new_cases.WEEKDAY))
+
+        stale_plan_models = [key for key in self.plan_models if key[:3] in plan_keys]
+        stale_simulation_models = [key for key in self.simulation_models if key in simulation_keys]
+        stale_emergent_models = [key for key in self.emergent_models if key[:2] in emergent_keys]
+        for key in stale_plan_models:
+            del self.plan_models[key]
+            self.planModel(*key)
+        for key in stale_simulation_models:
+            del self.simulation_models[key]
+            self.simulationModel(*key)
+        for key in stale_emergent_models:
+            del self.emergent_models[key]
+            self.emergentModel(*key)
+        return len(stale_plan_models) + len(stale_simulation_models) + len(stale_emergent_models)
+
+    def build(self, months=None, weekdays=None, cutoff_times=(.2916666,)):
+        #fit every room for the given months, weekdays and cutoffs (default all months/weekdays found in the data)
+        combined_data = self.combined_data
+        if months is None:
+            months = combined_data.SCH_START_MONTH.dropna().unique()
+        if weekdays is None:
+            weekdays = combined_data.WEEKDAY.dropna().unique()
+        for selected_month in months:
+            for selected_weekday in weekdays:
+                for selected_cutoff_time in cutoff_times:
+                    for or_room in findORRooms(combined_data):
+                        self.planModel(or_room, selected_month, selected_weekday, selected_cutoff_time)
+                for or_room in findORRooms(combined_data):
+                    self.simulationModel(or_room, selected_month, selected_weekday)
+        return self
+
+    def save(self, path):
+        #the fitted models only - the data they came from is loaded separately
+        with open(path, 'wb') as f:
+            pickle.dump((self.plan_models, self.simulation_models, self.emergent_models), f)
+
+    @classmethod
+    def load(cls, path, combined_data=None):
+        index = cls(combined_data)
+        with open(path, 'rb') as f:
+            index.plan_models, index.simulation_models, index.emergent_models = pickle.load(f)
+        return index
+
+
+def getDistributionIndex():
+    #the index for the data currently in use, created on first use
+    if _loaded['distribution_index'] is None:
+        _loaded['distribution_index'] = DistributionIndex(getCombinedData())
+    return _loaded['distribution_index']
+
+def useDistributionIndex(index):
+    #use a prebuilt (e.g. loaded from disk) index instead of fitting one
+    _loaded['distribution_index'] = index
+    return index
+
+
+'''
+
+Historical schedules. The cases of the simulated rooms are sorted by CASE_DATE once. The real schedules of every
+day are prepared for a cutoff time in one pass and kept in a small LRU cache, so replaying a day is a slice lookup.
+
+'''
+
+############################# Date-indexed historical cases ##############################################################
+#columns selectRealSchedule needs
+real_schedule_columns = ['CASE_DATE', 'ORIG_SCH_DATE', 'CANCELLED_DATE', 'cancelled_flag', 'SCH_START', 'SCH_END', 'SCH_OR', 'Service_Line']
+
+def dateSlice(dates, first_date, last_date):
+    #positions of sorted dates from first_date to last_date (both included)
+    first = np.searchsorted(dates, pd.Timestamp(first_date).to_datetime64(), side='left')
+    last = np.searchsorted(dates, pd.Timestamp(last_date).to_datetime64(), side='right')
+    return slice(first, last)
+
+class RealScheduleIndex:
+    '''
+    Historical cases of the simulated rooms sorted by CASE_DATE, with an LRU cache of the real schedules of every
+    day prepared for the cache_size most recently used cutoff times
+    '''
+    def __init__(self, combined_data, all_or_rooms, cache_size=8):
+        cases = combined_data[combined_data.SCH_OR.isin(all_or_rooms) & combined_data.CASE_DATE.notna()]
+        self.cases = cases[real_schedule_columns].sort_values(by=['CASE_DATE', 'SCH_OR', 'SCH_START'], kind='stable')
+        self.dates = self.cases.CASE_DATE.to_numpy()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @staticmethod
+    def prepare(cases, selected_cutoff_time):
+        '''
+        Input: historical cases of one or more days sorted by day, room and start, cutoff time
+        Output: the real schedule of each day as selectRealSchedule returns it, with a CASE_DATE column
+        '''
+        cutoff = cases.CASE_DATE - timedelta(days=selected_cutoff_time)
+        # filter out cases that were scheduled not before cutoff time the previous day (these are emergency cases mostly) or were cancelled after the cutoff time
+        scheduled_cases = cases[((cases.ORIG_SCH_DATE < cutoff) | pd.isnull(cases.ORIG_SCH_DATE)) & ((cases.CANCELLED_DATE > cutoff) | (cases.cancelled_flag == 0))].copy()
+        #set cancelled to 0 because we don't know any information about cancelled cases at this time
+        scheduled_cases['CANCELLED'] = 0
+        #add in the new case number for order
+        scheduled_cases['CASE_NBR'] = scheduled_cases.groupby(['CASE_DATE', 'SCH_OR'], sort=False, observed=True)["SCH_START"].rank("dense", ascending=True)
+        return scheduled_cases[['CASE_DATE', 'CASE_NBR', 'SCH_START', 'SCH_END', 'SCH_OR', 'Service_Line', 'CANCELLED']]
+
+    def prepared(self, selected_cutoff_time):
+        #real schedules of every day for a cutoff time and their sorted dates, prepared on first use
+        if selected_cutoff_time in self.cache:
+            self.cache.move_to_end(selected_cutoff_time)
+        else:
+            schedules = self.prepare(self.cases, selected_cutoff_time)
+            self.cache[selected_cutoff_time] = (schedules, schedules.CASE_DATE.to_numpy())
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return self.cache[selected_cutoff_time]
+
+    def schedule(self, selected_date, selected_cutoff_time):
+        #real schedule of one day - a copy, so callers can change it without changing the cache
+        schedules, dates = self.prepared(selected_cutoff_time)
+        return schedules.iloc[dateSlice(dates, selected_date, selected_date)].drop(columns='CASE_DATE')
+
+    def schedules(self, first_date, last_date, selected_cutoff_time):
+        #real schedules of every day from first_date to last_date
+        schedules, dates = self.prepared(selected_cutoff_time)
+        return schedules.iloc[dateSlice(dates, first_date, last_date)].copy()
+
+def getRealScheduleIndex():
+    #the date index of the data currently in use, created on first use
+    if _loaded['real_schedule_index'] is None:
+        _loaded['real_schedule_index'] = RealScheduleIndex(getCombinedData(), getAllORRooms())
+    return _loaded['real_schedule_index']
+
+
+'''
+
+Incremental ingestion. New monthly extracts are cleaned on their own and only their new cases are appended to an
+on-disk store partitioned by month and room. Only the fitted distributions of the keys the new cases touch are refit.
+
+'''
+
+################################# Partitioned case store ##############################################################
+STORE_DIR = "orsim_store"
+
+#cases with the same values of these columns are the same case
+case_key_columns = ['CASE_NBR', 'cancelled_flag', 'SCH_START']
+
+class CaseStore:
+    '''
+    Cleaned cases on disk as one Feather file per (month of CASE_DATE, scheduled room), with a manifest.json listing
+    the partitions and a snapshot of all of them in one file for fast loading. The fitted DistributionIndex is kept
+    next to them so later runs only refit what changed.
+    '''
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        self.manifest_file = os.path.join(path, "manifest.json")
+        self.snapshot_file = os.path.join(path, "combined_data.feather")
+        self.index_file = os.path.join(path, "distribution_index.pkl")
+        self.manifest = {'version': CACHE_VERSION, 'partitions': {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get('version') != CACHE_VERSION:
+                warnings.warn("Case store {} was cleaned by an older version of the cleaning steps - rebuild it from the extracts".format(path))
+
+    @staticmethod
+    def partitionKeys(cases):
+        #(month, room) partition of each case
+        month = cases.CASE_DATE.dt.strftime('%Y-%m').fillna("unknown")
+        room = cases.SCH_OR.astype(object).fillna("").astype(str)
+        return month, room
+
+    @staticmethod
+    def partitionFile(month, room):
+        #room names can hold spaces and slashes - keep the file name to safe characters
+        safe_room = "".join(character if character.isalnum() else "_" for character in room) or "_no_room"
+        return os.path.join(month, safe_room + "_" + hashlib.sha256(room.encode()).hexdigest()[:8] + ".feather")
+
+    def readPartition(self, partition_file):
+        return pd.read_feather(os.path.join(self.path, partition_file))
+
+    def ingest(self, scheduled_cases, cancelled_cases):
+        '''
+        Input: raw scheduled and cancelled case extracts with the workbook columns
+        Output: the cleaned cases that were not in the store yet (they are now appended to their partitions)
+        '''
+        cleaned = cleanData(scheduled_cases, cancelled_cases).drop_duplicates(subset=case_key_columns)
+        month, room = self.partitionKeys(cleaned)
+
+        new_cases = []
+        for (partition_month, partition_room), cases in cleaned.groupby([month, room], sort=True):
+            partition_file = self.partitionFile(partition_month, partition_room)
+            if partition_file in self.manifest['partitions']:
+                stored = self.readPartition(partition_file)
+                #keep only the cases this partition does not have yet
+                cases = cases[~pd.MultiIndex.from_frame(cases[case_key_columns]).isin(pd.MultiIndex.from_frame(stored[case_key_columns]))]
+                if len(cases) == 0:
+                    continue
+                partition = pd.concat([stored, cases], ignore_index=True)
+            else:
+                partition = cases.reset_index(drop=True)
+            os.makedirs(os.path.join(self.path, partition_month), exist_ok=True)
+            partition.to_feather(os.path.join(self.path, partition_file))
+            self.manifest['partitions'][partition_file] = {'month': partition_month, 'room': partition_room, 'rows': len(partition)}
+            new_cases.append(cases)
+
+        new_cases = pd.concat(new_cases, ignore_index=True) if new_cases else cleaned.iloc[:0]
+
+        #the snapshot only needs the new cases added to it
+        if len(new_cases) > 0 or not os.path.exists(self.snapshot_file):
+            if os.path.exists(self.snapshot_file):
+                snapshot = pd.concat([pd.read_feather(self.snapshot_file), new_cases], ignore_index=True)
+            else:
+                snapshot = self.loadPartitions()
+            snapshot.to_feather(self.snapshot_file)
+
+        self.manifest['version'] = CACHE_VERSION
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.manifest_file, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        return new_cases
+
+    def ingestFiles(self, scheduled_file, cancelled_file):
+        #same as ingest, reading the extracts from workbooks
+        return self.ingest(pd.read_excel(scheduled_file, engine='openpyxl'), pd.read_excel(cancelled_file, engine='openpyxl'))
+
+    def loadPartitions(self):
+        #every stored case, read partition by partition
+        partitions = [self.readPartition(partition_file) for partition_file in sorted(self.manifest['partitions'])]
+        if not partitions:
+            raise FileNotFoundError("Case store {} is empty - ingest some extracts first".format(self.path))
+        return pd.concat(partitions, ignore_index=True)
+
+    def load(self):
+        #every stored case as one combined_data DataFrame
+        if os.path.exists(self.snapshot_file):
+            return pd.read_feather(self.snapshot_file)
+        return self.loadPartitions()
+
+    def loadIndex(self, combined_data):
+        #the fitted distributions saved with the store, or a new empty index
+        if os.path.exists(self.index_file):
+            return DistributionIndex.load(self.index_file, combined_data)
+        return DistributionIndex(combined_data)
+
+def ingestExtracts(scheduled_cases, cancelled_cases, store_dir=STORE_DIR):
+    '''
+    Input: raw scheduled and cancelled case extracts (DataFrames or workbook paths), folder of the case store
+    Output: the new cases that were added; the store's data and refit distributions are used from now on
+    '''
+    store = CaseStore(store_dir)
+    if isinstance(scheduled_cases, str):
+        new_cases = store.ingestFiles(scheduled_cases, cancelled_cases)
+    else:
+        new_cases = store.ingest(scheduled_cases, cancelled_cases)
+
+    combined_data = useData(store.load())
+    distribution_index = store.loadIndex(combined_data)
+    #only the keys the new cases fall in are refit
+    if distribution_index.update(combined_data, new_cases) > 0 or not os.path.exists(store.index_file):
+        distribution_index.save(store.index_file)
+    useDistributionIndex(distribution_index)
+    return new_cases
+
+def useStore(store_dir=STORE_DIR):
+    '''
+    Input: folder of a case store built by ingestExtracts
+    Output: the stored cases as combined_data, which is used by the rest of the module from now on (with the
+    distributions already fitted for them)
+    '''
+    store = CaseStore(store_dir)
+    combined_data = useData(store.load())
+    useDistributionIndex(store.loadIndex(combined_data))
+    return combined_data
+
+
+'''
+
+Discrete-event simulation of the day of surgery. Every room of every simulated day shares one priority-queue event
+calendar (case start, case end, turnover end and emergent arrival), so emergent and add-on cases that arrive during
+the day compete with the planned cases for rooms and a bumping policy decides which case gets a room that frees up.
+
+'''
+
+############################# Emergent arrivals ########################################################################
+#order waiting emergent cases are served in - stat/emergent, urgent, priority, then elective add-ons
+priority_rank = {1: 0, 2: 1, 3: 2, 0: 3}
+
+class EmergentArrivalModel:
+    '''
+    Cases booked after the cutoff time (the cases planSchedule leaves out) for one month and weekday across all rooms.
+    A simulated day resamples the number of such cases from history and, for each case, its arrival time,
+    new_emergency_classification, service line and length.
+    '''
+    def __init__(self, days, emergent_cases):
+        #cases on each historical day, with the days that had none as zeros
+        counts = emergent_cases.groupby('CASE_DATE').size().to_numpy()
+        self.cases_per_day = np.concatenate([counts, np.zeros(max(days - len(counts), 0), dtype=int)]) if days > 0 else np.zeros(1, dtype=int)
+
+        #arrival is when the case was booked, in minutes after midnight of the day of surgery (booked the evening before -> midnight)
+        arrival = (emergent_cases.ORIG_SCH_DATE - emergent_cases.CASE_DATE).dt.total_seconds()/60
+        self.arrival = np.clip(arrival.to_numpy(dtype=float), 0, 24*60 - 1)
+        self.priority = emergent_cases.new_emergency_classification.fillna(0).to_numpy().astype(int)
+        self.service_line = emergent_cases.Service_Line.to_numpy()
+        length = emergent_cases.actual_case_duration_minute.fillna(emergent_cases.scheduled_case_duration_minute)
+        self.length = np.maximum(np.nan_to_num(length.to_numpy(dtype=float), nan=10), 10)
+
+    def sampleBatch(self, n, rng):
+        '''
+        Input: number of days, random generator
+        Output: dict of arrays with one entry per emergent case of the n days - replication, arrival (minutes after
+        midnight), priority, service_line and length (minutes) - in order of arrival within each day
+        '''
+        counts = rng.choice(self.cases_per_day, size=n) if len(self.arrival) > 0 else np.zeros(n, dtype=int)
+        replication = np.repeat(np.arange(n), counts)
+        drawn = rng.integers(0, max(len(self.arrival), 1), size=len(replication))
+        order = np.lexsort((self.arrival[drawn], replication)) if len(drawn) > 0 else drawn
+        drawn = drawn[order]
+        return {'replication': replication[order], 'arrival': self.arrival[drawn], 'priority': self.priority[drawn],
+                'service_line': self.service_line[drawn], 'length': self.length[drawn]}
+
+
+############################# Bumping policies ########################################################################
+class BumpingPolicy:
+    '''
+    Decides whether a room that has just become free takes the most urgent waiting emergent case ahead of its next
+    planned case. This base policy always does - the planned case is bumped back. Subclass and override takeEmergent
+    for other strategies.
+    '''
+    #rooms kept open for emergent cases even on days they have no planned cases
+    rooms = ()
+
+    def takeEmergent(self, room, priority, waited, electives_left):
+        '''
+        Input: room name, new_emergency_classification of the waiting case, minutes it has waited, number of planned
+        cases the room still has to do
+        Output: True to start the emergent case in this room now
+        '''
+        return True
+
+class NoBumpingPolicy(BumpingPolicy):
+    #emergent cases only get rooms that have finished their planned cases
+    def takeEmergent(self, room, priority, waited, electives_left):
+        return electives_left == 0
+
+class DedicatedRoomPolicy(BumpingPolicy):
+    '''
+    Emergent cases go to dedicated rooms. Other rooms only bump planned cases for the given classifications
+    (default stat/emergent) and take any emergent case once their planned cases are done.
+    '''
+    def __init__(self, rooms, bump_priorities=(1,)):
+        self.rooms = tuple(rooms)
+        self.bump_priorities = tuple(bump_priorities)
+
+    def takeEmergent(self, room, priority, waited, electives_left):
+        return room in self.rooms or priority in self.bump_priorities or electives_left == 0
+
+class MaxWaitPolicy(BumpingPolicy):
+    '''
+    Planned cases are bumped only once an emergent case has waited the maximum wait of its classification, in minutes
+    (default the classify thresholds - stat at once, urgent after 6 hours, priority and add-ons after 24 hours)
+    '''
+    def __init__(self, max_wait=None):
+        self.max_wait = {1: 0, 2: 6*60, 3: 24*60, 0: 24*60} if max_wait is None else dict(max_wait)
+
+    def takeEmergent(self, room, priority, waited, electives_left):
+        return electives_left == 0 or waited >= self.max_wait.get(priority, 0)
+
+
+############################# Event-driven simulation engine ########################################################################
+#turnover time in minutes after a case when the room's next planned case does not directly follow it
+TURNOVER_MINUTES = 30
+
+class EventSimulation:
+    '''
+    Event calendar for a CompactSchedule of planned days plus emergent arrivals. The planned cases keep the drawn
+    lengths and turnovers of simulateCompact, but a room only does one case at a time and emergent cases can take
+    a room ahead of its planned cases.
+    '''
+    CASE_START, CASE_END, TURNOVER_END, EMERGENT_ARRIVAL = range(4)
+
+    def __init__(self, schedule, emergent=None, policy=None):
+        '''
+        Input: CompactSchedule already simulated by simulateCompact (the draws of every planned case), dict of
+        emergent arrivals from EmergentArrivalModel.sampleBatch (or None), BumpingPolicy (default bump the next case)
+        '''
+        self.schedule = schedule
+        self.policy = BumpingPolicy() if policy is None else policy
+        if emergent is None:
+            emergent = {'replication': np.zeros(0, dtype=int), 'arrival': np.zeros(0), 'priority': np.zeros(0, dtype=int),
+                        'service_line': np.zeros(0, dtype=object), 'length': np.zeros(0)}
+        self.emergent = emergent
+        self.room_names = list(schedule.rooms) + [room for room in self.policy.rooms if room not in schedule.rooms]
+
+    def plannedCases(self):
+        '''
+        Output: dict of (replication, room) -> list of the room's planned, not cancelled cases in order as
+        (position, fixed start, start time or turnover, length)
+        '''
+        cases = self.schedule.cases
+        in_room = cases['in_room'].astype(float)
+        out_room = cases['out_room'].astype(float)
+        order = np.lexsort((cases['case_nbr'], cases['room'], cases['replication']))
+        planned = {}
+        previous_key = None
+        for position, replication, room, case_nbr, cancelled in zip(order.tolist(), cases['replication'][order].tolist(), cases['room'][order].tolist(),
+                                                                     cases['case_nbr'][order].tolist(), cases['cancelled'][order].tolist()):
+            key = (replication, room)
+            room_cases = planned.setdefault(key, [])
+            if key != previous_key:
+                previous_key = key
+                first, previous_cancelled, previous_out = True, False, None
+            if cancelled != 1:
+                #the first case and the case after a cancelled case start at their own drawn time, the rest a drawn turnover after the case before
+                if first or case_nbr == 1 or previous_cancelled:
+                    room_cases.append((position, True, in_room[position], out_room[position] - in_room[position]))
+                else:
+                    room_cases.append((position, False, in_room[position] - previous_out, out_room[position] - in_room[position]))
+                previous_out = out_room[position]
+            first, previous_cancelled = False, cancelled == 1
+        return planned
+
+    def run(self):
+        '''
+        Output: DataFrame of every planned and emergent case of every day with the usual simulated columns plus
+        EMERGENT, PRIORITY, ARRIVAL_TIME and BUMPED (planned case that had its room taken by an emergent case)
+        '''
+        schedule = self.schedule
+        policy = self.policy
+        emergent = self.emergent
+        planned = self.plannedCases()
+        replications = int(max(schedule.cases['replication'].max(initial=-1), emergent['replication'].max(initial=-1))) + 1
+
+        #state of every open room of every day
+        keys = sorted(set(planned) | {(replication, self.room_names.index(room)) for replication in range(replications) for room in policy.rooms})
+        room_cases = [planned.get(key, []) for key in keys]
+        next_case = [0]*len(keys)
+        version = [0]*len(keys)
+        free = [False]*len(keys)
+        room_name = [self.room_names[room] for replication, room in keys]
+        rooms_by_replication = [[] for replication in range(replications)]
+        for k, (replication, room) in enumerate(keys):
+            rooms_by_replication[replication].append(k)
+
+        in_room = np.full(len(schedule.cases), np.nan)
+        out_room = np.full(len(schedule.cases), np.nan)
+        bumped = np.zeros(len(schedule.cases), dtype=int)
+        emergent_priority = emergent['priority'].tolist()
+        emergent_arrival = emergent['arrival'].tolist()
+        emergent_length = emergent['length'].tolist()
+        emergent_in = np.full(len(emergent_arrival), np.nan)
+        emergent_out = np.full(len(emergent_arrival), np.nan)
+        emergent_room = np.full(len(emergent_arrival), -1)
+        waiting = [[] for replication in range(replications)]
+
+        #event calendar - days run one after another, events of a day in time order
+        calendar = []
+        sequence = 0
+        def schedule_event(replication, time, kind, k, case):
+            nonlocal sequence
+            sequence += 1
+            heapq.heappush(calendar, (replication, time, sequence, kind, k, case))
+
+        def dispatch(k, replication, time):
+            #room k is free - start the most urgent waiting emergent case if the policy allows, otherwise its next planned case
+            electives_left = len(room_cases[k]) - next_case[k]
+            if waiting[replication]:
+                rank, arrival, e = waiting[replication][0]
+                if policy.takeEmergent(room_name[k], emergent_priority[e], time - arrival, electives_left):
+                    heapq.heappop(waiting[replication])
+                    version[k] += 1
+                    free[k] = False
+                    emergent_in[e] = time
+                    emergent_room[e] = keys[k][1]
+                    if electives_left:
+                        bumped[room_cases[k][next_case[k]][0]] = 1
+                    schedule_event(replication, time + emergent_length[e], self.CASE_END, k, -e - 1)
+                    return
+            if electives_left:
+                position, fixed_start, start, length = room_cases[k][next_case[k]]
+                version[k] += 1
+                schedule_event(replication, max(start, time) if fixed_start else time, self.CASE_START, k, version[k])
+
+        for k, (replication, room) in enumerate(keys):
+            free[k] = True
+            dispatch(k, replication, -np.inf)
+        #rooms open with the first planned case of the day - emergent cases booked before that arrive then
+        opening_time = np.full(replications, np.inf)
+        for k, (replication, room) in enumerate(keys):
+            if room_cases[k]:
+                opening_time[replication] = min(opening_time[replication], room_cases[k][0][2])
+        opening_time[np.isinf(opening_time)] = 0
+        for e, (replication, arrival) in enumerate(zip(emergent['replication'].tolist(), emergent_arrival)):
+            schedule_event(replication, max(arrival, opening_time[replication]), self.EMERGENT_ARRIVAL, -1, e)
+
+        while calendar:
+            replication, time, _, kind, k, case = heapq.heappop(calendar)
+            if kind == self.CASE_START:
+                #a start that was replaced by a later decision for this room is skipped
+                if case != version[k]:
+                    continue
+                position, fixed_start, start, length = room_cases[k][next_case[k]]
+                next_case[k] += 1
+                free[k] = False
+                in_room[position] = time
+                schedule_event(replication, time + length, self.CASE_END, k, position)
+            elif kind == self.CASE_END:
+                if case >= 0:
+                    out_room[case] = time
+                else:
+                    emergent_out[-case - 1] = time
+                #the next planned case's own turnover if it directly follows, otherwise the standard turnover
+                turnover = TURNOVER_MINUTES
+                if next_case[k] < len(room_cases[k]) and not room_cases[k][next_case[k]][1]:
+                    turnover = room_cases[k][next_case[k]][2]
+                schedule_event(replication, time + turnover, self.TURNOVER_END, k, None)
+            elif kind == self.TURNOVER_END:
+                free[k] = True
+                dispatch(k, replication, time)
+            else:
+                heapq.heappush(waiting[replication], (priority_rank.get(emergent_priority[case], len(priority_rank)), emergent_arrival[case], case))
+                for free_room in rooms_by_replication[replication]:
+                    if not waiting[replication]:
+                        break
+                    if free[free_room]:
+                        dispatch(free_room, replication, time)
+
+        return self.toFrame(in_room, out_room, bumped, emergent_in, emergent_out, emergent_room)
+
+    def toFrame(self, in_room, out_room, bumped, emergent_in, emergent_out, emergent_room):
+        #planned cases in the usual layout followed by the emergent cases of each day - on a copy, so the planned
+        #schedule passed in keeps its own times
+        schedule = CompactSchedule(self.schedule.day_start, self.schedule.rooms, self.schedule.service_lines, self.schedule.cases.copy())
+        emergent = self.emergent
+        cases = schedule.cases
+        cases['in_room'] = np.where(np.isnan(in_room), MISSING_TIME, np.round(np.nan_to_num(in_room))).astype(np.int64)
+        cases['out_room'] = np.where(np.isnan(out_room), MISSING_TIME, np.round(np.nan_to_num(out_room))).astype(np.int64)
+        planned_frame = schedule.toFrame(replications=True)
+        planned_frame['EMERGENT'] = 0
+        planned_frame['PRIORITY'] = 0
+        planned_frame['ARRIVAL_TIME'] = pd.NaT
+        planned_frame['BUMPED'] = bumped
+
+        def toTimes(minutes):
+            return schedule.toTimes(np.where(np.isnan(minutes), MISSING_TIME, np.round(np.nan_to_num(minutes))).astype(np.int64))
+        arrival = toTimes(emergent['arrival'])
+        emergent_frame = pd.DataFrame(data={'REPLICATION': emergent['replication'], 'CASE_NBR': 0, 'SCH_START': arrival,
+                                            'SCH_END': toTimes(emergent['arrival'] + emergent['length']), 'SCH_OR': "",
+                                            'Service_Line': emergent['service_line'], 'CANCELLED': 0,
+                                            'IN_ROOM_TIME': toTimes(emergent_in), 'OUT_ROOM_TIME': toTimes(emergent_out),
+                                            'OR_USED': np.array(self.room_names + [""], dtype=object)[emergent_room],
+                                            'EMERGENT': 1, 'PRIORITY': emergent['priority'], 'ARRIVAL_TIME': arrival, 'BUMPED': 0})
+        frame = pd.concat([planned_frame, emergent_frame], ignore_index=True) if len(emergent_frame) > 0 else planned_frame
+        return frame.sort_values(by=['REPLICATION', 'EMERGENT', 'SCH_OR', 'CASE_NBR', 'ARRIVAL_TIME'], ignore_index=True)
+
+
+'''
+
+Online KPIs. Summary statistics of simulated days are updated chunk by chunk while the simulation runs, so a large
+experiment only keeps running means, variances and quantile histograms - never the simulated cases.
+
+'''
+
+############################# Streaming accumulators ########################################################################
+class RunningStats:
+    '''
+    Count, mean and variance of a stream of values (Welford), updated a batch at a time
+    '''
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) > 0:
+            batch = RunningStats()
+            batch.n = len(values)
+            batch.mean = values.mean()
+            batch.m2 = ((values - batch.mean)**2).sum()
+            self.merge(batch)
+        return self
+
+    def merge(self, other):
+        #combine two streams (Chan et al.) - the same result as one stream of all the values
+        n = self.n + other.n
+        if n > 0:
+            delta = other.mean - self.mean
+            self.mean += delta*other.n/n
+            self.m2 += other.m2 + delta**2*self.n*other.n/n
+            self.n = n
+        return self
+
+    @property
+    def variance(self):
+        return self.m2/(self.n - 1) if self.n > 1 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def confidenceInterval(self, level=.95):
+        #normal confidence interval of the mean
+        half_width = NormalDist().inv_cdf(.5 + level/2)*self.std/np.sqrt(self.n) if self.n > 1 else np.nan
+        return self.mean - half_width, self.mean + half_width
+
+class BinnedQuantiles:
+    '''
+    Quantiles of a stream of values from a fixed-bin histogram between low and high - exact to within one bin width.
+    Values outside the range are counted in the first or last bin.
+    '''
+    __slots__ = ('low', 'high', 'counts')
+
+    def __init__(self, low=0, high=720, bins=720):
+        self.low = low
+        self.high = high
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        bins = len(self.counts)
+        index = np.clip(((values - self.low)/(self.high - self.low)*bins).astype(np.int64), 0, bins - 1)
+        self.counts += np.bincount(index, minlength=bins)
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def quantile(self, q):
+        #linear interpolation inside the bin that holds the q-th value
+        q = np.asarray(q, dtype=float)
+        total = self.counts.sum()
+        if total == 0:
+            return np.full(q.shape, np.nan)
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        edges = np.linspace(self.low, self.high, len(self.counts) + 1)
+        return np.interp(q*total, cumulative, edges)
+
+############################# Day KPIs ########################################################################
+def roomDays(schedule, closing_times):
+    '''
+    Input: simulated CompactSchedule with at least one case, closing time of each of its rooms in minutes after
+    day_start (nan uses the latest scheduled end of the room that day)
+    Output: dict with the room-day (group) of each case, the room and day of each group, which cases happened with
+    their in and out room times, and per group the busy minutes, open minutes (first scheduled start to closing
+    time, at least 1), overtime past the closing time and idle minutes while open
+    '''
+    cases = schedule.cases
+    replications, replication = np.unique(cases['replication'], return_inverse=True)
+    group_keys, group = np.unique(replication*len(schedule.rooms) + cases['room'], return_inverse=True)
+    groups = len(group_keys)
+
+    happened = cases['in_room'] != MISSING_TIME
+    in_room = cases['in_room'][happened].astype(float)
+    out_room = cases['out_room'][happened].astype(float)
+    happened_group = group[happened]
+
+    #the room is open from its first scheduled start until its closing time
+    opening = np.full(groups, np.inf)
+    np.minimum.at(opening, group, cases['sch_start'].astype(float))
+    latest_end = np.full(groups, -np.inf)
+    np.maximum.at(latest_end, group, cases['sch_end'].astype(float))
+    closing = np.asarray(closing_times, dtype=float)[group_keys % len(schedule.rooms)]
+    closing = np.where(np.isnan(closing), latest_end, closing)
+
+    busy = np.bincount(happened_group, weights=out_room - in_room, minlength=groups)
+    last_out = np.full(groups, -np.inf)
+    np.maximum.at(last_out, happened_group, out_room)
+    overtime = np.where(np.isfinite(last_out), np.maximum(last_out - closing, 0), 0)
+    available = np.maximum(closing - opening, 1)
+    #busy minutes past the closing time are not open time that was used
+    idle = np.maximum(available - (busy - overtime), 0)
+    return {'group': group, 'room': group_keys % len(schedule.rooms), 'day': group_keys // len(schedule.rooms), 'days': len(replications),
+            'happened': happened, 'in_room': in_room, 'out_room': out_room,
+            'busy': busy, 'available': available, 'overtime': overtime, 'idle': idle}
+
+class KPIAccumulator:
+    '''
+    Online KPIs of simulated days. Per room and day: utilization of the room until its closing time, overtime past
+    the closing time, first case on time, total turnover minutes, cases and cancellations - the ALL room holds the
+    same KPIs over every room of the day. Cases and cancellations are also counted by service line.
+    '''
+    room_kpis = ['utilization', 'overtime_minutes', 'first_case_on_time', 'turnover_minutes', 'cases', 'cancelled']
+
+    def __init__(self, on_time_minutes=5, overtime_bins=(0, 720, 720), day_overtime_bins=(0, 7200, 1440)):
+        #a first case is on time when it is in the room at most on_time_minutes after its scheduled start
+        #overtime quantiles use (low, high, bins) histograms - one room, or the total of every room of the day
+        self.on_time_minutes = on_time_minutes
+        self.overtime_bins = overtime_bins
+        self.day_overtime_bins = day_overtime_bins
+        self.stats = {}
+        self.overtime_quantiles = {}
+        self.service_line_cases = {}
+        self.service_line_cancelled = {}
+        self.days = 0
+
+    def roomStats(self, room):
+        if room not in self.stats:
+            self.stats[room] = {kpi: RunningStats() for kpi in self.room_kpis}
+            self.overtime_quantiles[room] = BinnedQuantiles(*(self.day_overtime_bins if room == "ALL" else self.overtime_bins))
+        return self.stats[room]
+
+    def update(self, schedule, closing_times):
+        '''
+        Input: simulated CompactSchedule, closing time of each room of the schedule in minutes after day_start
+        (nan uses the latest scheduled end of the room that day)
+        Output: this accumulator, with every (replication, room) of the schedule added as one room-day
+        '''
+        cases = schedule.cases
+        if len(cases) == 0:
+            return self
+        room_days = roomDays(schedule, closing_times)
+        group, group_room, group_day, groups = room_days['group'], room_days['room'], room_days['day'], len(room_days['room'])
+        happened, in_room, out_room = room_days['happened'], room_days['in_room'], room_days['out_room']
+        happened_group = group[happened]
+        sch_start = cases['sch_start'].astype(float)
+        busy, available, overtime = room_days['busy'], room_days['available'], room_days['overtime']
+
+        #cases of each room-day in the order they went into the room
+        order = np.lexsort((in_room, happened_group))
+        ordered_group = happened_group[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = ordered_group[1:] != ordered_group[:-1]
+        on_time = np.full(groups, np.nan)
+        on_time[ordered_group[first]] = in_room[order][first] - sch_start[happened][order][first] <= self.on_time_minutes
+        gaps = np.maximum(in_room[order][1:] - out_room[order][:-1], 0)
+        turnover = np.bincount(ordered_group[1:][~first[1:]], weights=gaps[~first[1:]], minlength=groups)
+
+        planned = np.bincount(group, minlength=groups)
+        cancelled = np.bincount(group, weights=cases['cancelled'] >= 1, minlength=groups)
+
+        room_day = {'utilization': busy/available, 'overtime_minutes': overtime, 'first_case_on_time': on_time,
+                    'turnover_minutes': turnover, 'cases': planned, 'cancelled': cancelled}
+        for room in np.unique(group_room):
+            in_this_room = group_room == room
+            stats = self.roomStats(schedule.rooms[room])
+            for kpi in self.room_kpis:
+                stats[kpi].update(room_day[kpi][in_this_room])
+            self.overtime_quantiles[schedule.rooms[room]].update(overtime[in_this_room])
+
+        #the whole day - utilization over every room's open time and the share of first cases on time
+        days = room_days['days']
+        day_sum = lambda values: np.bincount(group_day, weights=values, minlength=days)
+        with np.errstate(invalid='ignore'):
+            day = {'utilization': day_sum(busy)/day_sum(available), 'overtime_minutes': day_sum(overtime),
+                   'first_case_on_time': day_sum(np.nan_to_num(on_time))/day_sum(~np.isnan(on_time)),
+                   'turnover_minutes': day_sum(turnover), 'cases': day_sum(planned), 'cancelled': day_sum(cancelled)}
+        stats = self.roomStats("ALL")
+        for kpi in self.room_kpis:
+            stats[kpi].update(day[kpi])
+        self.overtime_quantiles["ALL"].update(day['overtime_minutes'])
+
+        #cancellations by service line
+        service_lines = np.array(schedule.service_lines + [np.nan], dtype=object)
+        service_line_codes = cases['service_line'].astype(np.int64) % (len(schedule.service_lines) + 1)
+        case_counts = np.bincount(service_line_codes, minlength=len(service_lines))
+        cancelled_counts = np.bincount(service_line_codes, weights=cases['cancelled'] >= 1, minlength=len(service_lines))
+        for service_line, case_count, cancelled_count in zip(service_lines, case_counts, cancelled_counts):
+            if case_count > 0:
+                service_line = "Unknown" if pd.isnull(service_line) else service_line
+                self.service_line_cases[service_line] = self.service_line_cases.get(service_line, 0) + int(case_count)
+                self.service_line_cancelled[service_line] = self.service_line_cancelled.get(service_line, 0) + int(cancelled_count)
+
+        self.days += days
+        return self
+
+    def merge(self, other):
+        #add the days of another accumulator, e.g. from another process
+        for room, other_stats in other.stats.items():
+            stats = self.roomStats(room)
+            for kpi in self.room_kpis:
+                stats[kpi].merge(other_stats[kpi])
+            self.overtime_quantiles[room].merge(other.overtime_quantiles[room])
+        for service_line, case_count in other.service_line_cases.items():
+            self.service_line_cases[service_line] = self.service_line_cases.get(service_line, 0) + case_count
+            self.service_line_cancelled[service_line] = self.service_line_cancelled.get(service_line, 0) + other.service_line_cancelled[service_line]
+        self.days += other.days
+        return self
+
+    def summary(self, level=.95):
+        '''
+        Input: confidence level
+        Output: DataFrame with one row per room and KPI (room ALL is the whole day) - number of room-days, mean,
+        standard deviation and confidence interval of the mean
+        '''
+        rows = []
+        for room in sorted(self.stats, key=lambda room: (room != "ALL", room)):
+            for kpi in self.room_kpis:
+                stats = self.stats[room][kpi]
+                ci_low, ci_high = stats.confidenceInterval(level)
+                rows.append({'ROOM': room, 'KPI': kpi, 'N': stats.n, 'MEAN': stats.mean, 'STD': stats.std, 'CI_LOW': ci_low, 'CI_HIGH': ci_high})
+        return pd.DataFrame(rows, columns=['ROOM', 'KPI', 'N', 'MEAN', 'STD', 'CI_LOW', 'CI_HIGH'])
+
+    def overtimeQuantiles(self, quantiles=(.5, .9, .95)):
+        #quantiles of overtime minutes per room-day (room ALL is the total overtime of the day)
+        return pd.DataFrame({room: self.overtime_quantiles[room].quantile(quantiles) for room in self.stats}, index=list(quantiles)).T
+
+    def cancellations(self):
+        #cases and cancellations by service line
+        cancellations = pd.DataFrame({'CASES': pd.Series(self.service_line_cases), 'CANCELLED': pd.Series(self.service_line_cancelled)})
+        cancellations['CANCELLED_SHARE'] = cancellations.CANCELLED/cancellations.CASES
+        return cancellations.sort_index()
+
+
+'''
+
+Schedule optimization. Searches over the room and order of a day's cases with simulated annealing, scoring each
+candidate schedule by its expected overtime and idle time over many simulated days. Every candidate is simulated
+with the same random streams (common random numbers) and in stages, so a candidate that is clearly worse than the
+current schedule is dropped after its first stage.
+
+'''
+
+############################# Schedule optimization ########################################################################
+class ScheduleOptimizer:
+    '''
+    Simulated annealing over the rooms and order of a day's planned cases. Each room keeps its first scheduled
+    start and its cases are packed one after the other with gap_minutes between them.
+    '''
+    def __init__(self, simulation, planned_schedule, rooms=None, overtime_weight=1.0, idle_weight=.25, n=200, stage_size=50,
+                 gap_minutes=None, seed=None):
+        '''
+        Input: HersheyORSim whose fitted distributions simulate the candidates, planned schedule of one day (e.g. from
+        selectRealSchedule or planSchedule), rooms the cases may use (default the rooms they are in - cases of rooms
+        left out keep their planned room and times), cost per minute
+        of overtime and of idle time, simulated days per candidate, simulated days per stage, gap between cases
+        (default the median scheduled gap of the day), seed of the common random numbers
+        '''
+        self.simulation = simulation
+        planned_schedule = planned_schedule[planned_schedule.SCH_OR.isin(getAllORRooms())].sort_values(by=['SCH_OR', 'SCH_START'])
+        self.day_start = pd.Timestamp(planned_schedule.SCH_START.min()).floor("D")
+        #cases in rooms outside the given rooms stay where they are - those rooms come after the movable ones
+        planned_rooms = sorted(planned_schedule.SCH_OR.unique())
+        movable_rooms = planned_rooms if rooms is None else list(rooms)
+        self.movable = len(movable_rooms)
+        self.rooms = movable_rooms + [room for room in planned_rooms if room not in movable_rooms]
+        self.overtime_weight = overtime_weight
+        self.idle_weight = idle_weight
+        #exactly n simulated days - the last stage is shorter when stage_size does not divide n
+        self.stage_sizes = [stage_size]*(n // stage_size) + ([n % stage_size] if n % stage_size else [])
+        self.stages = len(self.stage_sizes)
+
+        #one row per case - service line, planned length and cancelled flag stay with the case wherever it goes
+        self.case_service_lines = pd.Categorical(planned_schedule.Service_Line)
+        self.case_lengths = ((planned_schedule.SCH_END - planned_schedule.SCH_START)/pd.Timedelta(minutes=1)).to_numpy()
+        self.case_cancelled = planned_schedule.CANCELLED.to_numpy()
+        minutes = ((planned_schedule.SCH_START - self.day_start)/pd.Timedelta(minutes=1)).to_numpy()
+        self.case_starts = minutes
+        first_starts = pd.Series(minutes).groupby(planned_schedule.SCH_OR.to_numpy()).min()
+        self.opening = np.array([first_starts.get(room, first_starts.min()) for room in self.rooms])
+        if gap_minutes is None:
+            gaps = minutes[1:] - (minutes + self.case_lengths)[:-1]
+            same_room = planned_schedule.SCH_OR.to_numpy()[1:] == planned_schedule.SCH_OR.to_numpy()[:-1]
+            gap_minutes = float(np.median(np.maximum(gaps[same_room], 0))) if same_room.any() else TURNOVER_MINUTES
+        self.gap_minutes = gap_minutes
+
+        #the starting candidate is the planned schedule itself, with every case of the day
+        room_of_case = planned_schedule.SCH_OR.to_numpy()
+        self.initial = [list(np.flatnonzero(room_of_case == room)) for room in self.rooms]
+        self.evaluations = 0
+
+        #closing time of every room a case can move to, coded like the compact schedules
+        all_or_rooms = getAllORRooms()
+        #common random numbers - a stream per stage and room code, so a move only changes the draws of the rooms it touches
+        self.stage_seeds = [stage_seed.spawn(len(all_or_rooms)) for stage_seed in spawnSeeds(seed, self.stages)]
+        self.room_codes = [all_or_rooms.index(room) for room in self.rooms]
+        self.closing_times = np.full(len(all_or_rooms), np.nan)
+        distribution_index = getDistributionIndex()
+        for room, or_room in zip(self.room_codes, self.rooms):
+            plan_model = distribution_index.planModel(or_room, simulation.selected_month, simulation.selected_weekday, simulation.selected_cutoff_time)
+            if plan_model is not None:
+                self.closing_times[room] = plan_model.max_time_or
+
+    def compact(self, candidate, replications):
+        #CompactSchedule of a candidate repeated for a number of replications - rooms coded by the day's room list
+        case_ids = np.concatenate([np.asarray(room_cases, dtype=int) for room_cases in candidate])
+        size = len(case_ids)
+        schedule = CompactSchedule.empty(self.day_start, getAllORRooms(), list(self.case_service_lines.categories), size*replications)
+        cases = schedule.cases
+        sch_start = np.empty(size)
+        room = np.empty(size, dtype=np.int16)
+        case_nbr = np.empty(size, dtype=np.int32)
+        position = 0
+        for room_index, room_cases in enumerate(candidate):
+            if len(room_cases) == 0:
+                continue
+            if room_index >= self.movable:
+                starts = self.case_starts[room_cases]
+            else:
+                #cases packed one after the other from the room's first start
+                lengths = self.case_lengths[room_cases]
+                starts = self.opening[room_index] + np.concatenate([[0], np.cumsum(lengths + self.gap_minutes)[:-1]])
+            sch_start[position:position + len(room_cases)] = starts
+            room[position:position + len(room_cases)] = self.room_codes[room_index]
+            case_nbr[position:position + len(room_cases)] = np.arange(1, len(room_cases) + 1)
+            position += len(room_cases)
+        cases['replication'] = np.repeat(np.arange(replications), size)
+        cases['case_nbr'] = np.tile(case_nbr, replications)
+        cases['room'] = np.tile(room, replications)
+        cases['service_line'] = np.tile(self.case_service_lines.codes[case_ids], replications)
+        cases['cancelled'] = np.tile(self.case_cancelled[case_ids], replications)
+        cases['sch_start'] = np.tile(np.round(sch_start), replications)
+        cases['sch_end'] = np.tile(np.round(sch_start + self.case_lengths[case_ids]), replications)
+        return schedule
+
+    def stageCosts(self, candidate, stage):
+        #cost of each simulated day of one stage - every candidate uses the same random streams for the same stage
+        schedule = self.simulation.simulateCompact(self.compact(candidate, self.stage_sizes[stage]), room_seeds=self.stage_seeds[stage])
+        room_days = roomDays(schedule, self.closing_times)
+        self.evaluations += 1
+        day_cost = self.overtime_weight*room_days['overtime'] + self.idle_weight*room_days['idle']
+        return np.bincount(room_days['day'], weights=day_cost, minlength=self.stage_sizes[stage])
+
+    def evaluate(self, candidate, current_costs=None, temperature=None, reject_probability=.01):
+        '''
+        Input: candidate, costs of the current candidate by stage, temperature, acceptance probability below which a
+        worse candidate is dropped early
+        Output: list of the cost arrays of the stages that were simulated - fewer than all of them when the candidate
+        was dropped early
+        '''
+        costs = []
+        for stage in range(self.stages):
+            costs.append(self.stageCosts(candidate, stage))
+            if current_costs is None or stage == self.stages - 1:
+                continue
+            #sequential test on the paired differences - drop the candidate once even the optimistic end of the
+            #confidence interval would almost never be accepted
+            differences = np.concatenate(costs) - np.concatenate(current_costs[:stage + 1])
+            lower = differences.mean() - 2*differences.std(ddof=1)/np.sqrt(len(differences))
+            if lower > 0 and np.exp(-lower/max(temperature, 1e-9)) < reject_probability:
+                break
+        return costs
+
+    def neighbour(self, candidate, rng):
+        #move a case to another room, swap two cases of one room, or swap cases between two rooms - movable rooms only
+        candidate = [list(room_cases) for room_cases in candidate]
+        filled = [room for room, room_cases in enumerate(candidate[:self.movable]) if room_cases]
+        if not filled:
+            return candidate
+        move = rng.integers(3)
+        room = filled[rng.integers(len(filled))]
+        if move == 0 and self.movable > 1:
+            case = candidate[room].pop(rng.integers(len(candidate[room])))
+            other = (room + 1 + rng.integers(self.movable - 1)) % self.movable
+            candidate[other].insert(rng.integers(len(candidate[other]) + 1), case)
+        elif move == 1 and len(candidate[room]) > 1:
+            first, second = rng.choice(len(candidate[room]), size=2, replace=False)
+            candidate[room][first], candidate[room][second] = candidate[room][second], candidate[room][first]
+        elif len(filled) > 1:
+            other = filled[rng.integers(len(filled))]
+            first, second = rng.integers(len(candidate[room])), rng.integers(len(candidate[other]))
+            candidate[room][first], candidate[other][second] = candidate[other][second], candidate[room][first]
+        return candidate
+
+    def run(self, iterations=500, initial_temperature=None, cooling=.99, seed=None):
+        '''
+        Input: number of candidates to try, starting temperature (default 1% of the starting cost), cooling factor
+        per iteration, seed of the search moves
+        Output: (best planned schedule, DataFrame with one row per iteration - cost, best cost, temperature, whether the
+        candidate was accepted and how many stages it was simulated for)
+        '''
+        rng = np.random.default_rng(seed)
+        current = self.initial
+        current_costs = self.evaluate(current)
+        current_cost = np.concatenate(current_costs).mean()
+        best, best_cost = current, current_cost
+        temperature = .01*current_cost if initial_temperature is None else initial_temperature
+
+        history = []
+        for iteration in range(iterations):
+            candidate = self.neighbour(current, rng)
+            costs = self.evaluate(candidate, current_costs, temperature)
+            cost = np.concatenate(costs).mean()
+            #only fully simulated candidates can be accepted
+            accepted = len(costs) == self.stages and (cost < current_cost or rng.random() < np.exp(-(cost - current_cost)/max(temperature, 1e-9)))
+            if accepted:
+                current, current_costs, current_cost = candidate, costs, cost
+                if cost < best_cost:
+                    best, best_cost = candidate, cost
+            history.append({'ITERATION': iteration, 'COST': cost, 'CURRENT_COST': current_cost, 'BEST_COST': best_cost,
+                            'TEMPERATURE': temperature, 'ACCEPTED': accepted, 'STAGES': len(costs)})
+            temperature *= cooling
+        return self.toFrame(best), pd.DataFrame(history)
+
+    def toFrame(self, candidate):
+        #a candidate as a planned schedule in the usual pandas layout
+        return self.compact(candidate, 1).toFrame(simulated=False)
 
 
 '''
@@ -168,630 +2148,893 @@ This is the bulk of the logic. Takes in all formatted data and performs scheduli
 ############################# Define the main class ########################################################################
 class HersheyORSim:
     #set initial variables
-    def __init__(self, selected_month="Jan", selected_weekday="Mon", selected_cutoff_time=.2916666):
+    def __init__(self, selected_month="Jan", selected_weekday="Mon", selected_cutoff_time=.2916666, seed=None):
     	#cut off time determines the hours before midnight when we are generating the schedule
     	#default is 5 p.m.
         self.selected_month = selected_month
         self.selected_weekday = selected_weekday
         self.selected_cutoff_time = selected_cutoff_time
-    #plan schedule function
-    def planSchedule(self):
-        d = {'CASE_NBR': [], 'SCH_START': [], 'SCH_END': [], 'SCH_OR': [], 'Service_Line': [], 'CANCELLED': []}
-        scheduled_cases = pd.DataFrame(data=d)
-        
-        for or_room in all_or_rooms:
-            # filter data based on selections
-            or_single = combined_data[(combined_data.SCH_OR == or_room) & (combined_data.SCH_START_MONTH == self.selected_month) & (combined_data.WEEKDAY == self.selected_weekday)]
+        #every draw of planSchedule and simulateSchedule comes from this generator - the same seed gives the same schedules
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+    #independent copies of this simulation for parallel replications
+    def spawn(self, n):
+        '''
+        Input: number of child simulations
+        Output: list of n HersheyORSim with the same settings, each with its own independent random stream
+        '''
+        return [HersheyORSim(self.selected_month, self.selected_weekday, self.selected_cutoff_time, seed=child_seed)
+                for child_seed in spawnSeeds(self.seed if self.seed is not None else self.rng, n)]
+
+    #times and counts what runs inside the with block - off (and close to free) everywhere else
+    def profile(self, trace=False, cprofile=False):
+        '''
+        Input: whether to keep every timed span for Profiler.writeTrace, whether to also run cProfile for
+        Profiler.dumpStats
+        Output: context manager giving the Profiler - e.g. with sim.profile() as profiler: sim.runReplications(1000)
+        then profiler.timerSummary() and profiler.counterSummary()
+        '''
+        return profiling(Profiler(trace, cprofile))
 
-            # filter out cases that were scheduled not before cutoff time the previous day (these are emergency cases mostly) or were cancelled after the cutoff time
-            or_single = or_single[((or_single.ORIG_SCH_DATE < (or_single.CASE_DATE-timedelta(days=self.selected_cutoff_time))) | pd.isnull(or_single.ORIG_SCH_DATE)) & ((or_single.CANCELLED_DATE > or_single.CASE_DATE-timedelta(days=self.selected_cutoff_time)) | (or_single.cancelled_flag ==0))]
-            # skip room if no data
-            if len(or_single) == 0:
-                continue
-            
-            # rank the cases by time each day - we can use this to find the first, second, third, etc. case of each day
-            or_single['case_order_scheduled'] = or_single.groupby("CASE_DATE")["SCH_START"].rank("dense", ascending=True)
-            
-            ##################################################################################################
-            #Find the 90th percentile time a case has been scheduled to end in a room for use later
-            max_time_or = or_single['SCH_END'].apply(lambda x : datetime.strptime(str(x), "%Y-%m-%d %H:%M:%S").time())
-            max_time_or = max_time_or.sort_values(ascending=True, ignore_index=True)
-            max_time_or = max_time_or.iloc[round(.9*len(max_time_or))-1]
-
-            # Start by seeing how many cases there will be that day
-            num_cases = or_single[['CASE_DATE', 'CASE_NBR']].groupby(['CASE_DATE']).agg(['count']).reset_index()
-            num_cases = num_cases[['CASE_NBR']]
-            
-            # the next few lines create a KDE of the number of cases that will be in the OR that day
-            num_cases_numpy = num_cases.to_numpy().reshape(-1, 1)
-            num_cases_kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(num_cases_numpy)
-            # pull a random draw from the distribution - rerunning this block will create a new draw each time
-            num_cases_draw = round(num_cases_kde.sample(1)[0][0])
-
-            #################################################################################################
-
-            days_cases = []
-            days_cancelled = []
-
-            # for each of the cases that is scheduled for that day, what is that case?
-            for i in range(1, int(num_cases_draw)+1):
-                # what is the probability of each type of case being the ith case of the day?
-                or_single_sl_prob_start = or_single[(or_single.case_order_scheduled == i)]
-                or_single_sl_prob = or_single_sl_prob_start[['Service_Line', 'CASE_NBR', 'cancelled_flag']].groupby(['Service_Line', 'cancelled_flag']).agg(['count']).reset_index().sort_values(by=('CASE_NBR', 'count'), ascending=False)
-                total_cases = len(or_single_sl_prob_start)
-                or_single_sl_prob['prob'] = or_single_sl_prob[['CASE_NBR']]/total_cases
-
-                # random number, pick which type of case with be the ith of the day based on historical probability
-                ids = list(range(0, len(or_single_sl_prob)))
-                or_single_sl_prob['ids'] = ids
-                
-                for id_x in ids:
-                    cs = sum(or_single_sl_prob['prob'][or_single_sl_prob['ids'] < id_x+1])
-                    or_single_sl_prob.iloc[id_x, 3] = cs
-
-                random_num = random.uniform(0, 1)
-
-                for id_x in ids:
-                    if random_num < or_single_sl_prob.iloc[id_x, 3]:
-                        case_type = or_single_sl_prob.iloc[id_x,0]
-                        cancelled = or_single_sl_prob.iloc[id_x,1]
-                        break
-                        
-                        
-                #check if case_type that was just drawn is the same as the one before it - 94% of the time it should
-                #if it's the same, just continue
-                if i != 1:
-                    if case_type != days_cases[i-2]:
-                        random_num = random.uniform(0, 1)
-                        if random_num < .06:
-                            case_type = case_type
-                        else:
-                            case_type = days_cases[i-2]
-            
-                        
-                days_cases.append(case_type)
-                days_cancelled.append(cancelled)
-            ################################################################################################
-
-            # What time will the first case start? Random draw from discrete distribution of historical probabilities
-            or_single_first_cases = or_single[(or_single.case_order_scheduled == 1)]
-            first_case_start_time = or_single_first_cases[['scheduled_start_time']]
-
-            first_case_start_time = or_single_first_cases[['scheduled_start_time', 'CASE_NBR']].groupby(['scheduled_start_time']).agg(['count']).reset_index().sort_values(by=('CASE_NBR', 'count'), ascending=False)
-            total_cases = len(or_single_first_cases)
-            first_case_start_time['prob'] = first_case_start_time[['CASE_NBR']]/total_cases
-
-            ids = list(range(0, len(first_case_start_time)))
-            first_case_start_time['ids'] = ids
-
-            for id_x in ids:
-                cs = sum(first_case_start_time['prob'][first_case_start_time['ids'] < id_x+1])
-                first_case_start_time.iloc[id_x, 3] = cs
-
-            random_num = random.uniform(0, 1)
-
-            for id_x in ids:
-                if random_num < first_case_start_time.iloc[id_x, 3]:
-                    starting_time_winner = first_case_start_time.iloc[id_x,0]
-                    break
-
-            #date formatting for month
-            if self.selected_month == "Jan":
-                month_number = 1
-            elif self.selected_month == "Feb":
-                month_number = 2
-            elif self.selected_month == "Mar":
-                month_number = 3
-            elif self.selected_month == "Apr":
-                month_number = 4
-            elif self.selected_month == "May":
-                month_number = 5
-            elif self.selected_month == "Jun":
-                month_number = 6
-            elif self.selected_month == "Jul":
-                month_number = 7
-            elif self.selected_month == "Aug":
-                month_number = 8
-            elif self.selected_month == "Sep":
-                month_number = 9
-            elif self.selected_month == "Oct":
-                month_number = 10
-            elif self.selected_month == "Nov":
-                month_number = 11
-            else:
-                month_number = 12
-                
-            #format starting time and max case end time based on the selected month
-            starting_time = datetime.combine(date(2020, month_number, 1), starting_time_winner)
-            max_cases_or_time = datetime.combine(date(2020, month_number, 1), max_time_or)
-
-            ##################################################################################################
-            #distribution of time between cases to draw from
-            or_single_copy = or_single.copy()
-            or_single_copy['case_order_scheduled'] = or_single_copy['case_order_scheduled'] - 1
-            or_single_time_between = or_single.merge(or_single_copy, how='left', on=['CASE_DATE', 'case_order_scheduled', 'SCH_OR'])
-            or_single_time_between = or_single_time_between[['SCH_START_x', 'SCH_END_x', 'SCH_OR', 'SCH_START_y', 'SCH_END_y']]
-            or_single_time_between = or_single_time_between[or_single_time_between.SCH_START_y.notnull()]
-            or_single_time_between['time_between_surgeries_scheduled'] = (or_single_time_between['SCH_START_y'] - or_single_time_between['SCH_END_x']).dt.total_seconds()/60
-            or_single_time_between
-
-            scheduled_time_between = or_single_time_between[['time_between_surgeries_scheduled']]
-            scheduled_time_between_numpy = scheduled_time_between.to_numpy().reshape(-1, 1)
-            
-            #check if there are enough cases to build this data, otherwise set it to just be 10 minutes
-            if len(scheduled_time_between) == 0:
-                scheduled_time_between_numpy = np.array([10,10,10,10]).reshape(-1, 1)
-            kde_time_between_cases = KernelDensity(kernel='gaussian', bandwidth=.02).fit(scheduled_time_between_numpy)
-
-            ##################################################################################################
-            #for each case number in that OR
-            for case_number in range(0, len(days_cases)):
-                # starting case
-                if case_number == 0:
-                    # with starting case, generate distrubution of that surgery length as originally scheduled
-                    or_single_department_line = or_single[(or_single.Service_Line == days_cases[case_number])]
-                    X = or_single_department_line[['scheduled_case_duration_minute']]
-                    X2 = X.to_numpy().reshape(-1, 1)
-                    kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(X2)
-                    #draw case length
-                    case_length = round(kde.sample(1)[0][0])
-                    #add the first case onto the schedule
-                    temp_d = pd.DataFrame(data={'CASE_NBR': [case_number+1], 'SCH_START': [starting_time], 'SCH_END': [starting_time + timedelta(minutes=case_length)], 'SCH_OR': [or_room], 'Service_Line': [days_cases[case_number]], 'CANCELLED': [days_cancelled[case_number]]})
-                    scheduled_cases = scheduled_cases.append(temp_d)
-                else: 
-                    # distribution of turnover time
-                    scheduled_time_between_draw = round(kde_time_between_cases.sample(1)[0][0])
-                    # add turnover time to scheduled end of last case --> this is scheduled start
-                    next_case_scheduled_start = scheduled_cases.iloc[len(scheduled_cases)-1,2] + timedelta(minutes= round(kde_time_between_cases.sample(1)[0][0]))
-
-                    # random pull for surgery length --> scheduled end
-                    or_single_department_line = or_single[(or_single.Service_Line == days_cases[case_number])]
-                    X = or_single_department_line[['scheduled_case_duration_minute']]
-                    X2 = X.to_numpy().reshape(-1, 1)
-                    kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(X2)
-                    case_length = round(kde.sample(1)[0][0])
-                                       
-                    #make sure case length isn't too late in the night
-                    if next_case_scheduled_start + timedelta(minutes=case_length) < max_cases_or_time:
-                        temp_d = pd.DataFrame(data={'CASE_NBR': [case_number+1], 'SCH_START': [next_case_scheduled_start], 'SCH_END': [next_case_scheduled_start + timedelta(minutes=case_length)], 'SCH_OR': [or_room], 'Service_Line': [days_cases[case_number]], 'CANCELLED': [days_cancelled[case_number]]})
-                        temp_d['SCH_START'] = temp_d['SCH_START'].dt.round("5min") # round start to nearest 5 minutes
-                        scheduled_cases = scheduled_cases.append(temp_d)
-                    #try to redraw 5 times to see if we get a shorter case; if we don't, move on
-                    else:
-                        num_retries = 0
-                        while num_retries <5:
-                            case_length = round(kde.sample(1)[0][0])
-                            if next_case_scheduled_start + timedelta(minutes=case_length) < max_cases_or_time:
-                                temp_d = pd.DataFrame(data={'CASE_NBR': [case_number+1], 'SCH_START': [next_case_scheduled_start], 'SCH_END': [next_case_scheduled_start + timedelta(minutes=case_length)], 'SCH_OR': [or_room], 'Service_Line': [days_cases[case_number]], 'CANCELLED': [days_cancelled[case_number]]})
-                                temp_d['SCH_START'] = temp_d['SCH_START'].dt.round("5min") # round start to nearest 5 minutes
-                                scheduled_cases = scheduled_cases.append(temp_d)
-                                break
-                            else:
-                                num_retries += 1
-                        
-                        if num_retries == 5:
-                            break
-                         
-
-
-        return(scheduled_cases)
+    #plan schedule function
+    def planSchedule(self, batch_size=None):
+        '''
+        Input: optional number of days to plan at once
+        Output: planned schedule; with a batch_size, that many planned days labelled by a REPLICATION column
+        '''
+        with profileTimer("plan"):
+            schedule = self.planCompact(1 if batch_size is None else batch_size, self.rng)
+        with profileTimer("to frame"):
+            return schedule.toFrame(simulated=False, replications=batch_size is not None)
+
+    #plans n days at once as a CompactSchedule
+    def planCompact(self, n, rng=None):
+        '''
+        Input: number of days to plan, random generator
+        Output: CompactSchedule with the planned cases of every day, numbered by replication
+        '''
+        rng = self.rng if rng is None else rng
+        distribution_index = getDistributionIndex()
+        all_or_rooms = getAllORRooms()
+
+        #every day of a room is planned together from that room's fitted distributions
+        room_plans = []
+        for room, or_room in enumerate(all_or_rooms):
+            with profileTimer("plan room", or_room):
+                plan_model = distribution_index.planModel(or_room, self.selected_month, self.selected_weekday, self.selected_cutoff_time)
+                # skip room if no data
+                if plan_model is None:
+                    continue
+                plan = plan_model.planBatch(n, rng)
+            replication, case_number = np.nonzero(plan['in_plan'])
+            room_plans.append((room, replication, case_number, plan))
+
+        #put the plans of all rooms into one compact schedule
+        #a case with no service line (a room whose history has none) gets code -1
+        service_lines = sorted({service_line for room, replication, case_number, plan in room_plans for service_line in plan['service_line'][replication, case_number] if pd.notna(service_line)})
+        schedule = CompactSchedule.empty(datetime(2020, monthNumber(self.selected_month), 1), all_or_rooms, service_lines,
+                                         sum(len(replication) for room, replication, case_number, plan in room_plans))
+        first_case = 0
+        for room, replication, case_number, plan in room_plans:
+            room_cases = schedule.cases[first_case:first_case + len(replication)]
+            room_cases['replication'] = replication
+            room_cases['case_nbr'] = case_number + 1
+            room_cases['room'] = room
+            room_cases['service_line'] = pd.Categorical(plan['service_line'][replication, case_number], categories=service_lines).codes
+            room_cases['cancelled'] = plan['cancelled'][replication, case_number]
+            room_cases['sch_start'] = plan['sch_start'][replication, case_number]
+            room_cases['sch_end'] = plan['sch_end'][replication, case_number]
+            first_case += len(replication)
+        return schedule
     
     #Finds, formats, and returns an actual Hershey planned schedule for simulating
     def selectRealSchedule(self, selected_date):
+        #the day's cases are one slice of the date index, and recently used days come from its cache
         selected_date = datetime.strptime(selected_date, '%Y-%m-%d')
-
-        # filter data based on selections
-        scheduled_cases = combined_data[(combined_data.CASE_DATE == selected_date)]
-
-        # filter out cases that were scheduled not before cutoff time the previous day (these are emergency cases mostly) or were cancelled after the cutoff time
-        scheduled_cases = scheduled_cases[((scheduled_cases.ORIG_SCH_DATE < (scheduled_cases.CASE_DATE-timedelta(days=self.selected_cutoff_time))) | pd.isnull(scheduled_cases.ORIG_SCH_DATE)) & ((scheduled_cases.CANCELLED_DATE > scheduled_cases.CASE_DATE-timedelta(days=self.selected_cutoff_time)) | (scheduled_cases.cancelled_flag == 0))]
-        
-        #only keep cases that happened in one of the used OR rooms
-        scheduled_cases = scheduled_cases[(scheduled_cases.SCH_OR.isin(all_or_rooms))]
-        #set cancelled to 0 because we don't know any information about cancelled cases at this time
-        scheduled_cases['CANCELLED'] = 0 
-        #add in the new case number for order and sort values before returning
-        scheduled_cases['CASE_NBR'] = scheduled_cases.groupby("SCH_OR")["SCH_START"].rank("dense", ascending=True)
-        scheduled_cases = scheduled_cases.sort_values(by=['SCH_OR', 'SCH_START'])
-        scheduled_cases = scheduled_cases[['CASE_NBR', 'SCH_START', 'SCH_END', 'SCH_OR', 'Service_Line',
-                                          'CANCELLED']]
-        return scheduled_cases
+        with profileTimer("real schedule"):
+            return getRealScheduleIndex().schedule(selected_date, self.selected_cutoff_time)
+
+    #actual Hershey planned schedules of every day in a date range
+    def selectRealSchedules(self, first_date, last_date):
+        '''
+        Input: first and last date ('%Y-%m-%d', both included)
+        Output: the real schedule of every day as selectRealSchedule returns it, labelled by a CASE_DATE column
+        '''
+        return getRealScheduleIndex().schedules(datetime.strptime(first_date, '%Y-%m-%d'), datetime.strptime(last_date, '%Y-%m-%d'), self.selected_cutoff_time)
     
     #simulates a planned schedule
-    def simulateSchedule(self, planned_schedule):
-        #store the actual simulated schedule
-        d = {'CASE_NBR': [], 'SCH_START': [], 'SCH_END': [], 'SCH_OR': [], 'Service_Line': [], 'CANCELLED': [],
-            "IN_ROOM_TIME": [], "OUT_ROOM_TIME": [], "OR_USED":[]}
-        simulated_cases = pd.DataFrame(data=d)
-        
-        #go through each OR room
-        for or_room in all_or_rooms:
-            temp_or_room = planned_schedule[planned_schedule.SCH_OR==or_room]
-            #if OR room has not scheduled cases, pass and continue onto the next one
-            if len(temp_or_room) == 0:
-                continue
-            
-            
-            #Filter for the correct room, day, month, non-emergency and non-cancelled
-            or_single_simulated = combined_data[(combined_data.OR_USED == or_room) & (combined_data.ACTUAL_START_MONTH == self.selected_month) & (combined_data.ACTUAL_WEEKDAY == self.selected_weekday) & (combined_data.cancelled_flag == 0 & (combined_data.calculated_add_on_hours > 6))]
-            
-            #calculate a few columns that are useful to use
-            or_single_simulated['IN_ROOM_TIME'] = pd.to_datetime(or_single_simulated['IN_ROOM_TIME'])
-            or_single_simulated['OUT_ROOM_TIME'] = pd.to_datetime(or_single_simulated['OUT_ROOM_TIME'])
-            or_single_simulated['case_order_actual'] = or_single_simulated.groupby("CASE_DATE")["IN_ROOM_TIME"].rank("dense", ascending=True)
-            
-            #go through each case in that room
-            for index, row in temp_or_room.iterrows():
-                #check if it's the first case of the day in that OR - if it is,
-                #draw from the KDE from same OR, where case number == 1
-                if row['CASE_NBR'] == 1:
-                    #check if the case is cancelled
-                    #first case of the day, cancelled
-                    if row['CANCELLED'] == 1:
-                        #add the results to the data frame
-                        temp_d = pd.DataFrame(data={'CASE_NBR': [row['CASE_NBR']], 'SCH_START': [row['SCH_START']], 'SCH_END': [row['SCH_END']], 'SCH_OR': [row['SCH_OR']], 'Service_Line': [row['Service_Line']], 'CANCELLED': [row['CANCELLED']],
-                                               "IN_ROOM_TIME":[np.nan], "OUT_ROOM_TIME":[np.nan], "OR_USED":[""]})
-                    
-                        simulated_cases = simulated_cases.append(temp_d)
-                    #first case of the day, not cancelled
-                    else:
-                        # with starting case, generate distrubution of actual-scheduled case start time ##########################
-                        or_single_first_case = or_single_simulated[(or_single_simulated.case_order_actual == 1)]
-
-                        X = or_single_first_case[['actual_minus_scheduled_case_start_time']]
-                        X2 = X.to_numpy().reshape(-1, 1)
-                        #if no data, make the start time difference distribution
-                        if len(or_single_first_case) == 0:
-                            X2 = np.array([0,0,-5,5,10,-10]).reshape(-1, 1)
-                        #draw difference in case start time if there's data
-                        kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(X2)
-                        start_time_difference = round(kde.sample(1)[0][0])
-                        
-                        #make sure the start time for the first case is reasonable
-                        while start_time_difference < -90 or start_time_difference > 90:
-                            start_time_difference = round(kde.sample(1)[0][0])
-                        ######################################## CASE LENGTH #####################################################
-                        # random pull for surgery length --> actual length/difference from planned
-                        or_single_department_line = or_single_simulated[(or_single_simulated.Service_Line == row['Service_Line'])]
-                        X = or_single_department_line[['actual_minus_scheduled_case_duration_minute']]
-                        X2 = X.to_numpy().reshape(-1, 1)
-                        if len(or_single_department_line) == 0:
-                            X2 = np.array([0,0,0,0]).reshape(-1, 1)
-                        kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(X2)
-                        case_length_modifier = round(kde.sample(1)[0][0])
-                        
-                        #get the actual scheduled case length of this case
-                        scheduled_case_length = (row.loc['SCH_END'] - row.loc['SCH_START']).total_seconds()/60
-                          
-                        #make sure the length of the case is positive; redraw case_length_modifier if not    
-                        while scheduled_case_length + case_length_modifier < 10:
-                            case_length_modifier = round(kde.sample(1)[0][0])
-
-                        #add the results to the data frame
-                        temp_d = pd.DataFrame(data={'CASE_NBR': [row['CASE_NBR']], 'SCH_START': [row['SCH_START']], 'SCH_END': [row['SCH_END']], 'SCH_OR': [row['SCH_OR']], 'Service_Line': [row['Service_Line']], 'CANCELLED': [row['CANCELLED']],
-                                                   "IN_ROOM_TIME":[row['SCH_START'] + timedelta(minutes=start_time_difference)], "OUT_ROOM_TIME":[row['SCH_START'] + timedelta(minutes=start_time_difference+scheduled_case_length+case_length_modifier)],
-                                                    "OR_USED":[row['SCH_OR']]})
-
-                        simulated_cases = simulated_cases.append(temp_d)
-                #second case or later
-                else:
-                    #second case or later, cancelled
-                    if row['CANCELLED'] == 1:
-                        temp_d = pd.DataFrame(data={'CASE_NBR': [row['CASE_NBR']], 'SCH_START': [row['SCH_START']], 'SCH_END': [row['SCH_END']], 'SCH_OR': [row['SCH_OR']], 'Service_Line': [row['Service_Line']], 'CANCELLED': [row['CANCELLED']],
-                                               "IN_ROOM_TIME":[np.nan], "OUT_ROOM_TIME":[np.nan], "OR_USED":""})
-                    
-                        simulated_cases = simulated_cases.append(temp_d)
-                    #second case or later, not cancelled 
-                    else:
-                        #bring in previous case data
-                        previous_case = simulated_cases.iloc[len(simulated_cases)-1,]
-                        #previous case was cancelled
-                        if previous_case['CANCELLED'] >=1:
-                            #previous case was cancelled, and it could be any number case of the day
-                            #take scheduled start time add to it turnover time modifier, but let this modifier be zero or negative
-                            #random pull for turnover time
-                            #calculate turnover time distribution to draw from
-                            or_single_simulated_copy = or_single_simulated[or_single_simulated.Service_Line == row['Service_Line']].copy()
-                            or_single_simulated_copy['case_order_actual'] = or_single_simulated_copy['case_order_actual'] - 1
-                            or_single_time_between = or_single_simulated[or_single_simulated.Service_Line == row['Service_Line']].merge(or_single_simulated_copy, how='left', on=['CASE_DATE', 'case_order_actual', 'OR_USED'])
-                            or_single_time_between = or_single_time_between[['IN_ROOM_TIME_x', 'OUT_ROOM_TIME_x', 'OR_USED', 'IN_ROOM_TIME_y', 'OUT_ROOM_TIME_y', 'SCH_START_x', 'SCH_END_x', 'SCH_START_y', 'SCH_END_y', 'Service_Line_x']]
-                            or_single_time_between = or_single_time_between[or_single_time_between.IN_ROOM_TIME_y.notnull()]
-                            or_single_time_between['time_between_surgeries_actual'] = (or_single_time_between['IN_ROOM_TIME_y'] - or_single_time_between['OUT_ROOM_TIME_x']).dt.total_seconds()/60
-                            or_single_time_between['time_between_surgeries_scheduled'] = (or_single_time_between['SCH_START_y'] - or_single_time_between['SCH_END_x']).dt.total_seconds()/60
-                            or_single_time_between['actual_minus_expected_turnover_time'] = or_single_time_between['time_between_surgeries_actual'] - or_single_time_between['time_between_surgeries_scheduled']
-                            #return or_single_time_between
-
-                            actual_minus_expected_time_between = or_single_time_between[['actual_minus_expected_turnover_time']]
-                            actual_minus_expected_time_between_numpy = actual_minus_expected_time_between.to_numpy().reshape(-1, 1)
-
-                            #check if there are enough cases to build this data, otherwise set it to just be 10 minutes
-                            if len(actual_minus_expected_time_between_numpy) == 0:
-                                actual_minus_expected_time_between_numpy = np.array([10,10,10,10]).reshape(-1, 1)
-                            kde_time_between_cases_actual = KernelDensity(kernel='gaussian', bandwidth=.3).fit(actual_minus_expected_time_between_numpy)
-                            
-                            actual_time_between_draw = round(kde_time_between_cases_actual.sample(1)[0][0])
-
-                            #check if the turnover time is too extreme - limit of max 60 minutes since the previous case was cancelled
-                            too_extreme_count = 0
-                            if actual_time_between_draw > 60:
-                                while too_extreme_count < 5:
-                                    actual_time_between_draw = round(kde_time_between_cases_actual.sample(1)[0][0])
-                                    if actual_time_between_draw <= 60:
-                                        too_exteme_count = 10
-                                    else:
-                                        too_extreme_count +=1
-                            #if we couldn't get a draw less than 2 hours, manually set turnover time
-                            if too_extreme_count == 5:
-                                actual_time_between_draw = 25
-                            
-                                
-                            #case duration draw
-                            or_single_department_line = or_single_simulated[(or_single_simulated.Service_Line == row['Service_Line'])]
-                            X = or_single_department_line[['actual_minus_scheduled_case_duration_minute']]
-                            X2 = X.to_numpy().reshape(-1, 1)
-                            if len(or_single_department_line) == 0:
-                                X2 = np.array([0,0,0,0]).reshape(-1, 1)
-                            kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(X2)
-                            case_length_modifier = round(kde.sample(1)[0][0])
-                                
-                            #make sure the length of the case is positive
-                            scheduled_case_length = (row.loc['SCH_END'] - row.loc['SCH_START']).total_seconds()/60
-                            
-                            #redraw case length modifier if it will result in a case ending before it began
-                            while scheduled_case_length + case_length_modifier < 10:
-                                case_length_modifier = round(kde.sample(1)[0][0])
-                            
-                            #add things up and append
-                            temp_d = pd.DataFrame(data={'CASE_NBR': [row['CASE_NBR']], 'SCH_START': [row['SCH_START']], 'SCH_END': [row['SCH_END']], 'SCH_OR': [row['SCH_OR']], 'Service_Line': [row['Service_Line']], 'CANCELLED': [row['CANCELLED']],
-                                                           "IN_ROOM_TIME":[row['SCH_START'] + timedelta(minutes=actual_time_between_draw)], "OUT_ROOM_TIME":[row['SCH_START'] + timedelta(minutes=actual_time_between_draw+case_length_modifier+scheduled_case_length)],
-                                                        "OR_USED":[row['SCH_OR']]})
-
-                            simulated_cases = simulated_cases.append(temp_d)
-
-                            
-                        else: #continue as normal, previous case wasn't cancelled and neither was this one
-                        
-                            #random pull for turnover time
-                            #calculate turnover time distribution to draw from
-                            or_single_simulated_copy = or_single_simulated[or_single_simulated.Service_Line == row['Service_Line']].copy()
-                            or_single_simulated_copy['case_order_actual'] = or_single_simulated_copy['case_order_actual'] - 1
-                            or_single_time_between = or_single_simulated[or_single_simulated.Service_Line == row['Service_Line']].merge(or_single_simulated_copy, how='left', on=['CASE_DATE', 'case_order_actual', 'OR_USED'])
-                            or_single_time_between = or_single_time_between[['IN_ROOM_TIME_x', 'OUT_ROOM_TIME_x', 'OR_USED', 'IN_ROOM_TIME_y', 'OUT_ROOM_TIME_y', 'SCH_START_x', 'SCH_END_x', 'SCH_START_y', 'SCH_END_y', 'Service_Line_x']]
-                            or_single_time_between = or_single_time_between[or_single_time_between.IN_ROOM_TIME_y.notnull()]
-                            or_single_time_between['time_between_surgeries_actual'] = (or_single_time_between['IN_ROOM_TIME_y'] - or_single_time_between['OUT_ROOM_TIME_x']).dt.total_seconds()/60
-                            or_single_time_between['time_between_surgeries_scheduled'] = (or_single_time_between['SCH_START_y'] - or_single_time_between['SCH_END_x']).dt.total_seconds()/60
-                            or_single_time_between['actual_minus_expected_turnover_time'] = or_single_time_between['time_between_surgeries_actual'] - or_single_time_between['time_between_surgeries_scheduled']
-                            #return or_single_time_between
-
-                            actual_minus_expected_time_between = or_single_time_between[['actual_minus_expected_turnover_time']]
-                            actual_minus_expected_time_between_numpy = actual_minus_expected_time_between.to_numpy().reshape(-1, 1)
-
-                            #check if there are enough cases to build this data, otherwise set it to just be 10 minutes
-                            if len(actual_minus_expected_time_between_numpy) == 0:
-                                actual_minus_expected_time_between_numpy = np.array([0,5,10,15,20,25]).reshape(-1, 1)
-                            kde_time_between_cases_actual = KernelDensity(kernel='gaussian', bandwidth=.3).fit(actual_minus_expected_time_between_numpy)
-
-                            actual_time_between_draw = round(kde_time_between_cases_actual.sample(1)[0][0])
-                            
-                            #check if the turnover time is too extreme
-                            too_extreme_count = 0
-                            if actual_time_between_draw > 120:
-                                while too_extreme_count < 5:
-                                    actual_time_between_draw = round(kde_time_between_cases_actual.sample(1)[0][0])
-                                    if actual_time_between_draw <= 120:
-                                        too_exteme_count = 10
-                                    else:
-                                        too_extreme_count +=1
-                            #if we couldn't get a draw less than 2 hours, manually set turnover time
-                            if too_extreme_count == 5:
-                                actual_time_between_draw = 25
-                            
-                            #bring in previous row and check that the changeover time doesn't make the situation impossible
-                            simulated_turnover_time = (row.loc['SCH_START'] - previous_case['SCH_END']).total_seconds()/60 + actual_time_between_draw
-                            if simulated_turnover_time < 5:
-                                simulated_turnover_time = 30
-                                
-                                
-                            #case duration draw
-                            or_single_department_line = or_single_simulated[(or_single_simulated.Service_Line == row['Service_Line'])]
-                            X = or_single_department_line[['actual_minus_scheduled_case_duration_minute']]
-                            X2 = X.to_numpy().reshape(-1, 1)
-                            if len(or_single_department_line) == 0:
-                                X2 = np.array([0,0,0,0]).reshape(-1, 1)
-                            kde = KernelDensity(kernel='gaussian', bandwidth=.3).fit(X2)
-                            case_length_modifier = round(kde.sample(1)[0][0])
+    def simulateSchedule(self, planned_schedule, kpis=None):
+        #the simulation runs on a compact copy of the planned schedule and only the result goes back to pandas
+        #the day is also added to kpis when a KPIAccumulator is passed in
+        with profileTimer("from frame"):
+            schedule = CompactSchedule.fromFrame(planned_schedule, getAllORRooms())
+        with profileTimer("simulate"):
+            self.simulateCompact(schedule, self.rng)
+        if kpis is not None:
+            with profileTimer("kpis"):
+                kpis.update(schedule, self.closingTimes(schedule))
+        with profileTimer("to frame"):
+            return schedule.toFrame()
+
+    #simulates a CompactSchedule in place
+    def simulateCompact(self, schedule, rng=None, room_seeds=None):
+        '''
+        Input: CompactSchedule of planned cases (one or many replications), random generator, optional SeedSequence
+        per room code - each room then draws from its own stream instead of rng, so changing one room's cases does
+        not change the draws of the others
+        Output: the same schedule with in_room and out_room filled in
+        '''
+        rng = self.rng if rng is None else rng
+        distribution_index = getDistributionIndex()
+        cases = schedule.cases
+        #code -1 (missing service line) picks the nan on the end
+        service_line_names = np.array(schedule.service_lines + [np.nan], dtype=object)
+
+        #go through each OR room, simulating all of its replications together
+        for room, layout in schedule.roomLayouts().items():
+            or_room = schedule.rooms[room]
+            with profileTimer("simulate room", or_room):
+                #fitted distributions for the correct room, day, month and non-cancelled
+                simulation_model = distribution_index.simulationModel(or_room, self.selected_month, self.selected_weekday)
+
+                in_plan = layout >= 0
+                room_cases = cases[layout]
+                sch_start = np.where(in_plan, room_cases['sch_start'], np.nan)
+                sch_end = np.where(in_plan, room_cases['sch_end'], np.nan)
+                room_rng = rng if room_seeds is None else np.random.default_rng(room_seeds[room])
+                in_room, out_room = simulation_model.simulateBatch(service_line_names[room_cases['service_line']], room_cases['cancelled'],
+                                                                   sch_start, sch_end, in_plan, room_rng, first_case=room_cases['case_nbr'] == 1)
+
+            positions = layout[in_plan]
+            cases['in_room'][positions] = np.where(np.isnan(in_room[in_plan]), MISSING_TIME, in_room[in_plan])
+            cases['out_room'][positions] = np.where(np.isnan(out_room[in_plan]), MISSING_TIME, out_room[in_plan])
+        return schedule
+
+    #plans and simulates n replications of the day at once
+    def runReplications(self, n, seed=None):
+        '''
+        Input: number of replications of the day, seed or numpy Generator for the random draws (default this
+        simulation's own generator)
+        Output: planned and simulated cases of every replication in one DataFrame, with a REPLICATION column
+        '''
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        with profileTimer("plan"):
+            schedule = self.planCompact(n, rng)
+        with profileTimer("simulate"):
+            self.simulateCompact(schedule, rng)
+
+        with profileTimer("to frame"):
+            return schedule.toFrame(replications=True).sort_values(by=['REPLICATION', 'SCH_OR', 'CASE_NBR'], ignore_index=True)
+
+    #closing time of each room for the KPIs - the 90th percentile scheduled end the plans use
+    def closingTimes(self, schedule):
+        '''
+        Input: CompactSchedule
+        Output: closing time of each of its rooms in minutes after midnight, nan for rooms with no fitted plan
+        '''
+        distribution_index = getDistributionIndex()
+        closing_times = np.full(len(schedule.rooms), np.nan)
+        for room, or_room in enumerate(schedule.rooms):
+            if (schedule.cases['room'] == room).any():
+                plan_model = distribution_index.planModel(or_room, self.selected_month, self.selected_weekday, self.selected_cutoff_time)
+                if plan_model is not None:
+                    closing_times[room] = plan_model.max_time_or
+        return closing_times
+
+    #plans and simulates n replications in chunks, keeping only the KPIs of each day
+    def summarizeReplications(self, n, kpis=None, chunk_size=1000, seed=None):
+        '''
+        Input: number of replications of the day, KPIAccumulator to add them to (default a new one), replications
+        per chunk, seed or numpy Generator (default this simulation's own generator)
+        Output: the KPIAccumulator - no simulated cases are kept
+        '''
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        kpis = KPIAccumulator() if kpis is None else kpis
+        closing_times = None
+        for first_replication in range(0, n, chunk_size):
+            with profileTimer("plan"):
+                schedule = self.planCompact(min(chunk_size, n - first_replication), rng)
+            with profileTimer("simulate"):
+                self.simulateCompact(schedule, rng)
+            if closing_times is None:
+                closing_times = self.closingTimes(schedule)
+            with profileTimer("kpis"):
+                kpis.update(schedule, closing_times)
+        return kpis
+
+    #replays historical days of this month and weekday and scores the simulations against what happened
+    def backtestDays(self, dates, n, rng=None):
+        '''
+        Input: historical dates, simulations of each day, random generator
+        Output: (cases, room_days) DataFrames of the actual and simulated times in minutes after midnight with their
+        calibration metrics - see BacktestReport
+        '''
+        rng = self.rng if rng is None else rng
+        dates = pd.DatetimeIndex(dates).unique().sort_values()
+        schedules = getRealScheduleIndex().schedules(dates.min(), dates.max(), self.selected_cutoff_time)
+        schedules = schedules[schedules.CASE_DATE.isin(dates)]
+        actual = getCombinedData().loc[schedules.index, ['IN_ROOM_TIME', 'OUT_ROOM_TIME']]
+        all_or_rooms = getAllORRooms()
+
+        #n copies of every day - fromFrame keeps the order of the copies inside each room, so we know where each case went
+        rows = np.tile(np.arange(len(schedules)), n)
+        day = dates.get_indexer(schedules.CASE_DATE)
+        planned = schedules.iloc[rows].assign(REPLICATION=day[rows]*n + np.repeat(np.arange(n), len(schedules)))
+        schedule = self.simulateCompact(CompactSchedule.fromFrame(planned, all_or_rooms), rng)
+        source = rows[np.argsort(pd.Categorical(planned.SCH_OR, categories=all_or_rooms).codes, kind='stable')]
+        draw = schedule.cases['replication'] % n
+
+        #every time in minutes after the midnight of its own day
+        day_start = ((dates - pd.Timestamp(schedule.day_start))/pd.Timedelta(minutes=1)).to_numpy()[day]
+        simulated = {}
+        for time, column in (('IN', 'in_room'), ('OUT', 'out_room')):
+            minutes = np.full((len(schedules), n), np.nan)
+            minutes[source, draw] = np.where(schedule.cases[column] == MISSING_TIME, np.nan, schedule.cases[column])
+            simulated[time] = minutes - day_start[:, None]
+        midnight = schedules.CASE_DATE
+        cases = schedules[['CASE_DATE', 'SCH_OR', 'Service_Line', 'CASE_NBR']].reset_index(drop=True)
+        cases['ACTUAL_IN'] = ((actual.IN_ROOM_TIME - midnight)/pd.Timedelta(minutes=1)).to_numpy()
+        cases['ACTUAL_OUT'] = ((actual.OUT_ROOM_TIME - midnight)/pd.Timedelta(minutes=1)).to_numpy()
+        for time in ('IN', 'OUT'):
+            observed = cases['ACTUAL_' + time].to_numpy()
+            cases['SIMULATED_' + time] = np.median(simulated[time], axis=1)
+            cases['CRPS_' + time] = np.where(np.isnan(observed), np.nan, ensembleCRPS(simulated[time], observed))
+            for level in BacktestReport.levels:
+                cases['COVERAGE_{}_{}'.format(int(level*100), time)] = intervalCoverage(simulated[time], observed, level)
+
+        #end of each room's day, and the overrun past its closing time (the latest scheduled end if it has none)
+        room_days = cases.groupby(['CASE_DATE', 'SCH_OR'], sort=True, observed=True)
+        room_day = room_days.ngroup().to_numpy()
+        simulated_end = np.full((room_days.ngroups, n), -np.inf)
+        np.maximum.at(simulated_end, room_day, simulated['OUT'])
+        room_day_cases = room_days.size().index.to_frame(index=False)
+        actual_end = room_days.ACTUAL_OUT.max().to_numpy()
+        scheduled_end = pd.Series(((schedules.SCH_END - midnight)/pd.Timedelta(minutes=1)).to_numpy()).groupby(room_day).max().to_numpy()
+        closing = pd.Series(self.closingTimes(schedule), index=all_or_rooms)[room_day_cases.SCH_OR].to_numpy()
+        closing = np.where(np.isnan(closing), scheduled_end, closing)
+        room_day_cases['ACTUAL_END'] = actual_end
+        room_day_cases['SIMULATED_END'] = np.median(simulated_end, axis=1)
+        room_day_cases['END_ERROR'] = room_day_cases.SIMULATED_END - actual_end
+        room_day_cases['OVERRUN_ERROR'] = np.maximum(simulated_end - closing[:, None], 0).mean(axis=1) - np.maximum(actual_end - closing, 0)
+        room_day_cases['CRPS_END'] = np.where(np.isnan(actual_end), np.nan, ensembleCRPS(simulated_end, actual_end))
+        room_day_cases['COVERAGE_90_END'] = intervalCoverage(simulated_end, actual_end, .9)
+        return cases, room_day_cases
+
+    #plans and simulates n replications in chunks, writing each chunk to a sink instead of keeping it
+    def streamReplications(self, n, sink, chunk_size=100):
+        '''
+        Input: number of replications of the day, ResultSink (see openSink), replications per chunk
+        Output: the sink, with every replication written to it - each chunk has its own random stream spawned from
+        this simulation's seed and recorded in the SEED column
+        '''
+        scenario = (self.selected_month, self.selected_weekday, self.selected_cutoff_time)
+        chunk_starts = list(range(0, n, chunk_size))
+        for first_replication, chunk_seed in zip(chunk_starts, spawnSeeds(self.seed if self.seed is not None else self.rng, len(chunk_starts))):
+            results = self.runReplications(min(chunk_size, n - first_replication), seed=chunk_seed)
+            results['REPLICATION'] = results['REPLICATION'] + first_replication
+            sink.write(_labelChunk(scenario, results), scenarioKey(*scenario), chunk_seed)
+        return sink
+
+    #reorders and moves the cases of a planned day to lower its expected overtime and idle time
+    def optimizeSchedule(self, planned_schedule, iterations=500, n=200, overtime_weight=1.0, idle_weight=.25, rooms=None, seed=None):
+        '''
+        Input: planned schedule of one day, candidates to try, simulated days per candidate, cost per minute of
+        overtime and of idle time, rooms the cases may use (default the rooms they are in), seed
+        Output: (best planned schedule found, DataFrame with the cost of every candidate tried) - see ScheduleOptimizer
+        '''
+        search_seed, simulation_seed = spawnSeeds(seed if seed is not None else self.rng, 2)
+        optimizer = ScheduleOptimizer(self, planned_schedule, rooms, overtime_weight, idle_weight, n, seed=simulation_seed)
+        return optimizer.run(iterations, seed=search_seed)
+
+    #simulates a planned schedule with the event-driven engine, including emergent cases
+    def simulateEvents(self, planned_schedule, policy=None, emergent=True):
+        '''
+        Input: planned schedule (one day, or many labelled by a REPLICATION column), BumpingPolicy (default bump the
+        next planned case), whether to add emergent arrivals
+        Output: simulated planned and emergent cases with EMERGENT, PRIORITY, ARRIVAL_TIME and BUMPED columns
+        '''
+        schedule = CompactSchedule.fromFrame(planned_schedule, getAllORRooms())
+        return self.simulateEventsCompact(schedule, policy, emergent)
+
+    #plans n days and simulates them with the event-driven engine
+    def runEventReplications(self, n, policy=None, emergent=True, seed=None):
+        '''
+        Input: number of replications of the day, BumpingPolicy, whether to add emergent arrivals, seed or numpy
+        Generator (default this simulation's own generator)
+        Output: simulated planned and emergent cases of every replication in one DataFrame
+        '''
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        with profileTimer("plan"):
+            schedule = self.planCompact(n, rng)
+        return self.simulateEventsCompact(schedule, policy, emergent, rng)
+
+    def simulateEventsCompact(self, schedule, policy=None, emergent=True, rng=None):
+        #draw every planned case as simulateCompact does, then play the days out on one event calendar
+        rng = self.rng if rng is None else rng
+        with profileTimer("simulate"):
+            self.simulateCompact(schedule, rng)
+        arrivals = None
+        if emergent:
+            replications = int(schedule.cases['replication'].max(initial=-1)) + 1
+            emergent_model = getDistributionIndex().emergentModel(self.selected_month, self.selected_weekday, self.selected_cutoff_time)
+            arrivals = emergent_model.sampleBatch(replications, rng)
+        with profileTimer("event calendar"):
+            return EventSimulation(schedule, arrivals, policy).run()
 
-    
-                            #make sure the length of the case is positive
-                            scheduled_case_length = (row.loc['SCH_END'] - row.loc['SCH_START']).total_seconds()/60
-                            
-                            while scheduled_case_length + case_length_modifier < 10:
-                                case_length_modifier = round(kde.sample(1)[0][0])
-                                
-                            #add things up and append
-                            temp_d = pd.DataFrame(data={'CASE_NBR': [row['CASE_NBR']], 'SCH_START': [row['SCH_START']], 'SCH_END': [row['SCH_END']], 'SCH_OR': [row['SCH_OR']], 'Service_Line': [row['Service_Line']], 'CANCELLED': [row['CANCELLED']],
-                                                           "IN_ROOM_TIME":[previous_case['OUT_ROOM_TIME'] + timedelta(minutes=simulated_turnover_time)], "OUT_ROOM_TIME":[previous_case['OUT_ROOM_TIME'] + timedelta(minutes=simulated_turnover_time+case_length_modifier+scheduled_case_length)],
-                                                       "OR_USED":[row['SCH_OR']]})
-
-                            simulated_cases = simulated_cases.append(temp_d)
-                    
-                    
-        
-        
-        return simulated_cases
+'''
+
+Runs replications of many (month, weekday) scenarios in parallel across processes. Each worker process gets the
+cleaned data and the fitted distributions once when it starts, and every chunk of replications gets its own
+random stream, so the results are the same whatever the number of workers.
 
 '''
 
-Take the simulated case data and visualize it in a chart that gets saved to your working directory.
+############################# Parallel runner ########################################################################
+def _initWorker(combined_data, index_path):
+    #runs once when a worker process starts
+    useData(combined_data)
+    if index_path is not None:
+        useDistributionIndex(DistributionIndex.load(index_path, combined_data))
+
+def _runReplicationChunk(task):
+    #one chunk of replications of one scenario
+    scenario, first_replication, n, seed_sequence = task
+    results = HersheyORSim(*scenario, seed=seed_sequence).runReplications(n)
+    results['REPLICATION'] = results['REPLICATION'] + first_replication
+    return results
+
+def _summarizeChunk(task):
+    #KPIs of one chunk of replications of one scenario
+    scenario, first_replication, n, seed_sequence = task
+    return HersheyORSim(*scenario, seed=seed_sequence).summarizeReplications(n, chunk_size=n)
+
+def _replicationTasks(scenarios, n, seed, chunk_size):
+    #one random stream per scenario, split into one stream per chunk - independent of how the chunks are spread out
+    tasks = []
+    for scenario, scenario_seed in zip(scenarios, spawnSeeds(seed, len(scenarios))):
+        chunk_starts = list(range(0, n, chunk_size))
+        for first_replication, chunk_seed in zip(chunk_starts, scenario_seed.spawn(len(chunk_starts))):
+            tasks.append((scenario, first_replication, min(chunk_size, n - first_replication), chunk_seed))
+    return tasks
+
+def _runTasks(tasks, scenarios, combined_data, max_workers, prefit, function=_runReplicationChunk):
+    #results of each task in task order - at most two tasks per worker are in flight so memory stays bounded
+    if max_workers == 1:
+        for task in tasks:
+            yield function(task)
+        return
+
+    index_path = None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if prefit:
+            #fit every room of every scenario once so the workers only sample
+            distribution_index = getDistributionIndex()
+            for scenario in scenarios:
+                example_class = HersheyORSim(*scenario)
+                for or_room in getAllORRooms():
+                    distribution_index.planModel(or_room, example_class.selected_month, example_class.selected_weekday, example_class.selected_cutoff_time)
+                    distribution_index.simulationModel(or_room, example_class.selected_month, example_class.selected_weekday)
+            index_path = os.path.join(temp_dir, "distribution_index.pkl")
+            distribution_index.save(index_path)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_initWorker, initargs=(combined_data, index_path)) as executor:
+            in_flight = 2*(max_workers or os.cpu_count() or 1)
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(function, task))
+                if len(pending) >= in_flight:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+def _labelChunk(scenario, results):
+    #label a chunk of results with its scenario
+    example_class = HersheyORSim(*scenario)
+    results.insert(0, 'CUTOFF', example_class.selected_cutoff_time)
+    results.insert(0, 'WEEKDAY', example_class.selected_weekday)
+    results.insert(0, 'MONTH', example_class.selected_month)
+    return results
+
+def runParallel(scenarios, n, seed=None, max_workers=None, chunk_size=100, prefit=True, sink=None):
+    '''
+    Input: list of scenarios - (month, weekday) or (month, weekday, cutoff time) tuples - replications per scenario,
+    seed (int, SeedSequence or Generator), number of worker processes (default one per core, 1 runs in this process), replications per task,
+    whether to fit the distributions once here and hand them to the workers, optional ResultSink to stream the results to
+    Output: results of every replication of every scenario in one DataFrame with MONTH, WEEKDAY and CUTOFF columns -
+    or, with a sink, the sink after every chunk has been written to it (nothing is kept in memory)
+
+    On Windows call this from under if __name__ == "__main__": so the worker processes can start.
+    '''
+    scenarios = [tuple(scenario) for scenario in scenarios]
+    combined_data = getCombinedData()
+
+    tasks = _replicationTasks(scenarios, n, seed, chunk_size)
+    chunk_results = _runTasks(tasks, scenarios, combined_data, max_workers, prefit)
+    if sink is None:
+        return pd.concat([_labelChunk(task[0], results) for task, results in zip(tasks, chunk_results)], ignore_index=True)
+
+    for task, results in zip(tasks, chunk_results):
+        sink.write(_labelChunk(task[0], results), scenarioKey(*task[0]), task[3])
+    return sink
+
+def summarizeParallel(scenarios, n, seed=None, max_workers=None, chunk_size=1000, prefit=True):
+    '''
+    Input: the same as runParallel
+    Output: dict of scenario key (see scenarioKey) -> KPIAccumulator of every replication of the scenario - the
+    workers only send back their accumulators, never the simulated cases
+    '''
+    scenarios = [tuple(scenario) for scenario in scenarios]
+    tasks = _replicationTasks(scenarios, n, seed, chunk_size)
+    summaries = {}
+    for task, kpis in zip(tasks, _runTasks(tasks, scenarios, getCombinedData(), max_workers, prefit, _summarizeChunk)):
+        summaries.setdefault(scenarioKey(*task[0]), KPIAccumulator()).merge(kpis)
+    return summaries
+
+
+'''
+
+Scenario sweeps. A grid of months, weekdays and cutoff times is run with one task per (month, weekday), so every
+cutoff time of a key is planned from the same partitions of the data and simulated with the same fitted
+distributions, and each worker only fits the keys it runs.
 
 '''
 
-def visualizeSchedule(schedule, show_rooms=all_or_rooms):
+############################# Scenario sweeps ########################################################################
+def _sweepTask(task):
+    #KPIs of every cutoff time of one (month, weekday)
+    (selected_month, selected_weekday), cutoff_times, n, chunk_size, seed_sequences = task
+    return [HersheyORSim(selected_month, selected_weekday, selected_cutoff_time, seed=seed_sequence).summarizeReplications(n, chunk_size=chunk_size)
+            for selected_cutoff_time, seed_sequence in zip(cutoff_times, seed_sequences)]
+
+def runSweep(months=None, weekdays=None, cutoff_times=(.2916666,), n=1000, seed=None, max_workers=None, chunk_size=1000, prefit=False):
     '''
-    Input: final schedule that includes columns for both planned schedule and actual schedule, list of rooms to show
-    Output: graphs of planned vs. actual schedule, saves them to your folder
+    Input: months (default all twelve), weekdays (default Mon to Fri) and cutoff times to sweep, replications of each
+    scenario, seed, number of worker processes (1 runs in this process), replications simulated at once, whether to
+    fit every distribution here first instead of in the workers
+    Output: tidy DataFrame with one row per scenario, room and KPI (see KPIAccumulator.summary) labelled by MONTH,
+    WEEKDAY and CUTOFF
     '''
-    
-    #make the list of what rooms should be shown based on user input
-    rooms_in_data = list(set(schedule.SCH_OR.unique()))
-    new_show_rooms = []
-    for room in rooms_in_data:
-        if room in show_rooms:
-            new_show_rooms.append(room)
-    
-    #place the rooms in alphabetical order        
-    show_rooms = new_show_rooms
-    show_rooms = [x for x in show_rooms if str(x) != 'nan']
-    show_rooms.sort(reverse=False)
-    
-    sample_day = schedule.sort_values(by="SCH_OR")
-    
-    #set line colors for departments
-    line_color = {
-        "Urology" : "green",
-        "Ortho" : "blue",
-        "Otolaryngology": "orange",
-        "Trauma Surgery": "red",
-        "Neurosurgery": "purple",
-        "Plastic Surgery": "brown",
-        "Vascular Surgery": "pink",
-        "OB/Gyn": "gray",
-        "Ophthalmology Surgery": "olive",
-        "MIS/Bariatric Surgery": "cyan",
-        "GSSSO - HPB": "goldenrod",
-        "GSSSO - GSO": "magenta",
-        "Pediatric Surgery": "teal",
-        "Colorectal Surgery": "black",
-        "CT Surgery":"tomato",
-        "Thoracic Surgery":"sienna",
-        "GI-Adult":"darkgoldenrod",
-        "PEDS CT Surgery":"forestgreen",
-        "Transplant Surgery": "darkseagreen",
-        "Dental Surgery":"aquamarine",
-        "Miscellaneous Surgery": "darkslategray",
-        "Gift of Life":"deepskyblue",
-        "Pain": "dodgerblue",
-        "Pulmonary - Adult":"rebeccapurple",
-        "GI-Peds":"indigo",
-        "Pulmonary - Peds":"hotpink"
-    }
-    
-    
-    #initialize the graph with a point that will not be on it
-    point_plot =[
-      go.Scatter(x=["2010-02-05 01:00:00", "2010-02-05 01:00:00"],
-                 y=["Standby", "Standby"],
-                 name="",
-                 line=dict(color="black"))]
-    
-    #find date of first case of the day to set the proper range
-    start_range = sample_day.iloc[0,1].floor("D")
-    end_range = start_range + timedelta(minutes=1600)
-    
-    make_title = "Planned OR schedule"
-    layout = go.Layout(title=go.layout.Title(text=make_title,x=0.5),
-            xaxis={'title':'Time','range':[start_range, end_range]},
-            yaxis={'title':'OR'},
-            height = 900)
+    months = list(month_numbers) if months is None else list(months)
+    weekdays = weekday_names[:5] if weekdays is None else list(weekdays)
+    cutoff_times = list(cutoff_times)
+    keys = [(selected_month, selected_weekday) for selected_month in months for selected_weekday in weekdays]
+    #one random stream per scenario in grid order, so the results do not depend on the number of workers
+    key_seeds = spawnSeeds(seed, len(keys))
+    tasks = [(key, cutoff_times, n, chunk_size, key_seed.spawn(len(cutoff_times))) for key, key_seed in zip(keys, key_seeds)]
+    scenarios = [key + (selected_cutoff_time,) for key in keys for selected_cutoff_time in cutoff_times]
+
+    summaries = []
+    for task, key_kpis in zip(tasks, _runTasks(tasks, scenarios, getCombinedData(), max_workers, prefit, _sweepTask)):
+        (selected_month, selected_weekday), cutoff_times = task[:2]
+        for selected_cutoff_time, kpis in zip(cutoff_times, key_kpis):
+            summary = kpis.summary()
+            summary.insert(0, 'CUTOFF', selected_cutoff_time)
+            summary.insert(0, 'WEEKDAY', selected_weekday)
+            summary.insert(0, 'MONTH', selected_month)
+            summaries.append(summary)
+    return pd.concat(summaries, ignore_index=True)
 
-    fig = go.Figure(data=point_plot, layout=layout)
 
+'''
 
-    departments_used = []
+Streams simulated schedules to disk in chunks while the simulation runs, so long runs never hold more than one
+chunk of results in memory. Parquet and Arrow IPC need pyarrow - CSV works without it.
 
-    #loop through each case and add it to the chart
-    for i in range(0, len(sample_day)):
-        get_start = sample_day['SCH_START'].iloc[i]
-        get_end = sample_day['SCH_END'].iloc[i]
-        get_operating_room = sample_day['SCH_OR'].iloc[i]
-        get_department = sample_day['Service_Line'].iloc[i]
-        
-        if get_operating_room not in show_rooms:
-            continue
+'''
 
-        get_line_color = line_color[get_department]
-        line_color1 = dict(color=get_line_color)
+############################# Result sinks ########################################################################
+def scenarioKey(selected_month="Jan", selected_weekday="Mon", selected_cutoff_time=.2916666):
+    #text key of a scenario, e.g. Apr-Tue-0.2916666
+    return "{}-{}-{}".format(selected_month, selected_weekday, selected_cutoff_time)
 
-        if get_department in departments_used:
-            fig.add_trace(go.Scatter(x=[get_start, get_end],
-                 y=[get_operating_room, get_operating_room],
-                 name=get_department,
-                 line=line_color1,
-                showlegend=False))
+def seedLabel(seed):
+    #text that recreates a chunk's random stream - entropy/spawn key of a SeedSequence, e.g. 42/0-3
+    if isinstance(seed, np.random.SeedSequence):
+        return "{}/{}".format(seed.entropy, "-".join(str(key) for key in seed.spawn_key))
+    return "" if seed is None else str(seed)
 
+class ResultSink:
+    '''
+    Collects simulated schedules and writes them out in chunks of about row_group_size rows. Every row is labelled
+    with its SCENARIO and SEED, and a chunk never mixes scenarios, so readers can filter row groups lazily.
+    Use as a context manager or call close() at the end.
+    '''
+    def __init__(self, path, row_group_size=100000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.buffer = []
+        self.buffered_rows = 0
+        self.scenario = None
+        self.rows_written = 0
+
+    def write(self, results, scenario="", seed=None):
+        '''
+        Input: DataFrame of simulated cases (with a REPLICATION column), scenario key, seed of the chunk
+        '''
+        if scenario != self.scenario:
+            self.flush()
+            self.scenario = scenario
+        results = results.copy()
+        results.insert(0, 'SEED', seedLabel(seed))
+        results.insert(0, 'SCENARIO', scenario)
+        self.buffer.append(results)
+        self.buffered_rows += len(results)
+        if self.buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        #write everything buffered as one chunk
+        if self.buffered_rows > 0:
+            chunk = pd.concat(self.buffer, ignore_index=True)
+            self.writeChunk(chunk)
+            self.rows_written += len(chunk)
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def writeChunk(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ParquetSink(ResultSink):
+    #one Parquet row group per chunk
+    def __init__(self, path, row_group_size=100000):
+        import pyarrow
+        import pyarrow.parquet
+        super().__init__(path, row_group_size)
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def writeChunk(self, chunk):
+        if self.writer is None:
+            table = self.pyarrow.Table.from_pandas(chunk, preserve_index=False)
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
         else:
-            departments_used.append(get_department)
-            fig.add_trace(go.Scatter(x=[get_start, get_end],
-                y=[get_operating_room, get_operating_room],
-                 name=get_department,
-                 line=line_color1))
-     
-    #simulated end of day schedule viz
-    #same technique as above but use IN/OUT Room Time and actual OR Used
-    sample_day = sample_day.sort_values(by="OR_USED")
-    
-    point_plot1 = [
-      go.Scatter(x=["2010-02-05 01:00:00", "2010-02-05 01:00:00"],
-                 y=["Standby", "Standby"],
-                 name="",
-                 line=dict(color="black"))]
-
-    make_title1 = "Simulated OR schedule"
-    layout1 = go.Layout(title=go.layout.Title(text=make_title1,x=0.5),
-            xaxis={'title':'Time','range':[start_range, end_range]},
-            yaxis={'title':'OR'},
-            height = 900)
+            table = self.pyarrow.Table.from_pandas(chunk, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table, row_group_size=len(chunk))
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class ArrowSink(ResultSink):
+    #Arrow IPC file with one record batch per chunk
+    def __init__(self, path, row_group_size=100000):
+        import pyarrow
+        import pyarrow.ipc
+        super().__init__(path, row_group_size)
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def writeChunk(self, chunk):
+        if self.writer is None:
+            table = self.pyarrow.Table.from_pandas(chunk, preserve_index=False)
+            self.schema = table.schema
+            self.writer = self.pyarrow.ipc.new_file(self.path, table.schema)
+        else:
+            table = self.pyarrow.Table.from_pandas(chunk, schema=self.schema, preserve_index=False)
+        self.writer.write_table(table, max_chunksize=len(chunk))
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class CSVSink(ResultSink):
+    #plain CSV, appended chunk by chunk with the header written once
+    def writeChunk(self, chunk):
+        chunk.to_csv(self.path, mode='w' if self.rows_written == 0 else 'a', header=self.rows_written == 0, index=False)
 
-    fig1 = go.Figure(data=point_plot1, layout=layout1)
+def openSink(path, row_group_size=100000):
+    '''
+    Input: output file - .parquet, .arrow/.feather/.ipc or .csv - and rows per chunk
+    Output: the matching ResultSink, falling back to CSV (next to path) when pyarrow is not installed
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == ".parquet":
+            return ParquetSink(path, row_group_size)
+        if extension in (".arrow", ".feather", ".ipc"):
+            return ArrowSink(path, row_group_size)
+    except ImportError:
+        path = os.path.splitext(path)[0] + ".csv"
+        warnings.warn("pyarrow is not installed - writing CSV to {} instead".format(path))
+    return CSVSink(path, row_group_size)
+
+
+'''
 
+Backtesting. Every historical day in a date range is replayed with selectRealSchedule, simulated many times, and the
+simulated in room and out room times are scored against what really happened.
 
-    departments_used1 = []
+'''
+
+############################# Calibration metrics ########################################################################
+def ensembleCRPS(samples, observed):
+    '''
+    Input: (cases, samples) array of simulated values, observed value of each case
+    Output: continuous ranked probability score of each case - mean |X - y| - mean |X - X'| / 2 over the samples
+    '''
+    samples = np.sort(samples, axis=1)
+    n = samples.shape[1]
+    #mean |X - X'| from the sorted samples in one pass
+    weights = 2*np.arange(1, n + 1) - n - 1
+    spread = 2*(samples*weights).sum(axis=1)/n**2
+    return np.abs(samples - observed[:, None]).mean(axis=1) - spread/2
+
+def intervalCoverage(samples, observed, level):
+    #whether each observed value is inside the central prediction interval of the samples, nan where nothing was observed
+    low, high = np.quantile(samples, [.5 - level/2, .5 + level/2], axis=1)
+    return np.where(np.isnan(observed), np.nan, (observed >= low) & (observed <= high))
+
+class BacktestReport:
+    '''
+    Backtest results: one row per historical case (cases) and one per room and day (room_days), with calibration
+    metrics grouped by room, service line or over everything
+    '''
+    levels = (.5, .9)
+
+    def __init__(self, cases, room_days):
+        self.cases = cases
+        self.room_days = room_days
+
+    def caseMetrics(self, by=None):
+        #mean CRPS and interval coverage of the in room and out room times
+        metrics = ['CRPS_IN', 'CRPS_OUT'] + ['COVERAGE_{}_{}'.format(int(level*100), time) for level in self.levels for time in ('IN', 'OUT')]
+        cases = self.cases[self.cases.ACTUAL_IN.notna()]
+        if by is None:
+            return cases[metrics].mean().to_frame().T.assign(N=len(cases))
+        grouped = cases.groupby(by, observed=True)
+        return grouped[metrics].mean().assign(N=grouped.size())
+
+    def dayMetrics(self, by=None):
+        #end of day error and overrun error past the closing time, simulated median minus actual
+        room_days = self.room_days[self.room_days.ACTUAL_END.notna()].assign(ABS_END_ERROR=lambda room_days: room_days.END_ERROR.abs())
+        metrics = ['END_ERROR', 'ABS_END_ERROR', 'OVERRUN_ERROR', 'CRPS_END', 'COVERAGE_90_END']
+        if by is None:
+            return room_days[metrics].mean().to_frame().T.assign(ROOM_DAYS=len(room_days))
+        grouped = room_days.groupby(by, observed=True)
+        return grouped[metrics].mean().assign(ROOM_DAYS=grouped.size())
+
+    def byRoom(self):
+        return self.caseMetrics('SCH_OR').join(self.dayMetrics('SCH_OR'))
+
+    def byServiceLine(self):
+        return self.caseMetrics('Service_Line')
+
+    def summary(self):
+        return pd.concat([self.caseMetrics(), self.dayMetrics()], axis=1)
+
+def _backtestChunk(task):
+    #simulate a few historical days of one (month, weekday, cutoff) scenario
+    scenario, dates, n, seed_sequence = task
+    return HersheyORSim(*scenario, seed=seed_sequence).backtestDays(dates, n)
+
+def runBacktest(first_date, last_date, n=100, selected_cutoff_time=.2916666, seed=None, max_workers=None, days_per_task=5, prefit=True, index_file=None):
+    '''
+    Input: first and last date ('%Y-%m-%d', both included), simulations of each day, cutoff time, seed, number of
+    worker processes (1 runs in this process), historical days per task, whether to fit the distributions once here
+    and hand them to the workers, optional file to keep the fitted distributions in between backtests
+    Output: BacktestReport of every historical day in the range
+    '''
+    combined_data = getCombinedData()
+    if index_file is not None and os.path.exists(index_file):
+        useDistributionIndex(DistributionIndex.load(index_file, combined_data))
+
+    #each day is simulated with the distributions of its month and weekday
+    schedules = HersheyORSim(selected_cutoff_time=selected_cutoff_time).selectRealSchedules(first_date, last_date)
+    dates = pd.Series(schedules.CASE_DATE.unique())
+    scenarios = []
+    tasks = []
+    day_scenarios = pd.DataFrame({'CASE_DATE': dates, 'MONTH': monthNames(dates).astype(object), 'WEEKDAY': weekdayNames(dates).astype(object)})
+    for (month, weekday), days in day_scenarios.groupby(['MONTH', 'WEEKDAY'], sort=True):
+        scenarios.append((month, weekday, selected_cutoff_time))
+        for first_day in range(0, len(days), days_per_task):
+            tasks.append((scenarios[-1], list(days.CASE_DATE.iloc[first_day:first_day + days_per_task]), n))
+    #one random stream per task, so the results do not depend on the number of workers
+    tasks = [task + (task_seed,) for task, task_seed in zip(tasks, spawnSeeds(seed, len(tasks)))]
+
+    results = list(_runTasks(tasks, scenarios, combined_data, max_workers, prefit, _backtestChunk))
+    if index_file is not None:
+        getDistributionIndex().save(index_file)
+    cases = pd.concat([case_results for case_results, room_days in results], ignore_index=True)
+    room_days = pd.concat([room_days for case_results, room_days in results], ignore_index=True)
+    return BacktestReport(cases.sort_values(by=['CASE_DATE', 'SCH_OR', 'CASE_NBR'], ignore_index=True),
+                          room_days.sort_values(by=['CASE_DATE', 'SCH_OR'], ignore_index=True))
 
-    for i in range(0, len(sample_day)):
-        get_start = sample_day['IN_ROOM_TIME'].iloc[i]
-        get_end = sample_day['OUT_ROOM_TIME'].iloc[i]
-        get_operating_room = sample_day['OR_USED'].iloc[i]
-        get_department = sample_day['Service_Line'].iloc[i]
-        
-        if get_operating_room not in show_rooms:
-            continue
 
-        get_line_color = line_color[get_department]
-        line_color1 = dict(color=get_line_color)
+'''
 
-        if get_department in departments_used1:
-            fig1.add_trace(go.Scatter(x=[get_start, get_end],
-                 y=[get_operating_room, get_operating_room],
-                 name=get_department,
-                 line=line_color1,
-                showlegend=False))
+Take the simulated case data and visualize it in a chart that gets saved to your working directory.
 
-        else:
-            departments_used1.append(get_department)
-            fig1.add_trace(go.Scatter(x=[get_start, get_end],
-                y=[get_operating_room, get_operating_room],
-                 name=get_department,
-                 line=line_color1))
+'''
 
+#set line colors for departments
+service_line_colors = {
+    "Urology" : "green",
+    "Ortho" : "blue",
+    "Otolaryngology": "orange",
+    "Trauma Surgery": "red",
+    "Neurosurgery": "purple",
+    "Plastic Surgery": "brown",
+    "Vascular Surgery": "pink",
+    "OB/Gyn": "gray",
+    "Ophthalmology Surgery": "olive",
+    "MIS/Bariatric Surgery": "cyan",
+    "GSSSO - HPB": "goldenrod",
+    "GSSSO - GSO": "magenta",
+    "Pediatric Surgery": "teal",
+    "Colorectal Surgery": "black",
+    "CT Surgery":"tomato",
+    "Thoracic Surgery":"sienna",
+    "GI-Adult":"darkgoldenrod",
+    "PEDS CT Surgery":"forestgreen",
+    "Transplant Surgery": "darkseagreen",
+    "Dental Surgery":"aquamarine",
+    "Miscellaneous Surgery": "darkslategray",
+    "Gift of Life":"deepskyblue",
+    "Pain": "dodgerblue",
+    "Pulmonary - Adult":"rebeccapurple",
+    "GI-Peds":"indigo",
+    "Pulmonary - Peds":"hotpink"
+}
+
+def showRooms(schedule, show_rooms=None):
+    #rooms of the schedule to show, in alphabetical order
+    if show_rooms is None:
+        show_rooms = getAllORRooms()
+    show_rooms = set(show_rooms)
+    return sorted(room for room in schedule.SCH_OR.unique() if room in show_rooms and str(room) != 'nan')
+
+def figureHeight(show_rooms):
     #update figure height based on number of OR rooms being shown
     if len(show_rooms) < 6:
-        height_needed = 400
-    else:
-        height_needed = 400 + 14*(len(show_rooms)-6)
+        return 400
+    return 400 + 14*(len(show_rooms)-6)
 
-    #update the fig dimensions based on the above logic
-    fig.update_layout(
-    autosize=False,
-    width=1000,
-    height=height_needed,)
-    
-    fig1.update_layout(
-    autosize=False,
-    width=1000,
-    height=height_needed,)
+def scheduleSegments(schedule, show_rooms, start_column, end_column, room_column):
+    #(service line, starts, ends, rooms) of every case in show_rooms, one entry per service line
+    cases = schedule[schedule[room_column].isin(show_rooms)]
+    return [(service_line, cases[start_column].to_numpy(), cases[end_column].to_numpy(), cases[room_column].to_numpy())
+            for service_line, cases in cases.groupby(cases.Service_Line.astype(object), sort=False)]
 
+def plotlyTimes(times):
+    #datetime64 values put straight into an object array become integer nanoseconds - plotly needs datetimes, and None for missing times
+    times = pd.DatetimeIndex(times)
+    return np.where(times.isna(), None, times.to_pydatetime())
+
+def plotlyScheduleFigure(schedule, show_rooms, start_column, end_column, room_column, title):
+    '''
+    Input: schedule, rooms to show, columns with the start, end and room of each case, title
+    Output: plotly figure with one line trace per service line - the cases of a service line are joined into one
+    trace with None between them
+    '''
+    #find date of first case of the day to set the proper range
+    start_range = schedule.SCH_START.min().floor("D")
+    end_range = start_range + timedelta(minutes=1600)
+    layout = go.Layout(title=go.layout.Title(text=title,x=0.5),
+            xaxis={'title':'Time','range':[start_range, end_range]},
+            yaxis={'title':'OR', 'categoryorder':'array', 'categoryarray':["Standby"] + list(show_rooms)},
+            autosize=False, width=1000, height=figureHeight(show_rooms))
+
+    #initialize the graph with a point that will not be on it
+    traces = [go.Scatter(x=["2010-02-05 01:00:00", "2010-02-05 01:00:00"], y=["Standby", "Standby"], name="", line=dict(color="black"))]
+    for service_line, starts, ends, rooms in scheduleSegments(schedule, show_rooms, start_column, end_column, room_column):
+        x = np.empty(3*len(starts), dtype=object)
+        x[0::3] = plotlyTimes(starts)
+        x[1::3] = plotlyTimes(ends)
+        y = np.empty(3*len(starts), dtype=object)
+        y[0::3] = rooms
+        y[1::3] = rooms
+        traces.append(go.Scatter(x=x, y=y, name=service_line, mode='lines', connectgaps=False,
+                                 line=dict(color=service_line_colors.get(service_line, "gray"))))
+    return go.Figure(data=traces, layout=layout)
+
+def matplotlibScheduleAxes(ax, schedule, show_rooms, start_column, end_column, room_column, title):
+    #draw the schedule on matplotlib axes with one broken_barh call per room
+    start_range = schedule.SCH_START.min().floor("D")
+    room_rows = {room: row for row, room in enumerate(show_rooms)}
+    cases = schedule[schedule[room_column].isin(show_rooms)]
+    starts = mdates.date2num(cases[start_column].to_numpy())
+    widths = mdates.date2num(cases[end_column].to_numpy()) - starts
+    colors = np.array([service_line_colors.get(service_line, "gray") for service_line in cases.Service_Line.astype(object)], dtype=object)
+    room_codes = cases[room_column].map(room_rows).to_numpy()
+    for room, row in room_rows.items():
+        in_room = (room_codes == row) & ~np.isnan(widths)
+        if in_room.any():
+            ax.broken_barh(list(zip(starts[in_room], widths[in_room])), (row - .3, .6), facecolors=list(colors[in_room]))
+    ax.set_yticks(range(len(show_rooms)))
+    ax.set_yticklabels(show_rooms)
+    ax.set_ylim(-1, len(show_rooms))
+    ax.set_xlim(mdates.date2num(start_range), mdates.date2num(start_range + timedelta(minutes=1600)))
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    ax.set_xlabel('Time')
+    ax.set_ylabel('OR')
+    ax.set_title(title)
+    handles = [Patch(color=service_line_colors.get(service_line, "gray"), label=service_line)
+               for service_line in cases.Service_Line.astype(object).dropna().unique()]
+    ax.legend(handles=handles, loc='center left', bbox_to_anchor=(1, .5), fontsize='small')
+    return ax
+
+#planned and simulated views of a schedule: (columns of the start, end and room, title)
+schedule_views = [('SCH_START', 'SCH_END', 'SCH_OR', "Planned OR schedule"),
+                  ('IN_ROOM_TIME', 'OUT_ROOM_TIME', 'OR_USED', "Simulated OR schedule")]
+
+def scheduleFigures(schedule, show_rooms=None, backend="plotly"):
+    '''
+    Input: final schedule that includes columns for both planned schedule and actual schedule, list of rooms to show
+    (default all rooms), plotly or matplotlib
+    Output: planned and simulated figures
+    '''
+    show_rooms = showRooms(schedule, show_rooms)
+    if backend == "matplotlib":
+        figures = []
+        for start_column, end_column, room_column, title in schedule_views:
+            fig, ax = plt.subplots(figsize=(10, figureHeight(show_rooms)/100))
+            matplotlibScheduleAxes(ax, schedule, show_rooms, start_column, end_column, room_column, title)
+            #fixed margins with room for the legend on the right - much faster than tight_layout
+            fig.subplots_adjust(left=.1, right=.78, top=.92, bottom=.1)
+            figures.append(fig)
+        return tuple(figures)
+    return tuple(plotlyScheduleFigure(schedule, show_rooms, start_column, end_column, room_column, title)
+                 for start_column, end_column, room_column, title in schedule_views)
+
+def writeFigures(figures, files):
+    #plotly figures are written by one kaleido process, matplotlib figures are saved and closed
+    if len(figures) == 0:
+        return
+    if isinstance(figures[0], go.Figure):
+        if hasattr(pio, 'write_images'):
+            pio.write_images(figures, files)
+        else:
+            #older plotly keeps one kaleido process alive between calls
+            for fig, file in zip(figures, files):
+                fig.write_image(file)
+    else:
+        for fig, file in zip(figures, files):
+            fig.savefig(file)
+            plt.close(fig)
+
+def visualizeSchedule(schedule, show_rooms=None, backend="plotly", write_images=True):
+    '''
+    Input: final schedule that includes columns for both planned schedule and actual schedule, list of rooms to show (default all rooms),
+    plotly or the faster static matplotlib backend, whether to save the images
+    Output: graphs of planned vs. actual schedule, saves them to your folder
+    '''
+    fig, fig1 = scheduleFigures(schedule, show_rooms, backend)
 
     #write the images to the current directory
-    fig.write_image("planned_schedule.png")
-    fig1.write_image("simulated_schedule.png")
-    return fig, fig1
\ No newline at end of file
+    if write_images:
+        writeFigures([fig, fig1], ["planned_schedule.png", "simulated_schedule.png"])
+    return fig, fig1
+
+def visualizeReplications(replications, output_dir="schedules", show_rooms=None, backend="plotly", file_format="png", batch_size=50):
+    '''
+    Input: simulated cases of many days labelled by a REPLICATION column (e.g. from runReplications), folder for
+    the images, rooms to show, plotly or matplotlib, image format, days written per kaleido call
+    Output: list of the image files written - planned_schedule_<replication> and simulated_schedule_<replication>
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    #matplotlib figures are written as they are made so only two are open at a time
+    batch_size = 1 if backend == "matplotlib" else batch_size
+    figures = []
+    files = []
+    for replication, schedule in replications.groupby('REPLICATION', sort=True):
+        figures += scheduleFigures(schedule, show_rooms, backend)
+        files += [os.path.join(output_dir, "{}_schedule_{}.{}".format(kind, replication, file_format)) for kind in ("planned", "simulated")]
+        if len(figures) >= 2*batch_size:
+            writeFigures(figures, files[-len(figures):])
+            figures = []
+    if figures:
+        writeFigures(figures, files[-len(figures):])
+    return files
@@ -0,0 +1,42 @@
+'''
+
+Replays every historical day in a date range, simulates each one many times and reports how well the simulated
+in room and out room times match what really happened.
+
+Usage:
+    python run_backtest.py 2019-01-01 2019-12-31
+    python run_backtest.py 2019-04-01 2019-04-30 --n 200 --workers 4 --index-file backtest_index.pkl --out backtest
+
+'''
+
+import argparse
+import time
+
+import pandas as pd
+
+import ORSim
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the ORSim simulation against historical days")
+    parser.add_argument("first_date", help="first day to replay, e.g. 2019-01-01")
+    parser.add_argument("last_date", help="last day to replay, e.g. 2019-12-31")
+    parser.add_argument("--n", type=int, default=100, help="simulations of each day")
+    parser.add_argument("--cutoff", type=float, default=.2916666, help="cutoff time in days before midnight")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random draws")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default one per core, 1 runs in this process)")
+    parser.add_argument("--index-file", default=None, help="keep the fitted distributions in this file between backtests")
+    parser.add_argument("--out", default=None, help="write OUT_rooms.csv, OUT_service_lines.csv and OUT_cases.csv")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report = ORSim.runBacktest(args.first_date, args.last_date, n=args.n, selected_cutoff_time=args.cutoff, seed=args.seed,
+                               max_workers=args.workers, index_file=args.index_file)
+    print("Backtested", report.room_days.CASE_DATE.nunique(), "days in", round(time.perf_counter() - start, 2), "seconds")
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(report.summary().T.to_string())
+        print(report.byRoom().to_string())
+    if args.out is not None:
+        report.byRoom().to_csv(args.out + "_rooms.csv")
+        report.byServiceLine().to_csv(args.out + "_service_lines.csv")
+        report.cases.to_csv(args.out + "_cases.csv", index=False)
@@ -0,0 +1,279 @@
+'''
+
+Benchmarks the hot paths of ORSim - loading the data, planning, selecting a real schedule, simulating,
+batches of replications and visualizing - on a synthetic data set shaped like the two input workbooks,
+so it runs without the real case files.
+
+Usage:
+    python run_benchmark.py                           # run and print the timings
+    python run_benchmark.py --save baseline           # also store them in benchmarks/baseline.json
+    python run_benchmark.py --compare baseline        # compare against benchmarks/baseline.json
+    python run_benchmark.py --real                    # use the real workbooks instead of synthetic data
+
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+#imported inside runBenchmarks so the import itself can be timed
+ORSim = None
+
+BENCHMARK_DIR = "benchmarks"
+
+#a phase counts as a regression when it is this much slower than the baseline
+REGRESSION_RATIO = 1.25
+
+#service lines of the synthetic data with (mean, sd) of their scheduled case length in minutes
+synthetic_service_lines = {
+    "Urology": (90, 30), "Ortho": (150, 45), "Otolaryngology": (100, 35), "Trauma Surgery": (120, 50),
+    "Neurosurgery": (210, 60), "Plastic Surgery": (130, 40), "Vascular Surgery": (180, 50), "OB/Gyn": (110, 35),
+    "Ophthalmology Surgery": (60, 20), "MIS/Bariatric Surgery": (140, 40), "Colorectal Surgery": (170, 50),
+    "CT Surgery": (260, 70), "Pediatric Surgery": (90, 30), "Transplant Surgery": (300, 80),
+}
+
+
+'''
+
+Synthetic data set with the same columns and types as OR_Model_Final_PSH.xlsx and
+2019_Cancelled_Cases_Complete_Clean.xlsx
+
+'''
+
+def syntheticCases(days=365, rooms=20, cancelled_share=.09, seed=0):
+    '''
+    Input: number of days from 2019-01-01, number of OR rooms, share of cases that are cancelled, seed
+    Output: raw scheduled cases and raw cancelled cases as they would be read from the two workbooks
+    '''
+    rng = np.random.default_rng(seed)
+    service_lines = list(synthetic_service_lines)
+    room_names = ["MOR {:02d}".format(i + 1) for i in range(rooms - rooms // 4)] + ["CHOR {:02d}".format(i + 1) for i in range(rooms // 4)]
+    #each room mostly works for one service line
+    room_service_line = rng.choice(len(service_lines), size=len(room_names))
+
+    scheduled = []
+    cancelled = []
+    case_number = 0
+    for day in pd.date_range("2019-01-01", periods=days, freq="D"):
+        #fewer rooms run at the weekend
+        open_rooms = len(room_names) if day.dayofweek < 5 else max(1, len(room_names) // 5)
+        for room in rng.choice(len(room_names), size=open_rooms, replace=False):
+            sch_start = day + timedelta(minutes=int(rng.choice([450, 450, 450, 480, 510])))
+            in_room = None
+            for case in range(int(rng.integers(1, 7))):
+                case_number += 1
+                service_line = service_lines[room_service_line[room] if rng.random() < .9 else rng.integers(len(service_lines))]
+                mean_length, sd_length = synthetic_service_lines[service_line]
+                sch_length = max(15, int(round(rng.normal(mean_length, sd_length) / 5) * 5))
+                sch_end = sch_start + timedelta(minutes=sch_length)
+                if sch_end.hour >= 20:
+                    break
+
+                if rng.random() < cancelled_share:
+                    cancelled.append({"Case Number Formatted": "OR-2019-{}".format(case_number), "Scheduled OR Number": room_names[room],
+                                      "Service Line": service_line, "Service Line Dept": service_line,
+                                      "Cancelled Date and time": sch_start - timedelta(hours=float(rng.uniform(2, 96))),
+                                      "Scheduled Start  Date and Time": sch_start, "SCH_END": sch_end, "ACTUAL_DURATION": 0,
+                                      "IN_ROOM_TIME": None, "OUT_ROOM_TIME": None, "Medical Service": service_line})
+                else:
+                    #the first case starts a little late, later cases follow the previous one after a turnover
+                    if in_room is None:
+                        in_room = sch_start + timedelta(minutes=int(rng.normal(10, 12)))
+                    else:
+                        in_room = max(in_room, sch_start + timedelta(minutes=int(rng.normal(5, 15))))
+                    out_room = in_room + timedelta(minutes=max(10, int(rng.normal(sch_length, .25 * sch_length))))
+                    add_on_hours = float(rng.uniform(-1, 1)) if rng.random() < .05 else float(rng.uniform(24, 24 * 14))
+                    scheduled.append({"CASE_NBR": "OR-2019-{}".format(case_number), "PT_STATUS": "Elective" if add_on_hours > 24 else "Emergency",
+                                      "WEEKDAY": day.strftime("%a").upper(), "CASE_DATE": day, "ADD_ON": int(add_on_hours < 24),
+                                      "ADD_ON_HOURS": round(add_on_hours, 2), "ORIG_SCH_DATE": sch_start - timedelta(hours=add_on_hours),
+                                      "SCH_START": sch_start, "SCH_END": sch_end, "SCH_OR": room_names[room], "OR_USED": room_names[room],
+                                      "IN_ROOM_TIME": in_room, "OUT_ROOM_TIME": out_room, "Service_Line": service_line,
+                                      "Service_Line_Dept": service_line})
+                    in_room = out_room + timedelta(minutes=int(rng.integers(15, 45)))
+                #the next case is scheduled after a turnover, on a 5 minute boundary
+                sch_start = sch_end + timedelta(minutes=int(rng.choice([15, 20, 30, 30, 45])))
+
+    scheduled = pd.DataFrame(scheduled)
+    cancelled = pd.DataFrame(cancelled)
+    #whole seconds, as read from the workbooks
+    for column in ["ORIG_SCH_DATE", "IN_ROOM_TIME", "OUT_ROOM_TIME"]:
+        scheduled[column] = pd.to_datetime(scheduled[column]).dt.floor("s")
+    for column in ["Cancelled Date and time", "IN_ROOM_TIME", "OUT_ROOM_TIME"]:
+        cancelled[column] = pd.to_datetime(cancelled[column]).dt.floor("s")
+    return scheduled, cancelled
+
+
+'''
+
+Timing and peak memory of each phase
+
+'''
+
+def measure(results, phase, function, repeat=1, warmup=False):
+    '''
+    Input: dict of results, name of the phase, function to time, number of timed runs, whether to run it once
+    untimed first (so anything it fits on first use is already fitted)
+    Output: the return value of the last run; the best time, mean time and peak memory are added to results
+
+    The timed runs are not traced, tracing slows Python down a lot - the peak memory comes from one extra traced run.
+    '''
+    times = []
+    try:
+        if warmup:
+            function()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            value = function()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            value = function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except Exception as e:
+        #a phase that cannot run here (e.g. image export without kaleido) is reported instead of stopping the run
+        results[phase] = {"error": "{}: {}".format(type(e).__name__, str(e).strip().splitlines()[0] if str(e).strip() else "")}
+        print("{:<40} failed - {}".format(phase, results[phase]["error"]))
+        return None
+    results[phase] = {"best_seconds": min(times), "mean_seconds": sum(times) / len(times), "peak_mb": peak / 2**20, "repeat": repeat}
+    print("{:<40} best {:8.3f}s  mean {:8.3f}s  peak {:8.1f} MB".format(phase, min(times), sum(times) / len(times), peak / 2**20))
+    return value
+
+def refit(function):
+    #runs function with nothing fitted yet, so fitting the distributions is part of the timing
+    def run():
+        ORSim.useDistributionIndex(None)
+        return function()
+    return run
+
+def runBenchmarks(real=False, days=365, rooms=20, repeat=3, months=("Jan", "Apr", "Jul", "Oct"), weekdays=("Mon", "Wed", "Fri")):
+    '''
+    Input: whether to use the real workbooks, size of the synthetic data, number of runs of each phase,
+    months and weekdays to plan
+    Output: dict of phase -> timings
+    '''
+    global ORSim
+    results = {}
+
+    #importing the module should not read any data - timed once, a second import would be free
+    start = time.perf_counter()
+    import ORSim
+    import_seconds = time.perf_counter() - start
+    results["import"] = {"best_seconds": import_seconds, "mean_seconds": import_seconds, "repeat": 1}
+    print("{:<40} best {:8.3f}s".format("import", results["import"]["best_seconds"]))
+
+    if real:
+        measure(results, "load data (workbooks, no cache)", lambda: ORSim.loadData(use_cache=False), 1)
+        measure(results, "load data (cache)", lambda: ORSim.loadData(), repeat, warmup=True)
+    else:
+        scheduled, cancelled = syntheticCases(days, rooms)
+        measure(results, "load data (clean synthetic)",
+                lambda: ORSim.useData(ORSim.combineCases(ORSim.cleanScheduledCases(scheduled.copy()), ORSim.cleanCancelledCases(cancelled.copy()))), repeat)
+
+    #planning a scenario for the first time fits its distributions, later plans only sample
+    for month in months:
+        for weekday in weekdays:
+            example_class = ORSim.HersheyORSim(month, weekday, seed=0)
+            measure(results, "fit + plan {} {}".format(month, weekday), refit(example_class.planSchedule))
+    example_class = ORSim.HersheyORSim(months[0], weekdays[0], seed=0)
+    planned_schedule = measure(results, "plan", example_class.planSchedule, repeat, warmup=True)
+    measure(results, "fit + simulate planned", refit(lambda: example_class.simulateSchedule(planned_schedule)))
+    simulated_schedule = measure(results, "simulate planned", lambda: example_class.simulateSchedule(planned_schedule), repeat, warmup=True)
+
+    #a real weekday from the data, simulated with the distributions of its own month and weekday
+    combined_data = ORSim.getCombinedData()
+    real_dates = combined_data.CASE_DATE[combined_data.CASE_DATE.dt.dayofweek < 5].dropna().sort_values().unique()
+    real_date = pd.Timestamp(real_dates[len(real_dates) // 2])
+    real_class = ORSim.HersheyORSim(real_date.strftime("%b"), real_date.strftime("%a"), seed=0)
+    real_schedule = measure(results, "selectRealSchedule", lambda: real_class.selectRealSchedule(real_date.strftime("%Y-%m-%d")), repeat, warmup=True)
+    measure(results, "fit + simulate historical", refit(lambda: real_class.simulateSchedule(real_schedule)))
+    measure(results, "simulate historical", lambda: real_class.simulateSchedule(real_schedule), repeat, warmup=True)
+
+    for n in (100, 1000):
+        measure(results, "runReplications {}".format(n), lambda: example_class.runReplications(n, seed=0), repeat, warmup=True)
+
+    #the images are written to a temporary folder so the benchmark leaves nothing behind
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        try:
+            if simulated_schedule is not None:
+                measure(results, "visualizeSchedule", lambda: ORSim.visualizeSchedule(simulated_schedule))
+                measure(results, "visualizeSchedule matplotlib", lambda: ORSim.visualizeSchedule(simulated_schedule, backend="matplotlib"))
+        finally:
+            os.chdir(working_dir)
+
+    return results
+
+
+'''
+
+Storing baselines and comparing against them
+
+'''
+
+def gitCommit():
+    #commit the benchmark ran on, if this is a git checkout
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def saveResults(results, name, settings):
+    #write the timings with enough context to tell the runs apart
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_DIR, name + ".json")
+    record = {"commit": gitCommit(), "date": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+              "numpy": np.__version__, "pandas": pd.__version__, "machine": platform.machine(), "settings": settings, "phases": results}
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+    print("Saved", path)
+
+def compareResults(results, name):
+    '''
+    Input: timings of this run, name of a stored baseline
+    Output: list of phases that are more than REGRESSION_RATIO times slower than the baseline
+    '''
+    with open(os.path.join(BENCHMARK_DIR, name + ".json")) as f:
+        baseline = json.load(f)
+    print("\nCompared with {} (commit {})".format(name, baseline.get("commit")))
+    regressions = []
+    for phase, timing in results.items():
+        baseline_timing = baseline["phases"].get(phase)
+        if baseline_timing is None or "best_seconds" not in baseline_timing or "best_seconds" not in timing:
+            continue
+        ratio = timing["best_seconds"] / max(baseline_timing["best_seconds"], 1e-9)
+        flag = "  REGRESSION" if ratio > REGRESSION_RATIO else ""
+        print("{:<40} {:8.3f}s -> {:8.3f}s  x{:5.2f}{}".format(phase, baseline_timing["best_seconds"], timing["best_seconds"], ratio, flag))
+        if flag:
+            regressions.append(phase)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ORSim planning, simulation and visualization hot paths")
+    parser.add_argument("--real", action="store_true", help="use the real workbooks instead of synthetic data")
+    parser.add_argument("--days", type=int, default=365, help="days of synthetic data")
+    parser.add_argument("--rooms", type=int, default=20, help="OR rooms in the synthetic data")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each repeated phase")
+    parser.add_argument("--save", metavar="NAME", help="store the results in benchmarks/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="compare with benchmarks/NAME.json and exit 1 on a regression")
+    args = parser.parse_args()
+
+    results = runBenchmarks(real=args.real, days=args.days, rooms=args.rooms, repeat=args.repeat)
+    settings = {"real": args.real, "days": args.days, "rooms": args.rooms, "repeat": args.repeat}
+    if args.save:
+        saveResults(results, args.save, settings)
+    if args.compare and compareResults(results, args.compare):
+        sys.exit(1)
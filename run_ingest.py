@@ -0,0 +1,35 @@
+'''
+
+Adds new scheduled and cancelled case extracts to the partitioned case store and refits only the distributions
+the new cases change.
+
+Usage:
+    python run_ingest.py OR_Model_Final_PSH.xlsx 2019_Cancelled_Cases_Complete_Clean.xlsx
+    python run_ingest.py new_scheduled.xlsx new_cancelled.xlsx --store orsim_store --build
+
+'''
+
+import argparse
+import time
+
+import ORSim
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest new case extracts into the ORSim case store")
+    parser.add_argument("scheduled_file", help="scheduled cases workbook with the OR_Model_Final_PSH.xlsx columns")
+    parser.add_argument("cancelled_file", help="cancelled cases workbook with the 2019_Cancelled_Cases_Complete_Clean.xlsx columns")
+    parser.add_argument("--store", default=ORSim.STORE_DIR, help="folder of the case store")
+    parser.add_argument("--build", action="store_true", help="also fit every room, month and weekday that is not fitted yet")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    new_cases = ORSim.ingestExtracts(args.scheduled_file, args.cancelled_file, args.store)
+    print("Added", len(new_cases), "new cases in", round(time.perf_counter() - start, 2), "seconds")
+    if len(new_cases) > 0:
+        print(new_cases.groupby(ORSim.CaseStore.partitionKeys(new_cases)[0]).size().rename("new cases per month").to_string())
+
+    if args.build:
+        start = time.perf_counter()
+        store = ORSim.CaseStore(args.store)
+        ORSim.getDistributionIndex().build().save(store.index_file)
+        print("Fitted every room, month and weekday in", round(time.perf_counter() - start, 2), "seconds")
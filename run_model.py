@@ -1,4 +1,5 @@
 #import the model code
+import os
 import ORSim
 
 print("Package successfully loaded...")
@@ -26,3 +27,51 @@ for simulation in range(0,10):
 	simulated_schedule_3 = example_class_3.simulateSchedule(planned_schedule_3)
 	print("Here are the first few cases of simulated schedule", simulation)
 	print(simulated_schedule_3.head(5))
+
+#the batch tools below share one seeded simulation of Tuesdays in April and are kept to demo sizes - full-size runs
+#belong in their own scripts, like run_benchmark.py and run_backtest.py. Files go to the ignored output folder
+example_class_4 = ORSim.HersheyORSim(selected_month = "Apr", selected_weekday = "Tue", seed = 42)
+os.makedirs("output", exist_ok=True)
+
+#simulate the same day 1000 times in one call - every replication is labelled in the REPLICATION column
+replications = example_class_4.runReplications(1000)
+print("Number of cases per simulated day")
+print(replications.groupby("REPLICATION").size().describe())
+
+#simulate 50 days with emergent cases arriving during the day - planned cases are bumped when a room is needed
+for policy in [ORSim.BumpingPolicy(), ORSim.NoBumpingPolicy(), ORSim.MaxWaitPolicy()]:
+	event_results = example_class_4.runEventReplications(50, policy=policy)
+	emergent_cases = event_results[event_results.EMERGENT == 1]
+	emergent_wait = (emergent_cases.IN_ROOM_TIME - emergent_cases.ARRIVAL_TIME).dt.total_seconds()/60
+	print(type(policy).__name__, "bumped cases per day:", event_results.BUMPED.sum()/50, "mean emergent wait (minutes):", emergent_wait.mean())
+
+#stream 100 days to a Parquet file in chunks instead of keeping them in memory, and summarize 200 days into KPIs
+#with 95% confidence intervals without keeping the cases at all - both work the same for runs too large for memory
+with ORSim.openSink(os.path.join("output", "replications.parquet")) as sink:
+	example_class_4.streamReplications(100, sink)
+print("Wrote", sink.rows_written, "simulated cases to", sink.path)
+kpis = example_class_4.summarizeReplications(200)
+print(kpis.summary().query("ROOM == 'ALL'"))
+print(kpis.overtimeQuantiles().loc["ALL"])
+print(kpis.cancellations())
+
+#draw 3 simulated days to image files - matplotlib is the faster static backend, plotly needs kaleido
+image_files = ORSim.visualizeReplications(example_class_4.runReplications(3), output_dir=os.path.join("output", "schedules"), backend="matplotlib")
+print("Wrote", len(image_files), "schedule images")
+
+#sweep two months, two weekdays and two cutoff times - one tidy table of KPIs per scenario and room. Leaving out
+#months and weekdays sweeps the full 12 x 5 grid, which takes many minutes
+sweep = ORSim.runSweep(months=["Apr", "May"], weekdays=["Tue", "Wed"], cutoff_times=(.2916666, .5), n=50, seed=5)
+print(sweep[(sweep.ROOM == "ALL") & (sweep.KPI == "overtime_minutes")].pivot_table(index=["MONTH", "WEEKDAY"], columns="CUTOFF", values="MEAN"))
+
+#reorder and move the cases of a real day to lower its expected overtime and idle time
+real_day = example_class_4.selectRealSchedule("2019-04-16")
+optimized_day, search_history = example_class_4.optimizeSchedule(real_day, iterations=30, n=50)
+print("Expected cost per day:", search_history.CURRENT_COST.iloc[0], "->", search_history.BEST_COST.iloc[-1])
+
+#time each phase and room of a run and count retried case lengths - a JSON trace for chrome://tracing or Perfetto
+with example_class_4.profile(trace=True) as profiler:
+	example_class_4.summarizeReplications(100)
+print(profiler.timerSummary().head(10))
+print(profiler.counterSummary().groupby("NAME").COUNT.sum())
+profiler.writeTrace(os.path.join("output", "orsim_trace.json"))